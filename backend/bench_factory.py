@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+"""
+Benchmark de throughput de la fábrica contra instancias de fake_reforge.py (LadyManager)
+
+Uso:
+  python bench_factory.py --jobs 100
+  python bench_factory.py --jobs 100,1000,10000 --instances 2 --latency lognormal:0.05,0.3 --swap-cost 0.5
+  python bench_factory.py --jobs 500 --scheduling grouped --json bench.json --min-ipm 300 --max-lag-p99 0.25
+
+Objetivo:
+- Levanta N ReForge falsos (subprocesos) y el backend en este proceso con carpetas temporales
+  (OUTPUTS_DIR, cola, índice, logs), sin tocar la configuración real.
+- Envía jobs sintéticos a /planner/execute_v2 (varios personajes y checkpoints) y espera queue_finished
+  por /factory/events.
+- Reporta imágenes/min, lag del event loop (p50/p99/máx), memoria máxima (RSS), latencia por etapa
+  (/factory/metrics) y utilización/cambios de modelo de cada instancia falsa.
+- Con --min-ipm / --max-lag-p99 / --max-failed sale con código 1 si no se cumplen (para CI).
+  Cada tamaño de --jobs corre en un subproceso aparte (backend limpio por corrida).
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+BACKEND_DIR = Path(__file__).resolve().parent
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def pct(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, min(len(values) - 1, int(q * len(values) + 0.999999) - 1))]
+
+
+def synthetic_jobs(n: int, characters: int, checkpoints: List[str], seed: int) -> Dict[str, Any]:
+    """Jobs de distintos personajes; cada personaje fija un checkpoint (mezcla realista de recargas)."""
+    rnd = random.Random(seed)
+    names = [f"bench_char_{i:02d}" for i in range(max(1, characters))]
+    jobs = []
+    for i in range(n):
+        name = rnd.choice(names)
+        jobs.append({
+            "character_name": name,
+            "prompt": f"{name}, masterpiece, best quality, pose {i % 7}",
+            "seed": rnd.randint(0, 2**31 - 1),
+        })
+    group_config = [{"character_name": name, "checkpoint": checkpoints[k % len(checkpoints)], "steps": 28}
+                    for k, name in enumerate(names)]
+    return {"jobs": jobs, "group_config": group_config}
+
+
+def current_rss_mb() -> float:
+    try:
+        with open("/proc/self/statm") as fh:
+            return int(fh.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1048576
+    except Exception:
+        return 0.0
+
+
+def start_fakes(args, workdir: Path) -> List[Dict[str, Any]]:
+    fakes = []
+    for i in range(args.instances):
+        port = free_port()
+        cmd = [sys.executable, str(BACKEND_DIR / "fake_reforge.py"), "--port", str(port),
+               "--latency", args.latency, "--swap-cost", str(args.swap_cost),
+               "--fail-rate", str(args.fail_rate), "--image-size", args.image_size,
+               "--seed", str(args.seed + i)]
+        log = open(workdir / f"fake_{port}.log", "w")
+        fakes.append({"url": f"http://127.0.0.1:{port}", "proc": subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT)})
+    return fakes
+
+
+async def wait_ready(urls: List[str], timeout: float = 60.0):
+    import httpx
+
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(timeout=2.0) as client:
+        for url in urls:
+            while True:
+                try:
+                    if (await client.get(f"{url}/sdapi/v1/options")).status_code == 200:
+                        break
+                except Exception:
+                    pass
+                if time.monotonic() > deadline:
+                    raise RuntimeError(f"{url} no respondió")
+                await asyncio.sleep(0.2)
+
+
+async def run_once(args) -> Dict[str, Any]:
+    import httpx
+
+    workdir = Path(tempfile.mkdtemp(prefix="lm_bench_"))
+    fakes = start_fakes(args, workdir)
+    try:
+        await wait_ready([f["url"] for f in fakes])
+        # Configuración aislada antes de importar el backend (lee el entorno al importar)
+        os.environ.update({
+            "OUTPUTS_DIR": str(workdir / "outputs"),
+            "FACTORY_QUEUE_PATH": str(workdir / "queue.db"),
+            "GALLERY_INDEX_PATH": str(workdir / "gallery_index.db"),
+            "FACTORY_LOG_PATH": str(workdir / "factory.log"),
+            "THUMBS_DIR": str(workdir / "thumbs"),
+            "REFORGE_API_BASE_URLS": ",".join(f["url"] for f in fakes),
+            "FACTORY_SCHEDULING": args.scheduling,
+            "FACTORY_MAX_BATCH": str(args.max_batch),
+        })
+        (workdir / "outputs").mkdir(parents=True, exist_ok=True)
+        sys.path.insert(0, str(BACKEND_DIR))
+        os.chdir(BACKEND_DIR)
+        import uvicorn
+        import main as backend
+
+        port = free_port()
+        server = uvicorn.Server(uvicorn.Config(backend.app, host="127.0.0.1", port=port, log_level="warning"))
+        server_task = asyncio.create_task(server.serve())
+        while not server.started:
+            await asyncio.sleep(0.05)
+
+        lags: List[float] = []
+        rss_peak = [current_rss_mb()]
+        stop = asyncio.Event()
+
+        async def probe():
+            # Lag del event loop: cuánto se atrasa un sleep de 50 ms
+            while not stop.is_set():
+                t0 = time.perf_counter()
+                await asyncio.sleep(0.05)
+                lags.append(max(0.0, time.perf_counter() - t0 - 0.05))
+                rss_peak[0] = max(rss_peak[0], current_rss_mb())
+
+        probe_task = asyncio.create_task(probe())
+        body = synthetic_jobs(args.jobs, args.characters, args.checkpoints, args.seed)
+        base = f"http://127.0.0.1:{port}"
+        async with httpx.AsyncClient(base_url=base, timeout=httpx.Timeout(30.0, read=None)) as client:
+            async with client.stream("GET", "/factory/events") as events:
+                started = time.perf_counter()
+                resp = await client.post("/planner/execute_v2", json=body)
+                resp.raise_for_status()
+                event = None
+                async for line in events.aiter_lines():
+                    if line.startswith("event:"):
+                        event = line[6:].strip()
+                    elif line.startswith("data:") and event == "queue_finished":
+                        break
+                elapsed = time.perf_counter() - started
+            metrics = (await client.get("/factory/metrics", params={"recent": 0})).json()
+            queue = (await client.get("/factory/queue", params={"limit": 1})).json()["counts"]
+            fake_stats = []
+            for f in fakes:
+                try:
+                    fake_stats.append({"url": f["url"], **(await client.get(f"{f['url']}/fake/stats")).json()})
+                except Exception as e:
+                    fake_stats.append({"url": f["url"], "error": str(e)})
+        stop.set()
+        await probe_task
+        server.should_exit = True
+        await server_task
+
+        images = int(metrics.get("images_total") or 0)
+        return {
+            "jobs": args.jobs,
+            "instances": args.instances,
+            "scheduling": args.scheduling,
+            "elapsed_s": round(elapsed, 2),
+            "images": images,
+            "images_per_min": round(images * 60.0 / elapsed, 2) if elapsed > 0 else 0.0,
+            "jobs_done": queue.get("done", 0),
+            "jobs_failed": queue.get("failed", 0),
+            "loop_lag_ms": {"p50": round((pct(lags, 0.5) or 0) * 1000, 2), "p99": round((pct(lags, 0.99) or 0) * 1000, 2),
+                            "max": round(max(lags or [0]) * 1000, 2)},
+            "rss_peak_mb": round(max(rss_peak[0], resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024), 1),
+            "stages": metrics.get("stages", {}),
+            "instances_stats": [{k: s.get(k) for k in ("url", "txt2img", "images", "swaps", "failures", "utilization", "error") if k in s}
+                                for s in fake_stats],
+        }
+    finally:
+        for f in fakes:
+            f["proc"].terminate()
+        for f in fakes:
+            try:
+                f["proc"].wait(timeout=5)
+            except Exception:
+                f["proc"].kill()
+
+
+def print_report(r: Dict[str, Any]):
+    print(f"\n== {r['jobs']} jobs · {r['instances']} instancia(s) · {r['scheduling']} ==")
+    print(f"  {r['images']} imágenes en {r['elapsed_s']}s -> {r['images_per_min']} img/min "
+          f"(ok {r['jobs_done']}, fallidos {r['jobs_failed']})")
+    lag = r["loop_lag_ms"]
+    print(f"  Lag del event loop: p50 {lag['p50']} ms, p99 {lag['p99']} ms, máx {lag['max']} ms · RSS máx {r['rss_peak_mb']} MB")
+    print(f"  {'etapa':<18}{'n':>7}{'p50':>10}{'p95':>10}{'p99':>10}")
+    for stage, s in r["stages"].items():
+        if s.get("count"):
+            print(f"  {stage:<18}{s['count']:>7}{s['p50']:>10.4f}{s['p95']:>10.4f}{s['p99']:>10.4f}")
+    for s in r["instances_stats"]:
+        print(f"  {s.get('url')}: {s.get('txt2img')} llamadas, {s.get('swaps')} cambios de modelo, "
+              f"utilización {s.get('utilization')}")
+
+
+def check_thresholds(results: List[Dict[str, Any]], args) -> List[str]:
+    errors = []
+    for r in results:
+        if args.min_ipm is not None and r["images_per_min"] < args.min_ipm:
+            errors.append(f"{r['jobs']} jobs: {r['images_per_min']} img/min < {args.min_ipm}")
+        if args.max_lag_p99 is not None and r["loop_lag_ms"]["p99"] / 1000 > args.max_lag_p99:
+            errors.append(f"{r['jobs']} jobs: lag p99 {r['loop_lag_ms']['p99']} ms > {args.max_lag_p99 * 1000} ms")
+        if args.max_failed is not None and r["jobs_failed"] > args.max_failed:
+            errors.append(f"{r['jobs']} jobs: {r['jobs_failed']} fallidos > {args.max_failed}")
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de la fábrica contra ReForge falsos.")
+    parser.add_argument("--jobs", default="100", help="Tamaños separados por coma (p. ej. 100,1000,10000)")
+    parser.add_argument("--instances", type=int, default=1)
+    parser.add_argument("--latency", default="lognormal:0.05,0.3", help="Distribución de fake_reforge.py")
+    parser.add_argument("--swap-cost", type=float, default=0.5)
+    parser.add_argument("--fail-rate", type=float, default=0.0)
+    parser.add_argument("--image-size", default="832x1216")
+    parser.add_argument("--characters", type=int, default=8)
+    parser.add_argument("--checkpoints", default="ponyDiffusionV6XL.safetensors,illustriousXL_v01.safetensors")
+    parser.add_argument("--scheduling", choices=("fifo", "grouped"), default="fifo")
+    parser.add_argument("--max-batch", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--json", dest="json_out", default=None, help="Guardar resultados en este archivo")
+    parser.add_argument("--min-ipm", type=float, default=None, help="CI: mínimo de imágenes/min")
+    parser.add_argument("--max-lag-p99", type=float, default=None, help="CI: lag p99 máximo (s)")
+    parser.add_argument("--max-failed", type=int, default=None, help="CI: máximo de jobs fallidos")
+    parser.add_argument("--single", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    args.checkpoints = [c.strip() for c in args.checkpoints.split(",") if c.strip()]
+
+    if args.single:
+        args.jobs = int(args.jobs)
+        print(json.dumps(asyncio.run(run_once(args))))
+        return
+
+    results = []
+    for size in [int(x) for x in str(args.jobs).split(",") if x.strip()]:
+        # Un proceso por tamaño: el backend se importa una sola vez por proceso
+        child = [a for a in sys.argv[1:]]
+        if "--jobs" in child:
+            child[child.index("--jobs") + 1] = str(size)
+        else:
+            child += ["--jobs", str(size)]
+        out = subprocess.run([sys.executable, __file__, *child, "--single"], capture_output=True, text=True)
+        line = next((l for l in reversed(out.stdout.splitlines()) if l.startswith("{")), None)
+        if out.returncode != 0 or line is None:
+            print(out.stdout[-2000:], out.stderr[-4000:], sep="\n")
+            sys.exit(f"La corrida de {size} jobs falló (código {out.returncode}).")
+        result = json.loads(line)
+        print_report(result)
+        results.append(result)
+
+    if args.json_out:
+        Path(args.json_out).write_text(json.dumps(results, indent=2, ensure_ascii=False), encoding="utf-8")
+    errors = check_thresholds(results, args)
+    for e in errors:
+        print(f"[FAIL] {e}")
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == "__main__":
+    main()
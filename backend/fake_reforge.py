@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+"""
+ReForge falso para medir la fábrica sin GPU (LadyManager)
+
+Uso:
+  python fake_reforge.py --port 7861 --latency lognormal:2.5,0.25 --swap-cost 8
+  python fake_reforge.py --port 7862 --latency fixed:0.05 --fail-rate 0.02 --image-size 832x1216
+
+Implementa los endpoints /sdapi/v1/* que usa services/reforge.py: txt2img, options (GET/POST),
+sd-models, sd-vae, upscalers, refresh-checkpoints, progress e interrupt.
+- Latencia de txt2img por distribución: fixed:S | uniform:A,B | normal:MEDIA,DESV | lognormal:MEDIANA,SIGMA
+  (escalada por steps/28, hires y batch_size). Una sola "GPU": las generaciones se serializan.
+- Cambio de checkpoint con costo configurable (--swap-cost) al hacer POST /options.
+- Inyección de fallos: --fail-rate (HTTP 500), --slow-rate/--slow-factor (latencias de cola).
+- Devuelve PNG reales en base64 (ruido del tamaño pedido, varios MB como los de ReForge) e 'info'
+  con all_seeds / index_of_first_image; con --return-grid antepone la grilla si batch_size > 1.
+- /fake/stats (contadores) y POST /fake/config (cambiar parámetros en caliente, p. ej. {"down": true}).
+"""
+
+import argparse
+import asyncio
+import base64
+import io
+import json
+import math
+import os
+import random
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+DEFAULT_CHECKPOINTS = ["ponyDiffusionV6XL.safetensors", "illustriousXL_v01.safetensors", "animagineXL_v31.safetensors"]
+
+
+def parse_latency(spec: str) -> Callable[[], float]:
+    """'fixed:2', 'uniform:1,3', 'normal:2,0.3', 'lognormal:2,0.25' -> función que devuelve segundos."""
+    kind, _, raw = (spec or "fixed:1").partition(":")
+    args = [float(x) for x in raw.split(",") if x.strip()] if raw else []
+    kind = kind.strip().lower()
+    if kind == "fixed":
+        value = args[0] if args else 1.0
+        return lambda: value
+    if kind in ("uniform", "normal", "lognormal") and len(args) != 2:
+        raise ValueError(f"'{kind}' requiere dos parámetros: {spec}")
+    if kind == "uniform":
+        lo, hi = args
+        return lambda: random.uniform(lo, hi)
+    if kind == "normal":
+        mean, sd = args
+        return lambda: max(0.0, random.gauss(mean, sd))
+    if kind == "lognormal":
+        median, sigma = args
+        mu = math.log(max(median, 1e-6))
+        return lambda: random.lognormvariate(mu, sigma)
+    raise ValueError(f"Distribución de latencia desconocida: {spec}")
+
+
+def make_png_b64(width: int, height: int) -> str:
+    """PNG de ruido (incompresible, tamaño realista) codificado en base64."""
+    from PIL import Image
+
+    img = Image.frombytes("RGB", (width, height), os.urandom(width * height * 3))
+    buf = io.BytesIO()
+    img.save(buf, "PNG", compress_level=1)
+    return base64.b64encode(buf.getvalue()).decode("ascii")
+
+
+class FakeReforge:
+    """Estado de la instancia falsa: configuración, modelo cargado, progreso y contadores."""
+
+    def __init__(self, latency: str = "fixed:1", swap_cost: float = 0.0, fail_rate: float = 0.0,
+                 slow_rate: float = 0.0, slow_factor: float = 5.0, image_size: str = "832x1216",
+                 checkpoints: Optional[List[str]] = None, return_grid: bool = False, image_pool: int = 4):
+        self.config: Dict[str, Any] = {}
+        self._images: List[str] = []
+        self.checkpoints = checkpoints or list(DEFAULT_CHECKPOINTS)
+        self.checkpoint = self.checkpoints[0]
+        self.update_config({
+            "latency": latency, "swap_cost": swap_cost, "fail_rate": fail_rate, "slow_rate": slow_rate,
+            "slow_factor": slow_factor, "image_size": image_size, "return_grid": return_grid, "down": False,
+        })
+        self._pool_size = max(1, image_pool)
+        self._gpu = asyncio.Lock()
+        self._interrupted = False
+        self.progress: Dict[str, Any] = {"progress": 0.0, "eta_relative": 0.0, "job": "", "step": 0, "steps": 0}
+        self.stats: Dict[str, Any] = {"txt2img": 0, "images": 0, "swaps": 0, "failures": 0,
+                                      "interrupts": 0, "busy_seconds": 0.0, "started": time.time()}
+
+    def update_config(self, values: Dict[str, Any]):
+        self.config.update({k: v for k, v in values.items() if v is not None})
+        self._sample = parse_latency(str(self.config["latency"]))
+        w, _, h = str(self.config["image_size"]).lower().partition("x")
+        size = (int(w or 832), int(h or 1216))
+        if size != getattr(self, "size", None):
+            self.size = size
+            self._images = []
+
+    def warm(self):
+        while len(self._images) < self._pool_size:
+            self._images.append(make_png_b64(*self.size))
+
+    def image(self) -> str:
+        # Pool pequeño precalculado: generar ruido de 3 MB por imagen mediría al servidor falso, no a la fábrica
+        if len(self._images) < self._pool_size:
+            self._images.append(make_png_b64(*self.size))
+            return self._images[-1]
+        return random.choice(self._images)
+
+    async def run_gpu(self, seconds: float, job: str, steps: int):
+        """Ocupa la "GPU" 'seconds' actualizando el progreso; corta antes si llega un interrupt."""
+        self._interrupted = False
+        started = time.monotonic()
+        self.progress.update({"job": job, "steps": steps})
+        while True:
+            elapsed = time.monotonic() - started
+            if elapsed >= seconds or self._interrupted:
+                break
+            frac = elapsed / seconds if seconds > 0 else 1.0
+            self.progress.update({"progress": round(frac, 4), "eta_relative": round(seconds - elapsed, 2),
+                                  "step": int(frac * steps)})
+            await asyncio.sleep(min(0.1, seconds - elapsed))
+        self.stats["busy_seconds"] += time.monotonic() - started
+        self.progress.update({"progress": 0.0, "eta_relative": 0.0, "job": "", "step": 0})
+
+
+def create_app(fake: FakeReforge) -> FastAPI:
+    app = FastAPI(title="Fake ReForge")
+
+    @app.on_event("startup")
+    async def _warm():
+        await asyncio.to_thread(fake.warm)
+
+    @app.middleware("http")
+    async def _down(request: Request, call_next):
+        if fake.config.get("down") and request.url.path.startswith("/sdapi/"):
+            return JSONResponse(status_code=503, content={"error": "down"})
+        return await call_next(request)
+
+    @app.get("/sdapi/v1/options")
+    async def get_options():
+        return {"sd_model_checkpoint": fake.checkpoint, "sd_batch_size": 1, "enable_hr": False, "hr_scale": 2.0}
+
+    @app.post("/sdapi/v1/options")
+    async def set_options(body: Dict[str, Any]):
+        target = body.get("sd_model_checkpoint")
+        if target and target != fake.checkpoint:
+            # Cargar un modelo ocupa la GPU igual que una generación
+            async with fake._gpu:
+                await fake.run_gpu(float(fake.config["swap_cost"]), "load_model", 0)
+                fake.checkpoint = target
+                fake.stats["swaps"] += 1
+        return None
+
+    @app.get("/sdapi/v1/sd-models")
+    async def sd_models():
+        return [{"title": c, "model_name": c.rsplit(".", 1)[0], "filename": f"/models/{c}"} for c in fake.checkpoints]
+
+    @app.get("/sdapi/v1/sd-vae")
+    async def sd_vae():
+        return [{"model_name": "sdxl_vae.safetensors", "filename": "/models/VAE/sdxl_vae.safetensors"}]
+
+    @app.get("/sdapi/v1/upscalers")
+    async def upscalers():
+        return [{"name": n} for n in ("Latent", "R-ESRGAN 4x+", "4x-UltraSharp")]
+
+    @app.post("/sdapi/v1/refresh-checkpoints")
+    async def refresh_checkpoints():
+        return None
+
+    @app.get("/sdapi/v1/progress")
+    async def progress():
+        p = fake.progress
+        return {
+            "progress": p["progress"], "eta_relative": p["eta_relative"],
+            "state": {"job": p["job"], "job_no": 0, "job_count": 1,
+                      "sampling_step": p["step"], "sampling_steps": p["steps"], "interrupted": fake._interrupted},
+            "current_image": None,
+        }
+
+    @app.post("/sdapi/v1/interrupt")
+    async def interrupt():
+        fake._interrupted = True
+        fake.stats["interrupts"] += 1
+        return None
+
+    @app.post("/sdapi/v1/txt2img")
+    async def txt2img(body: Dict[str, Any]):
+        cfg = fake.config
+        fake.stats["txt2img"] += 1
+        batch = max(1, int(body.get("batch_size") or 1)) * max(1, int(body.get("n_iter") or 1))
+        steps = int(body.get("steps") or 28)
+        seconds = fake._sample() * (steps / 28.0)
+        if body.get("enable_hr"):
+            seconds *= 1.0 + float(body.get("hr_scale") or 2.0) ** 2 * 0.35
+        # En GPU un lote cuesta menos que sus imágenes por separado
+        seconds *= 1.0 + (batch - 1) * 0.8
+        if random.random() < float(cfg["slow_rate"]):
+            seconds *= float(cfg["slow_factor"])
+        async with fake._gpu:
+            await fake.run_gpu(seconds, "txt2img", steps)
+        if random.random() < float(cfg["fail_rate"]):
+            fake.stats["failures"] += 1
+            return JSONResponse(status_code=500, content={"error": "RuntimeError", "detail": "Fallo inyectado"})
+        seed = body.get("seed")
+        base_seed = int(seed) if isinstance(seed, int) and seed >= 0 else random.randint(0, 2**32 - 1)
+        seeds = [base_seed + i for i in range(batch)]
+        images = [fake.image() for _ in range(batch)]
+        grid = bool(cfg["return_grid"]) and batch > 1
+        if grid:
+            images.insert(0, fake.image())
+        fake.stats["images"] += batch
+        info = {"seed": base_seed, "all_seeds": seeds, "index_of_first_image": 1 if grid else 0,
+                "sd_model_name": fake.checkpoint, "infotexts": [body.get("prompt", "")] * len(images)}
+        return {"images": images, "parameters": body, "info": json.dumps(info)}
+
+    @app.get("/fake/stats")
+    async def stats():
+        elapsed = max(1e-6, time.time() - fake.stats["started"])
+        return {**fake.stats, "utilization": round(fake.stats["busy_seconds"] / elapsed, 4),
+                "checkpoint": fake.checkpoint, "config": fake.config}
+
+    @app.post("/fake/config")
+    async def set_config(body: Dict[str, Any]):
+        fake.update_config(body)
+        return fake.config
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ReForge falso para pruebas de carga de la fábrica.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7861)
+    parser.add_argument("--latency", default="lognormal:2.5,0.25", help="fixed:S | uniform:A,B | normal:M,D | lognormal:MED,SIGMA")
+    parser.add_argument("--swap-cost", type=float, default=8.0, help="Segundos para cambiar de checkpoint")
+    parser.add_argument("--fail-rate", type=float, default=0.0)
+    parser.add_argument("--slow-rate", type=float, default=0.0)
+    parser.add_argument("--slow-factor", type=float, default=5.0)
+    parser.add_argument("--image-size", default="832x1216")
+    parser.add_argument("--image-pool", type=int, default=4)
+    parser.add_argument("--return-grid", action="store_true")
+    parser.add_argument("--checkpoints", default=",".join(DEFAULT_CHECKPOINTS))
+    parser.add_argument("--seed", type=int, default=None, help="Semilla del generador aleatorio (reproducible)")
+    args = parser.parse_args()
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    import uvicorn
+
+    fake = FakeReforge(latency=args.latency, swap_cost=args.swap_cost, fail_rate=args.fail_rate,
+                       slow_rate=args.slow_rate, slow_factor=args.slow_factor, image_size=args.image_size,
+                       checkpoints=[c.strip() for c in args.checkpoints.split(",") if c.strip()],
+                       return_grid=args.return_grid, image_pool=args.image_pool)
+    print(f"[FakeReforge] http://{args.host}:{args.port} latency={args.latency} swap={args.swap_cost}s fail={args.fail_rate}")
+    uvicorn.run(create_app(fake), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
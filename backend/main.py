@@ -1,23 +1,39 @@
 ﻿import os
 import asyncio
 import random
+import time
 import re
 from pathlib import Path
 from dotenv import load_dotenv
-from fastapi import FastAPI, HTTPException, BackgroundTasks, Request
+from fastapi import FastAPI, HTTPException, BackgroundTasks, Request, Query
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, PlainTextResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, FileResponse, Response, StreamingResponse
+from email.utils import formatdate, parsedate_to_datetime
 import httpx
-from services.reforge import call_txt2img, list_checkpoints, set_active_checkpoint, get_options, interrupt_generation, list_vaes, list_upscalers, refresh_checkpoints
+from services.reforge import call_txt2img, resolve_txt2img_payload, list_checkpoints, set_active_checkpoint, get_options, interrupt_generation, list_vaes, list_upscalers, refresh_checkpoints, get_client, close_client
 from services.lora import ensure_lora
 from services.llm import LLMService
 from services.library import LibraryService
+from services.gallery_index import GalleryIndex, parse_date_bound, encode_cursor, decode_cursor, date_folder_bounds, date_folder_in_range
+from services.gallery_watcher import GalleryWatcher
+from services.thumbnails import ThumbnailService, THUMB_SIZES
+from services.png_meta import read_image_text, parse_parameters
+from services.phash import DuplicateDetector
+from services.job_queue import JobQueue, JOB_STATUSES
+from services.reforge_pool import ReforgePool, ReforgeEndpoint, MAX_CONSECUTIVE_FAILURES
+from services.image_writer import ImageWriter
+from services.event_bus import EventBus
+from services.factory_log import LogBuffer, FactoryLogFile
+from services.factory_metrics import FactoryMetrics, JobSpan
+from services.fair_share import FairShare, parse_weights
+from services.retry_policy import RetryPolicy
 import cloudscraper
 from pydantic import BaseModel
 from urllib.parse import quote
-from typing import List, Optional, Union
+from typing import List, Optional, Union, Dict, Any
 import json
+import hashlib
 from PIL import Image
 try:
     from groq import Groq
@@ -255,12 +271,75 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "Last-Modified", "X-Next-Cursor"],
 )
 
 # Servicios Globales
 llm_service = LLMService()
 library_service = LibraryService()
 
+# Índice persistente de la galería (SQLite). GALLERY_INDEX=0 fuerza el escaneo clásico con os.walk.
+GALLERY_INDEX_PATH = os.getenv("GALLERY_INDEX_PATH") or str(BASE_DIR / "data" / "gallery_index.db")
+gallery_index: Optional[GalleryIndex] = None
+if OUTPUTS_DIR and os.getenv("GALLERY_INDEX", "1") != "0":
+    try:
+        gallery_index = GalleryIndex(Path(GALLERY_INDEX_PATH), OUTPUTS_DIR)
+        print(f"[GalleryIndex] Usando índice en: {GALLERY_INDEX_PATH}")
+    except Exception as e:
+        print(f"\033[33m[GalleryIndex] No se pudo abrir el índice ({e}); se usará os.walk.\033[0m")
+        gallery_index = None
+gallery_watcher: Optional[GalleryWatcher] = None
+if gallery_index is not None:
+    try:
+        gallery_watcher = GalleryWatcher(gallery_index, interval=float(os.getenv("GALLERY_RECONCILE_INTERVAL", "0") or 0))
+    except Exception as e:
+        print(f"\033[33m[GalleryWatcher] Configuración inválida ({e}); sin watcher.\033[0m")
+
+# Thumbnails WebP (THUMBS_DIR o <OUTPUTS_DIR>_thumbs), generados en un pool de procesos
+thumbnail_service: Optional[ThumbnailService] = None
+if OUTPUTS_DIR:
+    try:
+        thumbnail_service = ThumbnailService(OUTPUTS_DIR, os.getenv("THUMBS_DIR") or None)
+        print(f"[Thumbnails] Caché de thumbnails en: {thumbnail_service.thumbs_dir}")
+    except Exception as e:
+        print(f"\033[33m[Thumbnails] No se pudo configurar la caché ({e}).\033[0m")
+
+# Guardado de imágenes de la fábrica (decode + escritura + fsync) en un pool de hilos
+image_writer = ImageWriter(
+    workers=int(os.getenv("FACTORY_SAVE_WORKERS", "0") or 0) or None,
+    fsync=(os.getenv("FACTORY_FSYNC", "1").strip().lower() not in ("0", "false", "no")),
+)
+
+# Hash perceptual (dHash) en segundo plano para duplicados / "buscar similares"
+duplicate_detector: Optional[DuplicateDetector] = DuplicateDetector(gallery_index) if gallery_index is not None else None
+
+@app.on_event("startup")
+async def _startup_reforge_client():
+    # Un solo cliente con keep-alive para todas las llamadas a ReForge (progress, options, txt2img)
+    get_client()
+
+@app.on_event("shutdown")
+async def _shutdown_reforge_client():
+    await close_client()
+
+@app.on_event("startup")
+async def _startup_gallery_watcher():
+    # El primer barrido corre en segundo plano: ni el arranque ni /gallery esperan un recorrido completo
+    if gallery_watcher is not None:
+        gallery_watcher.start()
+    if duplicate_detector is not None:
+        duplicate_detector.start()
+
+@app.on_event("shutdown")
+async def _shutdown_gallery_watcher():
+    if gallery_watcher is not None:
+        await gallery_watcher.stop()
+    if thumbnail_service is not None:
+        thumbnail_service.shutdown()
+    if duplicate_detector is not None:
+        await duplicate_detector.stop()
+    image_writer.shutdown()
+
 # Montar directorio estÃ¡tico para servir imÃ¡genes generadas
 try:
     if OUTPUTS_DIR and Path(OUTPUTS_DIR).exists():
@@ -486,6 +565,10 @@ async def delete_file(path: str):
         if target.is_dir():
             raise HTTPException(status_code=400, detail="Ruta apunta a directorio, no archivo")
         target.unlink()
+        if gallery_index is not None:
+            await asyncio.to_thread(gallery_index.remove, target)
+        if thumbnail_service is not None:
+            thumbnail_service.remove(str(target.relative_to(base)).replace("\\", "/"))
         return {"deleted": True}
     except HTTPException:
         raise
@@ -499,18 +582,21 @@ class GalleryItem(BaseModel):
     url: str
     character: str
     timestamp: int
+    thumb_url: Optional[str] = None
+    thumb_md_url: Optional[str] = None
+
+def _thumb_urls(base_url: str, full_rel: str, ts: int) -> Dict[str, Optional[str]]:
+    """URLs de thumbnails (sm/md) para una ruta relativa a OUTPUTS_DIR; 'v' invalida caché del navegador."""
+    if thumbnail_service is None:
+        return {"thumb_url": None, "thumb_md_url": None}
+    q = quote(full_rel)
+    return {
+        "thumb_url": f"{base_url}/gallery/thumb?size=sm&path={q}&v={ts}",
+        "thumb_md_url": f"{base_url}/gallery/thumb?size=md&path={q}&v={ts}",
+    }
 
-@app.get("/gallery")
-async def get_gallery(request: Request, page: int = 1, limit: int = 100, character: Optional[str] = None, override_base: Optional[str] = None):
-    """Explora OUTPUTS_DIR y devuelve lista paginada de imÃ¡genes.
-    - filename: nombre del archivo
-    - path: ruta relativa dentro de OUTPUTS_DIR (usada para DELETE)
-    - url: /files/<path> para servir en navegador
-    - character: nombre del personaje (top-level folder)
-    - timestamp: mtime del archivo (segundos)
-    """
-    if not OUTPUTS_DIR:
-        raise HTTPException(status_code=400, detail="OUTPUTS_DIR no configurado en .env.")
+def _resolve_gallery_base(override_base: Optional[str]) -> Path:
+    """Resuelve override_base (tokens OUTPUTS_DIR) a una subcarpeta válida de OUTPUTS_DIR."""
     base = Path(OUTPUTS_DIR)
     try:
         raw = (override_base or "").strip()
@@ -522,55 +608,203 @@ async def get_gallery(request: Request, page: int = 1, limit: int = 100, charact
                 base = candidate
     except Exception:
         pass
+    return base
+
+def _scan_gallery_fs(base: Path, base_url: str, prefix: str = "",
+                     ts_from: Optional[int] = None, ts_to: Optional[int] = None) -> list[GalleryItem]:
+    """Escaneo clásico con os.walk (sin índice)."""
+    return list(_iter_gallery_fs(base, base_url, prefix, ts_from, ts_to))
+
+def _iter_gallery_fs(base: Path, base_url: str, prefix: str = "",
+                     ts_from: Optional[int] = None, ts_to: Optional[int] = None):
+    """Genera GalleryItem en orden de recorrido de os.walk.
+    Con ts_from/ts_to no desciende a carpetas <personaje>/<YYYYMMDD> fuera del rango."""
+    exts = {".png", ".jpg", ".jpeg", ".webp"}
+    dated = ts_from is not None or ts_to is not None
+    bounds = date_folder_bounds(ts_from, ts_to)
+    for root, dirs, files in os.walk(base):
+        if dated:
+            rel_root = Path(root).relative_to(base).as_posix()
+            full_root = "/".join(p for p in (prefix, "" if rel_root == "." else rel_root) if p)
+            # La carpeta de fecha es el segundo nivel bajo OUTPUTS_DIR (ver _save_image)
+            if full_root and "/" not in full_root:
+                dirs[:] = [d for d in dirs if date_folder_in_range(d, bounds)]
+        for fname in files:
+            ext = os.path.splitext(fname)[1].lower()
+            if ext not in exts:
+                continue
+            fpath = Path(root) / fname
+            rel = fpath.relative_to(base)
+            rel_str = str(rel).replace("\\", "/")
+            url = f"{base_url}/files/{quote(rel_str)}"
+            # derivar personaje desde primer segmento
+            parts = rel_str.split("/")
+            char_name = parts[0] if parts else "unknown"
+            # presentación amigable
+            character_pretty = char_name.replace("_", " ")
+            ts = int(fpath.stat().st_mtime)
+            if (ts_from is not None and ts < ts_from) or (ts_to is not None and ts >= ts_to):
+                continue
+            full_rel = f"{prefix}/{rel_str}" if prefix else rel_str
+            yield GalleryItem(
+                filename=fname,
+                path=rel_str,
+                url=url,
+                character=character_pretty,
+                timestamp=ts,
+                **_thumb_urls(base_url, full_rel, ts),
+            )
+
+def _gallery_prefix(base: Path) -> str:
+    """Subcarpeta de OUTPUTS_DIR (con '/') correspondiente a la base resuelta; '' si es la raíz."""
+    try:
+        rel = str(base.resolve().relative_to(Path(OUTPUTS_DIR).resolve())).replace("\\", "/")
+        return "" if rel == "." else rel
+    except ValueError:
+        return ""
+
+def _gallery_item_from_row(row: Dict[str, Any], prefix: str, base_url: str) -> GalleryItem:
+    """Construye un GalleryItem desde una fila del índice, relativo a la base pedida (override_base)."""
+    rel_str = row["path"][len(prefix) + 1:] if prefix else row["path"]
+    parts = rel_str.split("/")
+    char_name = parts[0] if parts else "unknown"
+    return GalleryItem(
+        filename=row["filename"],
+        path=rel_str,
+        url=f"{base_url}/files/{quote(rel_str)}",
+        character=char_name.replace("_", " "),
+        timestamp=int(row["mtime"]),
+        **_thumb_urls(base_url, row["path"], int(row["mtime"])),
+    )
+
+def _gallery_cache_headers(request: Request) -> tuple[Dict[str, str], Optional[Response]]:
+    """
+    ETag/Last-Modified de la colección según la versión del índice.
+    Devuelve (headers, respuesta 304 si el cliente ya tiene la versión actual).
+    """
+    if gallery_index is None:
+        return {}, None
+    generation, last_change = gallery_index.version()
+    etag = f'W/"gallery-{generation}"'
+    headers = {
+        "ETag": etag,
+        "Last-Modified": formatdate(last_change, usegmt=True),
+        "Cache-Control": "no-cache",
+    }
+    inm = request.headers.get("if-none-match")
+    if inm is not None:
+        tags = [t.strip() for t in inm.split(",")]
+        if "*" in tags or etag in tags:
+            return headers, Response(status_code=304, headers=headers)
+        return headers, None
+    ims = request.headers.get("if-modified-since")
+    if ims:
+        try:
+            if int(last_change) <= int(parsedate_to_datetime(ims).timestamp()):
+                return headers, Response(status_code=304, headers=headers)
+        except Exception:
+            pass
+    return headers, None
+
+def _ndjson_lines(items):
+    """Serializa un iterable de dicts/modelos como NDJSON (una línea por elemento)."""
+    for it in items:
+        data = it.dict() if isinstance(it, BaseModel) else it
+        yield json.dumps(data, ensure_ascii=False) + "\n"
+
+@app.get("/gallery")
+async def get_gallery(request: Request, page: int = 1, limit: Optional[int] = None, character: Optional[str] = None, override_base: Optional[str] = None,
+                      cursor: Optional[str] = None, format: Optional[str] = None,
+                      date_from: Optional[str] = Query(None, alias="from"), date_to: Optional[str] = Query(None, alias="to")):
+    """Devuelve lista paginada de imágenes de OUTPUTS_DIR (desde el índice si está disponible).
+    - filename: nombre del archivo
+    - path: ruta relativa dentro de OUTPUTS_DIR (usada para DELETE)
+    - url: /files/<path> para servir en navegador
+    - character: nombre del personaje (top-level folder)
+    - timestamp: mtime del archivo (segundos)
+    Paginación: page/limit (offset) o cursor opaco (header X-Next-Cursor), estable aunque
+    la fábrica esté escribiendo archivos nuevos. Responde 304 con If-None-Match/If-Modified-Since.
+    format=ndjson: transmite los items a medida que salen del índice (sin límite salvo 'limit'),
+    para exportaciones y "seleccionar todo" con memoria acotada.
+    from / to: YYYY-MM-DD, YYYYMMDD (inclusivos) o epoch; solo se consultan/recorren las
+    carpetas <personaje>/<YYYYMMDD> del rango.
+    """
+    if not OUTPUTS_DIR:
+        raise HTTPException(status_code=400, detail="OUTPUTS_DIR no configurado en .env.")
+    base = _resolve_gallery_base(override_base)
     if not base.exists():
         raise HTTPException(status_code=404, detail="OUTPUTS_DIR no existe en el sistema")
-    exts = {".png", ".jpg", ".jpeg", ".webp"}
-    items: list[GalleryItem] = []
-    try:
-        def scan() -> list[GalleryItem]:
-            out: list[GalleryItem] = []
-            for root, _, files in os.walk(base):
-                for fname in files:
-                    ext = os.path.splitext(fname)[1].lower()
-                    if ext not in exts:
-                        continue
-                    fpath = Path(root) / fname
-                    rel = fpath.relative_to(base)
-                    rel_str = str(rel).replace("\\", "/")
-                    base_url = str(request.base_url).rstrip("/")
-                    url = f"{base_url}/files/{quote(rel_str)}"
-                    # derivar personaje desde primer segmento
-                    parts = rel_str.split("/")
-                    char_name = parts[0] if parts else "unknown"
-                    # presentaciÃ³n amigable
-                    character_pretty = char_name.replace("_", " ")
-                    ts = int(fpath.stat().st_mtime)
-                    out.append(GalleryItem(
-                        filename=fname,
-                        path=rel_str,
-                        url=url,
-                        character=character_pretty,
-                        timestamp=ts,
-                    ))
-            return out
-        all_items = await asyncio.to_thread(scan)
-        # filtro por personaje si se envÃ­a
+    base_url = str(request.base_url).rstrip("/")
+    prefix = _gallery_prefix(base)
+    cursor_key = None
+    if cursor:
+        try:
+            cursor_key = decode_cursor(cursor)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    try:
+        ts_from = parse_date_bound(date_from)
+        ts_to = parse_date_bound(date_to, end=True)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if (format or "").lower() == "ndjson":
+        return _stream_gallery(base, base_url, prefix, character, cursor_key, limit, ts_from, ts_to)
+    page = max(1, int(page))
+    limit = max(1, min(500, int(limit if limit is not None else 100)))
+    start = (page - 1) * limit
+    try:
+        if gallery_index is not None:
+            headers, not_modified = _gallery_cache_headers(request)
+            if not_modified is not None:
+                return not_modified
+            rows = await asyncio.to_thread(gallery_index.query, prefix, character, limit, start, cursor_key, ts_from, ts_to)
+            if len(rows) == limit:
+                headers["X-Next-Cursor"] = encode_cursor(rows[-1]["mtime"], rows[-1]["path"])
+            return JSONResponse(content=[_gallery_item_from_row(r, prefix, base_url).dict() for r in rows], headers=headers)
+        all_items = await asyncio.to_thread(_scan_gallery_fs, base, base_url, prefix, ts_from, ts_to)
+        # filtro por personaje si se envía
         if character and character.strip():
             cc = character.strip().lower()
             all_items = [it for it in all_items if it.character.lower() == cc]
-        # ordenar por fecha desc
-        all_items.sort(key=lambda x: x.timestamp, reverse=True)
-        # paginaciÃ³n simple
-        page = max(1, int(page))
-        limit = max(1, min(500, int(limit)))
-        start = (page - 1) * limit
-        end = start + limit
-        return JSONResponse(content=[it.dict() for it in all_items[start:end]])
+        # ordenar por fecha desc (path desempata, igual que el índice)
+        full_key = lambda it: (it.timestamp, f"{prefix}/{it.path}" if prefix else it.path)
+        all_items.sort(key=full_key, reverse=True)
+        if cursor_key is not None:
+            all_items = [it for it in all_items if full_key(it) < cursor_key]
+            start = 0
+        page_items = all_items[start:start + limit]
+        headers = {}
+        if len(page_items) == limit:
+            headers["X-Next-Cursor"] = encode_cursor(*full_key(page_items[-1]))
+        return JSONResponse(content=[it.dict() for it in page_items], headers=headers)
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error escaneando galerÃ­a: {e}")
+        raise HTTPException(status_code=500, detail=f"Error escaneando galería: {e}")
+
+def _stream_gallery(base: Path, base_url: str, prefix: str, character: Optional[str],
+                    cursor_key: Optional[tuple], limit: Optional[int],
+                    ts_from: Optional[int] = None, ts_to: Optional[int] = None) -> StreamingResponse:
+    """Respuesta NDJSON de la galería. El generador es síncrono: Starlette lo itera en el threadpool."""
+    max_items = max(1, int(limit)) if limit is not None else None
+
+    def _items():
+        if gallery_index is not None:
+            rows = gallery_index.iter_query(prefix, character, cursor_key, date_from=ts_from, date_to=ts_to)
+            items = (_gallery_item_from_row(r, prefix, base_url) for r in rows)
+        else:
+            # Sin índice no hay orden global: se emite en orden de recorrido
+            items = _iter_gallery_fs(base, base_url, prefix, ts_from, ts_to)
+            if character and character.strip():
+                cc = character.strip().lower()
+                items = (it for it in items if it.character.lower() == cc)
+        for n, it in enumerate(items):
+            if max_items is not None and n >= max_items:
+                return
+            yield it
+
+    return StreamingResponse(_ndjson_lines(_items()), media_type="application/x-ndjson")
 
 @app.get("/gallery/folders")
-async def get_gallery_folders():
+async def get_gallery_folders(request: Request):
     if not OUTPUTS_DIR:
         raise HTTPException(status_code=400, detail="OUTPUTS_DIR no configurado en .env.")
     base = Path(OUTPUTS_DIR).resolve()
@@ -584,10 +818,174 @@ async def get_gallery_folders():
                     out.append(p.name)
             return sorted(out)
         items = await asyncio.to_thread(scan)
+        if gallery_index is not None:
+            # Unión con el índice: el listado de primer nivel es barato y mantiene carpetas vacías
+            # (personaje recién creado) o aún no indexadas durante la primera reconciliación
+            indexed = await asyncio.to_thread(gallery_index.characters)
+            items = sorted(set(items) | set(indexed))
+            # ETag por contenido: una carpeta vacía nueva no cambia la versión del índice
+            etag = 'W/"folders-' + hashlib.sha1("\n".join(items).encode("utf-8")).hexdigest()[:16] + '"'
+            headers = {"ETag": etag, "Cache-Control": "no-cache"}
+            tags = [t.strip() for t in request.headers.get("if-none-match", "").split(",")]
+            if "*" in tags or etag in tags:
+                return Response(status_code=304, headers=headers)
+            return JSONResponse(content=items, headers=headers)
         return items
     except Exception:
         return []
 
+@app.get("/gallery/search")
+async def search_gallery(request: Request, q: Optional[str] = None, lora: Optional[str] = None, seed: Optional[int] = None,
+                         checkpoint: Optional[str] = None, date_from: Optional[str] = None, date_to: Optional[str] = None,
+                         character: Optional[str] = None, page: int = 1, limit: int = 50):
+    """
+    Búsqueda sobre los parámetros de generación indexados (índice FTS5 de 'parameters').
+    - q: tokens del prompt (todos obligatorios), resultados ordenados por relevancia
+    - lora / checkpoint: nombre (o parte) del LoRA / modelo
+    - seed: seed exacta
+    - date_from / date_to: YYYY-MM-DD o YYYYMMDD (ambos inclusivos)
+    """
+    if gallery_index is None:
+        raise HTTPException(status_code=400, detail="Índice de galería desactivado")
+    try:
+        ts_from = parse_date_bound(date_from)
+        ts_to = parse_date_bound(date_to, end=True)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    page = max(1, int(page))
+    limit = max(1, min(200, int(limit)))
+    base_url = str(request.base_url).rstrip("/")
+    headers, not_modified = _gallery_cache_headers(request)
+    if not_modified is not None:
+        return not_modified
+    started = datetime.now()
+    try:
+        rows = await asyncio.to_thread(
+            gallery_index.search, q, lora, seed, checkpoint, ts_from, ts_to, character, limit + 1, (page - 1) * limit
+        )
+    except RuntimeError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error en búsqueda: {e}")
+    items = []
+    for r in rows[:limit]:
+        item = _gallery_item_from_row(r, "", base_url).dict()
+        item.update({"seed": r.get("seed"), "checkpoint": r.get("checkpoint"), "rank": r.get("rank")})
+        items.append(item)
+    return JSONResponse(content={
+        "items": items,
+        "page": page,
+        "limit": limit,
+        "has_more": len(rows) > limit,
+        "took_ms": round((datetime.now() - started).total_seconds() * 1000, 1),
+    }, headers=headers)
+
+def _gallery_ref(base_url: str, rel: str) -> Dict[str, Any]:
+    """Referencia mínima a una imagen (ruta relativa a OUTPUTS_DIR) con URLs de archivo y thumbnail."""
+    ref: Dict[str, Any] = {"path": rel, "url": f"{base_url}/files/{quote(rel)}"}
+    ref.update(_thumb_urls(base_url, rel, 0))
+    return ref
+
+@app.get("/gallery/stats")
+async def get_gallery_stats(request: Request, character: Optional[str] = None):
+    """
+    Estadísticas de producción: cantidad, bytes y último timestamp agrupados por personaje
+    (carpeta top-level) y por día (subcarpeta YYYYMMDD de _save_image). Se leen de agregados
+    mantenidos por el índice, sin recorrer imágenes.
+    """
+    if gallery_index is None:
+        raise HTTPException(status_code=400, detail="Índice de galería desactivado")
+    headers, not_modified = _gallery_cache_headers(request)
+    if not_modified is not None:
+        return not_modified
+    data = await asyncio.to_thread(gallery_index.stats, (character or "").strip() or None)
+    data["last_reconciled"] = gallery_index.last_reconciled()
+    return JSONResponse(content=data, headers=headers)
+
+@app.get("/gallery/duplicates")
+async def get_gallery_duplicates(request: Request, threshold: int = 4, limit: int = 200):
+    """
+    Reporte de duplicados y casi-duplicados (dHash de 64 bits, distancia de Hamming <= threshold).
+    threshold=0 agrupa solo copias exactas a nivel perceptual.
+    """
+    if duplicate_detector is None:
+        raise HTTPException(status_code=400, detail="Índice de galería desactivado")
+    threshold = max(0, min(16, int(threshold)))
+    limit = max(1, min(1000, int(limit)))
+    base_url = str(request.base_url).rstrip("/")
+    try:
+        groups = await asyncio.to_thread(duplicate_detector.duplicate_groups, threshold, limit)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error calculando duplicados: {e}")
+    return {
+        "threshold": threshold,
+        "groups": [{"count": g["count"], "items": [_gallery_ref(base_url, p) for p in g["paths"]]} for g in groups],
+        "status": await asyncio.to_thread(duplicate_detector.status),
+    }
+
+@app.get("/gallery/similar")
+async def get_gallery_similar(request: Request, path: str, threshold: int = 10, limit: int = 50):
+    """Imágenes perceptualmente similares a 'path' (relativa a OUTPUTS_DIR), ordenadas por distancia."""
+    if duplicate_detector is None:
+        raise HTTPException(status_code=400, detail="Índice de galería desactivado")
+    rel = (path or "").replace("\\", "/").strip("/")
+    base = Path(OUTPUTS_DIR).resolve()
+    target = (base / rel).resolve()
+    if base not in target.parents:
+        raise HTTPException(status_code=400, detail="Ruta fuera de OUTPUTS_DIR")
+    if not target.exists():
+        raise HTTPException(status_code=404, detail="Archivo no encontrado")
+    threshold = max(0, min(32, int(threshold)))
+    limit = max(1, min(500, int(limit)))
+    base_url = str(request.base_url).rstrip("/")
+    try:
+        matches = await asyncio.to_thread(duplicate_detector.similar, rel, threshold, limit)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error buscando similares: {e}")
+    items = []
+    for m in matches:
+        ref = _gallery_ref(base_url, m["path"])
+        ref["distance"] = m["distance"]
+        items.append(ref)
+    return {"path": rel, "threshold": threshold, "items": items}
+
+@app.get("/gallery/thumb")
+async def get_gallery_thumb(path: str, size: str = "sm"):
+    """Sirve el thumbnail WebP de una imagen (ruta relativa a OUTPUTS_DIR), generándolo si falta."""
+    if thumbnail_service is None:
+        raise HTTPException(status_code=400, detail="OUTPUTS_DIR no configurado en .env.")
+    if size not in THUMB_SIZES:
+        raise HTTPException(status_code=400, detail=f"size inválido (usar: {', '.join(THUMB_SIZES)})")
+    rel = (path or "").replace("\\", "/").strip("/")
+    if not rel or thumbnail_service.source_path(rel) is None:
+        raise HTTPException(status_code=400, detail="Ruta fuera de OUTPUTS_DIR")
+    try:
+        thumb = await thumbnail_service.ensure(rel, size)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error generando thumbnail: {e}")
+    if thumb is None:
+        raise HTTPException(status_code=404, detail="Archivo no encontrado")
+    return FileResponse(str(thumb), media_type="image/webp", headers={"Cache-Control": "public, max-age=604800"})
+
+@app.get("/gallery/index-status")
+async def get_gallery_index_status():
+    """Estado del índice de galería: modo del watcher y momento de la última reconciliación."""
+    if gallery_index is None:
+        return {"enabled": False}
+    status = gallery_watcher.status() if gallery_watcher is not None else {"last_reconciled": gallery_index.last_reconciled()}
+    status["enabled"] = True
+    status["count"] = await asyncio.to_thread(gallery_index.count)
+    return status
+
+@app.post("/gallery/reconcile")
+async def post_gallery_reconcile():
+    """Fuerza un barrido de reconciliación en segundo plano (no bloquea la respuesta)."""
+    if gallery_index is None or gallery_watcher is None:
+        raise HTTPException(status_code=400, detail="Índice de galería desactivado")
+    if not gallery_watcher.reconciling:
+        asyncio.create_task(gallery_watcher.reconcile_now())
+    return {"status": "scheduled", "last_reconciled": gallery_index.last_reconciled()}
+
 @app.post("/files/open")
 async def files_open(payload: dict):
     if not OUTPUTS_DIR:
@@ -1695,7 +2093,9 @@ def _find_lora_file_stem(character_name: str) -> str | None:
 #     _log(f"LoRA '{name}' no encontrado; no hay metadata para descargar. Se omite.")
 #     return False
 
-async def _save_image(character_name: str, image_b64: str, override_dir: Optional[str] = None) -> str:
+async def _save_image(character_name: str, image_b64: str, override_dir: Optional[str] = None,
+                      config: Optional[Dict[str, Any]] = None, name_suffix: str = "",
+                      span: Optional[JobSpan] = None, text: Optional[Dict[str, str]] = None) -> str:
     if not OUTPUTS_DIR:
         raise HTTPException(status_code=400, detail="OUTPUTS_DIR no configurado en .env.")
     # Resolver directorio de salida respetando tokens de entorno
@@ -1732,7 +2132,8 @@ async def _save_image(character_name: str, image_b64: str, override_dir: Optiona
         # Si por alguna razÃ³n falla, usar carpeta base del personaje
         date_dir = dest_dir
     ts = datetime.now().strftime("%Y%m%d_%H%M%S")
-    cfg = FACTORY_STATE.get("current_config") or {}
+    # Config del job que generó la imagen (con varios workers, current_config es solo el último)
+    cfg = config if config is not None else (FACTORY_STATE.get("current_config") or {})
     flags = []
     if bool(cfg.get("hires_fix")):
         flags.append("HR")
@@ -1744,10 +2145,10 @@ async def _save_image(character_name: str, image_b64: str, override_dir: Optiona
         suffix += "_" + "_".join(flags)
     if seed_val is not None:
         suffix += f"_{seed_val}"
-    target = date_dir / f"{ts}{suffix}.png"
+    suffix += name_suffix
     try:
-        data = base64.b64decode(image_b64)
-        target.write_bytes(data)
+        # Decode/escritura/fsync fuera del event loop; nombres únicos por creación exclusiva
+        target = await image_writer.save(date_dir, f"{ts}{suffix}", image_b64, span=span, text=text)
     except Exception as e:
         _log(f"Error guardando imagen: {e}")
         raise HTTPException(status_code=500, detail=f"Error guardando imagen: {str(e)}")
@@ -1755,6 +2156,17 @@ async def _save_image(character_name: str, image_b64: str, override_dir: Optiona
         _log(f"[INFO] Imagen guardada en: {str(target)}")
     except Exception:
         pass
+    if gallery_index is not None:
+        try:
+            await asyncio.to_thread(gallery_index.upsert_file, target)
+        except Exception as e:
+            _log(f"[WARN] No se pudo indexar la imagen: {e}")
+    if thumbnail_service is not None:
+        try:
+            thumbnail_service.schedule(str(target.resolve().relative_to(thumbnail_service.outputs_dir)).replace("\\", "/"))
+        except ValueError:
+            # override_dir fuera de OUTPUTS_DIR: no hay URL /files ni thumbnail
+            pass
     return str(target)
 
 # [DEPRECATED] produce_jobs (v1) eliminado. Usar produce_jobs para Producción asÃ­ncrona con aprovisionamiento.
@@ -1773,6 +2185,14 @@ class ResourceMeta(BaseModel):
 class ExecuteRequest(BaseModel):
     jobs: List[PlannerJob]
     resources_meta: Optional[List[ResourceMeta]] = []
+    # Prioridad del envío: nombre de FACTORY_PRIORITIES ("preview" se adelanta a todo) o entero
+    priority: Optional[Union[int, str]] = None
+    # Parte relativa del envío en el reparto justo frente a otros de igual prioridad
+    weight: Optional[float] = None
+    # Reintentos ante fallos transitorios para los jobs de este envío (None = FACTORY_RETRY_MAX_ATTEMPTS - 1)
+    max_retries: Optional[int] = None
+    # Regenerar aunque la caché de resultados ya tenga imágenes para el mismo payload
+    force: Optional[bool] = False
 
 # Nuevo: configuraciÃ³n por personaje (steps/cfg)
 class GroupConfigItem(BaseModel):
@@ -1802,6 +2222,12 @@ class ExecuteV2Request(BaseModel):
     jobs: List[PlannerJob]
     resources_meta: Optional[List[ResourceMeta]] = []
     group_config: Optional[List[GroupConfigItem]] = []
+    # "fifo" (orden de envío) o "grouped" (agrupa por checkpoint/VAE/clip_skip para evitar recargas)
+    scheduling: Optional[str] = None
+    priority: Optional[Union[int, str]] = None
+    weight: Optional[float] = None
+    max_retries: Optional[int] = None
+    force: Optional[bool] = False
 
 # Estado global de FÃ¡brica (consulta vÃ­a /factory/status)
 FACTORY_STATE: Dict[str, Any] = {
@@ -1810,17 +2236,87 @@ FACTORY_STATE: Dict[str, Any] = {
     "total_jobs": 0,
     "current_character": None,
     "last_image_path": None,
-    "logs": [],
     "stop_requested": False,
+    # Último id alcanzado por la parada de emergencia (lo encolado después no se cancela)
+    "stop_max_id": None,
     "canonical_cache": {},
+    "scheduling": os.getenv("FACTORY_SCHEDULING", "fifo").strip().lower(),
+    "sched_claimed": [],
+    "sched_swaps": 0,
+    # Reparto justo entre envíos/personajes (si no, FIFO estricto dentro de cada prioridad)
+    "fair_share": os.getenv("FACTORY_FAIR_SHARE", "1").strip().lower() not in ("0", "false", "no"),
 }
+FACTORY_SCHEDULING_MODES = ("fifo", "grouped")
+# Máximo de jobs (misma config, distinta seed) combinados en una llamada txt2img; 1 desactiva
+FACTORY_MAX_BATCH = max(1, min(10, int(os.getenv("FACTORY_MAX_BATCH", "4") or 4)))
+# Lotes por instancia que pueden estar guardándose mientras se genera el siguiente; 1 = sin solapamiento
+FACTORY_SAVE_PIPELINE = max(1, int(os.getenv("FACTORY_SAVE_PIPELINE", "2") or 2))
+# Prioridades con nombre para los envíos (mayor = antes); también se acepta un entero
+FACTORY_PRIORITIES = {"low": -10, "normal": 0, "high": 10, "preview": 100}
+if FACTORY_STATE["scheduling"] not in FACTORY_SCHEDULING_MODES:
+    FACTORY_STATE["scheduling"] = "fifo"
+# Pesos por personaje (FACTORY_CHARACTER_WEIGHTS="rias=2,akeno=0.5"); en modo agrupado se sigue con el
+# checkpoint cargado mientras su flujo no adelante en más de FACTORY_FAIR_SWITCH_SLACK jobs al más atrasado
+fair_share = FairShare(
+    parse_weights(os.getenv("FACTORY_CHARACTER_WEIGHTS")),
+    switch_slack=float(os.getenv("FACTORY_FAIR_SWITCH_SLACK", "8") or 8),
+    max_wait=float(os.getenv("FACTORY_FAIR_MAX_WAIT", "300") or 300),
+)
+# Caché de resultados: no regenerar jobs cuyo payload txt2img resuelto ya tiene imágenes guardadas
+FACTORY_RESULT_CACHE = os.getenv("FACTORY_RESULT_CACHE", "1").strip().lower() not in ("0", "false", "no")
+# Reintentos de jobs ante fallos transitorios de ReForge (timeouts, 5xx) con backoff exponencial
+retry_policy = RetryPolicy(
+    max_attempts=int(os.getenv("FACTORY_RETRY_MAX_ATTEMPTS", "4") or 4),
+    base_delay=float(os.getenv("FACTORY_RETRY_BASE_DELAY", "5") or 5),
+    max_delay=float(os.getenv("FACTORY_RETRY_MAX_DELAY", "300") or 300),
+)
+
+# Cola persistente de la fábrica (sobrevive a reinicios del backend)
+FACTORY_QUEUE_PATH = os.getenv("FACTORY_QUEUE_PATH") or str(BASE_DIR / "data" / "factory_queue.db")
+job_queue = JobQueue(Path(FACTORY_QUEUE_PATH))
+# Instancias de ReForge (REFORGE_API_BASE_URLS="http://a:7860,http://b:7861"); un worker por instancia
+reforge_pool = ReforgePool.from_env()
+# Tiempos por etapa de la línea de producción (/factory/metrics)
+factory_metrics = FactoryMetrics()
+# Eventos de la fábrica para /factory/events (SSE)
+factory_events = EventBus()
+# Intervalo (s) del sondeo de progreso de ReForge compartido por todos los clientes SSE
+FACTORY_EVENTS_POLL_INTERVAL = max(0.2, float(os.getenv("FACTORY_EVENTS_POLL_INTERVAL", "1") or 1))
+
+# Logs de la fábrica: buffer circular con secuencia (since=<seq>) + archivo rotativo escrito en segundo plano
+factory_logs = LogBuffer(int(os.getenv("FACTORY_LOG_BUFFER", "1000") or 1000))
+factory_log_file: Optional[FactoryLogFile] = None
+try:
+    factory_log_file = FactoryLogFile(
+        Path(os.getenv("FACTORY_LOG_PATH") or (BASE_DIR / "data" / "logs" / "factory.log")),
+        max_bytes=int(os.getenv("FACTORY_LOG_MAX_BYTES", str(5 * 1024 * 1024)) or 5 * 1024 * 1024),
+    )
+except Exception as e:
+    print(f"\033[33m[FactoryLog] No se pudo abrir el archivo de logs ({e}); solo en memoria.\033[0m")
 
 def _log(msg: str) -> None:
     ts = datetime.now().strftime("%H:%M:%S")
-    FACTORY_STATE["logs"].append(f"[{ts}] {msg}")
-    # Limitar tamaÃ±o de log para no crecer indefinidamente
-    if len(FACTORY_STATE["logs"]) > 400:
-        FACTORY_STATE["logs"] = FACTORY_STATE["logs"][-300:]
+    line = f"[{ts}] {msg}"
+    seq = factory_logs.append(line)
+    if factory_log_file is not None:
+        factory_log_file.write(seq, line)
+    factory_events.publish("log", {"seq": seq, "line": line})
+
+@app.on_event("startup")
+async def _startup_factory_log():
+    if factory_log_file is None:
+        return
+    try:
+        # El historial sobrevive reinicios y la secuencia continúa donde quedó
+        factory_logs.load(await asyncio.to_thread(factory_log_file.read_tail, factory_logs.size))
+    except Exception as e:
+        print(f"\033[33m[FactoryLog] No se pudo leer el historial: {e}\033[0m")
+    factory_log_file.start()
+
+@app.on_event("shutdown")
+async def _shutdown_factory_log():
+    if factory_log_file is not None:
+        factory_log_file.stop()
 
 from services.reforge import get_progress
 
@@ -1840,270 +2336,750 @@ def _parse_lora_names(prompt: str) -> List[str]:
     # Captura el nombre del LoRA en <lora:NOMBRE:PESO> o <lora:NOMBRE>
     return re.findall(r"<lora:([^:>]+)(?::[^>]+)?>", prompt)
 
-async def produce_jobs(jobs: List[PlannerJob], group_config: Optional[List[GroupConfigItem]] = None):
+class FactoryStopped(Exception):
+    """Se pidió parada de emergencia mientras el job estaba en curso."""
+
+def _clean_prompt(s: str) -> str:
+    import re
+    parts = [p.strip() for p in (s or "").split(",") if str(p).strip()]
+    seen = set()
+    out = []
+    lora_regex = re.compile(r"^<lora:([^:>]+)(?::([0-9.]+))?>$")
+    lora_pos = {}
+    for i, p in enumerate(parts):
+        m = lora_regex.match(p)
+        if m:
+            name = m.group(1).strip().lower()
+            w = m.group(2)
+            try:
+                wv = float(w) if w is not None else 0.7
+            except Exception:
+                wv = 0.7
+            if name in lora_pos:
+                j = lora_pos[name]
+                prev = out[j]
+                mm = lora_regex.match(prev)
+                pw = mm.group(2)
+                try:
+                    pwv = float(pw) if pw is not None else 0.7
+                except Exception:
+                    pwv = 0.7
+                if wv > pwv:
+                    out[j] = f"<lora:{m.group(1)}:{wv}>"
+            else:
+                lora_pos[name] = len(out)
+                out.append(p)
+        else:
+            key = p.lower()
+            if key not in seen:
+                seen.add(key)
+                out.append(p)
+    return ", ".join(out)
+
+def _txt2img_kwargs(job: PlannerJob, gc: Optional[GroupConfigItem], batch_size: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Argumentos de call_txt2img para un job: prompt con LoRAs extra y limpio, negativo por defecto
+    y overrides del group_config. Lo usan _generate_job y el hash de la caché de resultados.
+    batch_size reemplaza al del group_config (lotes coalescidos: la seed es la del primer job y
+    ReForge numera el resto seed+1, seed+2, ...; claim_batch solo junta seeds consecutivas).
+    """
+    final_prompt = job.prompt
+    extra_loras = gc.extra_loras if gc and isinstance(gc.extra_loras, list) else []
+    if extra_loras:
+        # Formato esperado: "nombre_archivo" (sin extensiÃ³n ni ruta, ya que ReForge lo busca por nombre)
+        # Se asume peso 0.7 por defecto si no se especifica, pero el frontend enviarÃ¡ strings formateados si es necesario.
+        # AquÃ­ el frontend enviarÃ¡ strings como "pixel_art_v2:0.8" o simplemente "pixel_art_v2".
+        # Nosotros envolvemos en <lora:...>
+        lora_blocks = []
+        for l in extra_loras:
+            if ":" in l:
+                lora_blocks.append(f"<lora:{l}>")
+            else:
+                lora_blocks.append(f"<lora:{l}:0.7>")
+        if lora_blocks:
+            final_prompt = f"{final_prompt}, {', '.join(lora_blocks)}"
+
+    raw_neg = getattr(job, "negative_prompt", None)
+    # Overrides avanzados: VAE y Clip Skip (CLIP_stop_at_last_layers)
+    vae_override = (gc.vae if (gc and isinstance(gc.vae, str) and gc.vae.strip() and gc.vae != "Automatic") else None)
+    cs_override = (gc.clip_skip if (gc and isinstance(gc.clip_skip, int) and 1 <= gc.clip_skip <= 12) else None)
+    override_settings = {}
+    if vae_override:
+        override_settings["sd_vae"] = vae_override
+    # Fix para imágenes negras en SDXL/Pony (NaNs en attention)
+    override_settings["upcast_attn"] = True
+    if cs_override is not None:
+        override_settings["CLIP_stop_at_last_layers"] = cs_override
+    # Adetailer script construction (estructura segura)
+    scripts_arr = []
+    if gc and gc.adetailer:
+        model_name = (gc.adetailer_model if (isinstance(getattr(gc, "adetailer_model", None), str) and gc.adetailer_model.strip()) else "face_yolov8n.pt")
+        scripts_arr.append({
+            "name": "ADetailer",
+            "args": [
+                {"ad_model": model_name}
+            ],
+        })
+    bs_override = (gc.batch_size if (gc and isinstance(gc.batch_size, int) and gc.batch_size > 0) else None)
+    return {
+        "prompt": _clean_prompt(final_prompt),
+        "negative_prompt": raw_neg if raw_neg and raw_neg.strip() else DEFAULT_NEGATIVE_PROMPT,
+        "cfg_scale": gc.cfg_scale if gc and isinstance(gc.cfg_scale, (int, float)) else None,
+        "steps": gc.steps if gc and isinstance(gc.steps, int) else None,
+        "enable_hr": gc.hires_fix if (gc and isinstance(gc.hires_fix, bool)) else None,
+        "denoising_strength": float(gc.denoising_strength) if (gc and isinstance(gc.denoising_strength, (int, float))) else None,
+        "hr_second_pass_steps": gc.hires_steps if (gc and isinstance(gc.hires_steps, int)) else None,
+        "batch_size": batch_size if batch_size is not None else bs_override,
+        "hr_upscaler": gc.upscaler if (gc and isinstance(gc.upscaler, str) and gc.upscaler.strip()) else None,
+        "hr_scale": gc.upscale_by if (gc and isinstance(gc.upscale_by, (int, float))) else None,
+        "width": gc.width if gc and isinstance(gc.width, int) else None,
+        "height": gc.height if gc and isinstance(gc.height, int) else None,
+        "alwayson_scripts": scripts_arr or None,
+        "seed": job.seed,
+        "override_settings": override_settings or None,
+    }
+
+async def _generate_job(jobs: List[PlannerJob], gc: Optional[GroupConfigItem], idx: int, total: int,
+                        ep: ReforgeEndpoint, span: Optional[JobSpan] = None) -> tuple:
+    """
+    Genera en la instancia 'ep' de ReForge y lanza el guardado de los resultados.
+    Devuelve (tarea de guardado, hash de caché por job): la tarea resuelve a las rutas guardadas por
+    job y la instancia queda libre para el siguiente txt2img mientras se escriben los archivos.
+    El hash de cada job queda también en sus PNG (chunk 'content_hash').
+    Con varios jobs (mismo payload salvo la seed) se envía una sola llamada con batch_size = len(jobs)
+    y la imagen i del lote se asigna al job i.
+    span acumula los tiempos por etapa (options, checkpoint_switch, txt2img, decode, write, save).
+    """
+    span = span if span is not None else JobSpan([])
+    job = jobs[0]
+    steps_override = gc.steps if gc and isinstance(gc.steps, int) else None
+    cfg_override = gc.cfg_scale if gc and isinstance(gc.cfg_scale, (int, float)) else None
+    # Lote coalescido: una imagen por job en la misma pasada de GPU
+    kw = _txt2img_kwargs(job, gc, batch_size=len(jobs) if len(jobs) > 1 else None)
+    final_prompt = kw["prompt"]
+
+    actual_steps = steps_override if isinstance(steps_override, int) else 28
+    actual_cfg = cfg_override if isinstance(cfg_override, (int, float)) else 7
+    with span.time("options"):
+        options = await get_options(base_url=ep.url)
+    if isinstance(options, dict) and options.get("sd_model_checkpoint"):
+        ep.checkpoint = options["sd_model_checkpoint"]
+    ckpt = (options.get("sd_model_checkpoint") if isinstance(options, dict) else None) or "Desconocido"
+    enable_hr = options.get("enable_hr") if isinstance(options, dict) else False
+    hr_scale = options.get("hr_scale") if isinstance(options, dict) else 1.5
+    hires_str = f"ON (x{hr_scale})" if enable_hr else "OFF"
+    bs = options.get("sd_batch_size") if isinstance(options, dict) else None
+    bs = bs if isinstance(bs, int) else 1
+    # Persistir prompt y configuraciÃ³n actual
+    final_negative = kw["negative_prompt"]
+    FACTORY_STATE["current_prompt"] = final_prompt
+    FACTORY_STATE["current_negative_prompt"] = final_negative
+    # Override de checkpoint por job si se especifica
+    if gc and isinstance(gc.checkpoint, str) and gc.checkpoint.strip():
+        new_ckpt = gc.checkpoint.strip()
+        if ckpt != new_ckpt:
+            try:
+                with span.time("checkpoint_switch"):
+                    await set_active_checkpoint(new_ckpt, base_url=ep.url)
+                ckpt = new_ckpt
+                ep.checkpoint = new_ckpt
+                _log(f"Checkpoint activado para {job.character_name} en {ep.name}: {ckpt}")
+            except Exception as e:
+                _log(f"Error activando checkpoint '{new_ckpt}': {e}")
+    
+    # Obtener opciones actuales para loguear hr_scale real
+    with span.time("options"):
+        options = await get_options(base_url=ep.url)
+    raw_hr_scale = options.get("hr_scale") if isinstance(options, dict) else None
+    
+    # Determinar estado real de Hires Fix para el log
+    hr_override = (gc.hires_fix if (gc and isinstance(gc.hires_fix, bool)) else None)
+    actual_hr = hr_override if hr_override is not None else enable_hr
+    # Si hay override de escala desde el group_config, Ãºsalo para el log
+    hr_scale_override = (gc.upscale_by if (gc and isinstance(gc.upscale_by, (int, float))) else None)
+    def _coerce_scale(val):
+        try:
+            f = float(val)
+            return f if 1.0 <= f <= 4.0 else 2.0
+        except Exception:
+            return 2.0
+    hr_display = _coerce_scale(hr_scale_override) if (actual_hr and hr_scale_override is not None) else (_coerce_scale(raw_hr_scale) if actual_hr else None)
+    hires_str = f"ON (x{hr_display})" if actual_hr else "OFF"
+    try:
+        _log(f"Hires Fix override: enable={actual_hr}, scale_override={hr_scale_override if hr_scale_override is not None else 'â€”'}, raw_scale={raw_hr_scale if raw_hr_scale is not None else 'â€”'}")
+    except Exception:
+        pass
+
+    job_config = {
+        "steps": actual_steps,
+        "cfg": actual_cfg,
+        "batch_size": bs,
+        "hires_fix": actual_hr,
+        "hr_scale": hr_display if actual_hr else None,
+        "seed": job.seed,
+        "checkpoint": ckpt,
+        "adetailer": bool(gc.adetailer) if gc is not None else False,
+        "endpoint": ep.name,
+    }
+    FACTORY_STATE["current_config"] = job_config
+    span.attrs.update({
+        "character": job.character_name, "endpoint": ep.name, "checkpoint": ckpt,
+        "steps": actual_steps, "hires": bool(actual_hr), "hr_scale": job_config["hr_scale"],
+        "size": f"{gc.width if gc and isinstance(gc.width, int) else 832}x{gc.height if gc and isinstance(gc.height, int) else 1216}",
+        "batch": len(jobs) if len(jobs) > 1 else bs, "adetailer": job_config["adetailer"],
+    })
+    seeds_str = ", ".join(str(j.seed) for j in jobs)
+    _log(f"Enviando a ReForge ({ep.name}): [Seed {seeds_str}] Prompt: {final_prompt}")
+    _log(f"Checkpoint: {ckpt}")
+    _log(f"Config: Steps {actual_steps}, CFG {actual_cfg}, Batch Size {bs}, Hires Fix: {hires_str}")
+    # Logs de upscaler/adetailer
+    if gc and isinstance(gc.upscaler, str) and gc.upscaler.strip():
+        _log(f"Upscaler: {gc.upscaler}")
+    if gc and gc.adetailer:
+        _log(f"ADetailer: ON (model={gc.adetailer_model or 'face_yolov8n.pt'})")
+    _log(f"Generando imagen {idx}/{total}...")
+    
+    vae_override = (kw["override_settings"] or {}).get("sd_vae")
+    if vae_override:
+        _log(f"VAE override: {vae_override}")
+    else:
+        _log("VAE: Usando configuración del modelo/global (sin override)")
+
+    t_gen = time.perf_counter()
+    fallback = False
+    try:
+        data = await call_txt2img(**kw, base_url=ep.url)
+    except httpx.HTTPStatusError as e:
+        code = e.response.status_code if getattr(e, "response", None) else None
+        if code == 422 and kw["alwayson_scripts"]:
+            fallback = True
+            # Reintento sin scripts (ADetailer no instalado en la instancia)
+            data = await call_txt2img(**{**kw, "negative_prompt": getattr(job, "negative_prompt", None),
+                                         "width": None, "height": None, "alwayson_scripts": None},
+                                      base_url=ep.url)
+        else:
+            raise
+    finally:
+        span.add("txt2img", time.perf_counter() - t_gen)
+    # Si se solicitÃ³ STOP mientras esperÃ¡bamos respuesta, no continuar.
+    if FACTORY_STATE.get("stop_requested"):
+        _log("Parada detectada tras la respuesta. Omitiendo guardado y cancelando cola.")
+        raise FactoryStopped()
+    images = data.get("images", []) if isinstance(data, dict) else []
+    if not images:
+        raise RuntimeError("ReForge no devolviÃ³ imÃ¡genes.")
+    # Guardado con posible override de ruta basado en env tokens
+    override_dir = (gc.output_path if (gc and isinstance(gc.output_path, str) and gc.output_path.strip()) else None)
+    # Lote coalescido: una imagen por job; job suelto: las que pidió su group_config
+    plan = _plan_txt2img_outputs(data, jobs, 1 if len(jobs) > 1 else (kw["batch_size"] or 1))
+    # Misma resolución de checkpoint que la consulta de la caché. Sin hash si el cambio de checkpoint
+    # falló (imágenes de otro modelo) o si se reintentó sin scripts (el payload enviado fue otro)
+    cache_ckpt = _cache_checkpoint(gc, ckpt)
+    hashes = [_job_content_hash(j, gc, cache_ckpt) if (cache_ckpt == ckpt and not fallback) else None for j in jobs]
+    return asyncio.create_task(_persist_outputs(jobs, plan, override_dir, job_config, span, hashes)), hashes
+
+async def _persist_outputs(jobs: List[PlannerJob], plan: List[tuple], override_dir: Optional[str],
+                           job_config: Dict[str, Any], span: Optional[JobSpan] = None,
+                           hashes: Optional[List[Optional[str]]] = None) -> List[List[str]]:
+    """Guarda en paralelo las imágenes de una respuesta txt2img. Devuelve las rutas por job.
+    hashes (uno por job) se graba en cada imagen del job como chunk 'content_hash'."""
+    t_save = time.perf_counter()
+    hashes = hashes or [None] * len(jobs)
+    saved = await asyncio.gather(*(
+        _save_image(jobs[i if i is not None else 0].character_name, b64, override_dir=override_dir,
+                    config={**job_config, "seed": seed}, name_suffix=suffix, span=span,
+                    text={"content_hash": hashes[i]} if i is not None and hashes[i] else None)
+        for i, b64, seed, suffix in plan
+    ))
+    if span is not None:
+        span.add("save", time.perf_counter() - t_save)
+    results: List[List[str]] = [[] for _ in jobs]
+    for (i, b64, seed, suffix), path in zip(plan, saved):
+        targets = range(len(jobs)) if i is None else [i]
+        for t in targets:
+            results[t].append(path)
+        if i is not None:
+            FACTORY_STATE["last_image_path"] = path
+            FACTORY_STATE["last_image_b64"] = f"data:image/png;base64,{b64}"
+        try:
+            rel = Path(path).resolve().relative_to(Path(OUTPUTS_DIR).resolve()).as_posix()
+        except ValueError:
+            rel = None  # override_dir fuera de OUTPUTS_DIR: sin URL /files
+        factory_events.publish("image_saved", {
+            "path": path, "rel": rel, "character": jobs[i if i is not None else 0].character_name,
+            "seed": seed, "grid": i is None, "endpoint": job_config.get("endpoint"),
+        })
+    _log(f"[INFO] {len(saved)} imagen(es) guardada(s) ({sum(1 for p in plan if p[0] is None)} grilla).")
+    return results
+
+def _plan_txt2img_outputs(data: Dict[str, Any], jobs: List[PlannerJob], per_job: int) -> List[tuple]:
+    """
+    Reparte las imágenes de una respuesta txt2img entre los jobs del lote.
+    Devuelve [(índice de job o None para la grilla, b64, seed, sufijo de nombre)].
+    La grilla (si ReForge la devuelve) va primero: info.index_of_first_image indica cuántas hay.
+    Los archivos se nombran con la seed del job (no con info.all_seeds, que con seed -1 es la
+    aleatoria de ReForge): así el nombre sigue identificando al job que lo pidió.
+    """
+    images = data.get("images", []) if isinstance(data, dict) else []
+    info: Dict[str, Any] = {}
+    try:
+        raw = data.get("info")
+        info = json.loads(raw) if isinstance(raw, str) else (raw if isinstance(raw, dict) else {})
+    except (ValueError, TypeError):
+        info = {}
+    expected = max(1, per_job) * len(jobs)
+    first = info.get("index_of_first_image")
+    if not isinstance(first, int) or not 0 <= first < len(images):
+        first = max(0, len(images) - expected)
+    plan: List[tuple] = []
+    for g, b64 in enumerate(images[:first]):
+        plan.append((None, b64, jobs[0].seed, "_grid" if first == 1 else f"_grid{g}"))
+    singles = images[first:]
+    step = max(1, len(singles) // len(jobs)) if len(jobs) > 1 else len(singles)
+    for n, b64 in enumerate(singles):
+        i = min(n // step, len(jobs) - 1) if step else 0
+        plan.append((i, b64, jobs[i].seed, ""))
+    return plan
+
+def _job_signature(gc: Optional[GroupConfigItem]) -> tuple:
+    """(checkpoint, firma) del job: lo que obliga a recargar modelos entre jobs (checkpoint, VAE, clip_skip).
+    Mismo criterio que los overrides de _generate_job."""
+    ckpt = gc.checkpoint.strip() if (gc and isinstance(gc.checkpoint, str) and gc.checkpoint.strip()) else None
+    vae = gc.vae if (gc and isinstance(gc.vae, str) and gc.vae.strip() and gc.vae != "Automatic") else None
+    cs = gc.clip_skip if (gc and isinstance(gc.clip_skip, int) and 1 <= gc.clip_skip <= 12) else None
+    return ckpt, json.dumps([ckpt or "", vae or "", cs])
+
+def _job_batch_key(job: PlannerJob, gc: Optional[GroupConfigItem]) -> Optional[str]:
+    """Clave compartida por jobs cuyo payload solo difiere en la seed (coalescibles en un lote).
+    Los jobs que ya piden varias imágenes (batch_size > 1) no se combinan."""
+    if gc and isinstance(gc.batch_size, int) and gc.batch_size > 1:
+        return None
+    base = job.dict()
+    base.pop("seed", None)
+    raw = json.dumps([base, gc.dict() if gc is not None else None], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+def _resolve_priority(value: Optional[Union[int, str]]) -> int:
+    if value is None or value == "":
+        return 0
+    if isinstance(value, int):
+        return value
+    key = str(value).strip().lower()
+    if key in FACTORY_PRIORITIES:
+        return FACTORY_PRIORITIES[key]
+    try:
+        return int(key)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"priority debe ser un entero o uno de: {', '.join(FACTORY_PRIORITIES)}")
+
+def _resolve_weight(value: Optional[float]) -> float:
+    if value is None:
+        return 1.0
+    if not value > 0:
+        raise HTTPException(status_code=400, detail="weight debe ser mayor que 0")
+    return float(value)
+
+def _resolve_max_attempts(max_retries: Optional[int]) -> Optional[int]:
+    if max_retries is None:
+        return None
+    if max_retries < 0:
+        raise HTTPException(status_code=400, detail="max_retries no puede ser negativo")
+    return int(max_retries) + 1
+
+def _enqueue_jobs(jobs: List[PlannerJob], group_config: Optional[List[GroupConfigItem]] = None,
+                  priority: int = 0, weight: float = 1.0, max_attempts: Optional[int] = None,
+                  force: bool = False) -> tuple:
+    """Persiste los jobs en la cola como un envío (cada uno con su GroupConfigItem). Devuelve (batch_id, ids)."""
+    cfg_map: Dict[str, GroupConfigItem] = {}
+    for gc in (group_config or []):
+        name = (gc.character_name or "").strip()
+        if name:
+            cfg_map[name] = gc
+    items = []
+    for job in jobs:
+        gc = cfg_map.get(job.character_name)
+        ckpt, signature = _job_signature(gc)
+        items.append({"job": job.dict(), "config": gc.dict() if gc is not None else None,
+                      "checkpoint": ckpt, "signature": signature, "batch_key": _job_batch_key(job, gc)})
+    return job_queue.enqueue(items, priority, weight, max_attempts, force)
+
+def _scheduling_report() -> Dict[str, Any]:
+    """
+    Cambios de firma (checkpoint/VAE/clip_skip) de la corrida actual frente a los que habría
+    procesando los mismos jobs en orden de envío con una sola instancia.
+    """
+    claimed = sorted(FACTORY_STATE.get("sched_claimed") or [])
+    fifo_swaps = sum(1 for a, b in zip(claimed, claimed[1:]) if a[1] != b[1])
+    swaps = int(FACTORY_STATE.get("sched_swaps", 0))
+    return {
+        "mode": FACTORY_STATE.get("scheduling"),
+        "swaps": swaps,
+        "swaps_fifo": fifo_swaps,
+        "swaps_saved": max(0, fifo_swaps - swaps),
+        "fair_share": bool(FACTORY_STATE.get("fair_share")),
+    }
+
+async def _factory_worker():
+    """Consume la cola persistente con un worker por instancia de ReForge hasta vaciarla."""
+    counts = await asyncio.to_thread(job_queue.counts)
     FACTORY_STATE.update({
         "is_active": True,
         "current_job_index": 0,
-        "total_jobs": len(jobs),
+        "total_jobs": counts["pending"],
         "current_character": None,
         "last_image_path": FACTORY_STATE.get("last_image_path"),
         "stop_requested": False,
+        "stop_max_id": None,
+        "dispatch_paused": False,
         "current_prompt": None,
         "current_negative_prompt": None,
         "current_config": None,
+        "sched_claimed": [],
+        "sched_swaps": 0,
     })
-    cfg_map: Dict[str, GroupConfigItem] = {}
-    for gc in (group_config or []):
-        name = (gc.character_name or "").strip()
-        if name:
-            cfg_map[name] = gc
-    _log(f"Producción iniciada: {len(jobs)} trabajos.")
-    for idx, job in enumerate(jobs, start=1):
-        if FACTORY_STATE.get("stop_requested"):
-            _log("Parada de emergencia solicitada. Deteniendo cola.")
-            break
-        FACTORY_STATE["current_job_index"] = idx
-        FACTORY_STATE["current_character"] = job.character_name
-        _log(f"Procesando {idx}/{len(jobs)}: {job.character_name}")
-        # loras = _parse_lora_names(job.prompt)
-        # for name in loras:
-        #     if not _lora_exists(name):
-        #         _log(f"LoRA faltante: {name}. Intentando descarga...")
-        #         ok = await _maybe_download_lora(name)
-        #         if not ok:
-        #             _log(f"Descarga omitida: no hay metadata disponible para '{name}'.")
-        gc = cfg_map.get(job.character_name)
-        steps_override = gc.steps if gc and isinstance(gc.steps, int) else None
-        cfg_override = gc.cfg_scale if gc and isinstance(gc.cfg_scale, (int, float)) else None
-        
-        final_prompt = job.prompt
-        extra_loras = gc.extra_loras if gc and isinstance(gc.extra_loras, list) else []
-        if extra_loras:
-            # Formato esperado: "nombre_archivo" (sin extensiÃ³n ni ruta, ya que ReForge lo busca por nombre)
-            # Se asume peso 0.7 por defecto si no se especifica, pero el frontend enviarÃ¡ strings formateados si es necesario.
-            # AquÃ­ el frontend enviarÃ¡ strings como "pixel_art_v2:0.8" o simplemente "pixel_art_v2".
-            # Nosotros envolvemos en <lora:...>
-            lora_blocks = []
-            for l in extra_loras:
-                if ":" in l:
-                    lora_blocks.append(f"<lora:{l}>")
-                else:
-                    lora_blocks.append(f"<lora:{l}:0.7>")
-            if lora_blocks:
-                final_prompt = f"{final_prompt}, {', '.join(lora_blocks)}"
-
-        def _clean_prompt(s: str) -> str:
-            import re
-            parts = [p.strip() for p in (s or "").split(",") if str(p).strip()]
-            seen = set()
-            out = []
-            lora_regex = re.compile(r"^<lora:([^:>]+)(?::([0-9.]+))?>$")
-            lora_pos = {}
-            for i, p in enumerate(parts):
-                m = lora_regex.match(p)
-                if m:
-                    name = m.group(1).strip().lower()
-                    w = m.group(2)
-                    try:
-                        wv = float(w) if w is not None else 0.7
-                    except Exception:
-                        wv = 0.7
-                    if name in lora_pos:
-                        j = lora_pos[name]
-                        prev = out[j]
-                        mm = lora_regex.match(prev)
-                        pw = mm.group(2)
-                        try:
-                            pwv = float(pw) if pw is not None else 0.7
-                        except Exception:
-                            pwv = 0.7
-                        if wv > pwv:
-                            out[j] = f"<lora:{m.group(1)}:{wv}>"
-                    else:
-                        lora_pos[name] = len(out)
-                        out.append(p)
-                else:
-                    key = p.lower()
-                    if key not in seen:
-                        seen.add(key)
-                        out.append(p)
-            return ", ".join(out)
-
-        final_prompt = _clean_prompt(final_prompt)
-
+    _log(f"Producción iniciada: {counts['pending']} trabajos en {len(reforge_pool.endpoints)} instancia(s) de ReForge.")
+    try:
+        await reforge_pool.check_all()
+        while True:
+            _factory_wakeup.clear()
+            await asyncio.gather(*(_endpoint_worker(ep) for ep in reforge_pool.endpoints))
+            # Envíos que llegaron mientras los workers terminaban: otra vuelta sin cerrar la corrida
+            if FACTORY_STATE.get("stop_requested") or not _factory_wakeup.is_set():
+                break
+    finally:
+        FACTORY_STATE["is_active"] = False
+        # Sin lotes en curso no queda nada que descartar
+        _cancelled_batches.clear()
+        if FACTORY_STATE.get("scheduling") == "grouped":
+            report = _scheduling_report()
+            _log(f"Planificación agrupada: {report['swaps']} cambios de modelo (FIFO: {report['swaps_fifo']}, ahorrados: {report['swaps_saved']}).")
+        _log("Producción finalizada.")
         try:
-            actual_steps = steps_override if isinstance(steps_override, int) else 28
-            actual_cfg = cfg_override if isinstance(cfg_override, (int, float)) else 7
-            options = await get_options()
-            ckpt = (options.get("sd_model_checkpoint") if isinstance(options, dict) else None) or "Desconocido"
-            enable_hr = options.get("enable_hr") if isinstance(options, dict) else False
-            hr_scale = options.get("hr_scale") if isinstance(options, dict) else 1.5
-            hires_str = f"ON (x{hr_scale})" if enable_hr else "OFF"
-            bs = options.get("sd_batch_size") if isinstance(options, dict) else None
-            bs = bs if isinstance(bs, int) else 1
-            # Persistir prompt y configuraciÃ³n actual
-            raw_neg = getattr(job, "negative_prompt", None)
-            final_negative = raw_neg if raw_neg and raw_neg.strip() else DEFAULT_NEGATIVE_PROMPT
-            FACTORY_STATE["current_prompt"] = final_prompt
-            FACTORY_STATE["current_negative_prompt"] = final_negative
-            # Override de checkpoint por job si se especifica
-            if gc and isinstance(gc.checkpoint, str) and gc.checkpoint.strip():
-                new_ckpt = gc.checkpoint.strip()
-                if ckpt != new_ckpt:
-                    try:
-                        await set_active_checkpoint(new_ckpt)
-                        ckpt = new_ckpt
-                        _log(f"Checkpoint activado para {job.character_name}: {ckpt}")
-                    except Exception as e:
-                        _log(f"Error activando checkpoint '{new_ckpt}': {e}")
-            
-            # Obtener opciones actuales para loguear hr_scale real
-            options = await get_options()
-            raw_hr_scale = options.get("hr_scale") if isinstance(options, dict) else None
-            
-            # Determinar estado real de Hires Fix para el log
-            hr_override = (gc.hires_fix if (gc and isinstance(gc.hires_fix, bool)) else None)
-            actual_hr = hr_override if hr_override is not None else enable_hr
-            # Si hay override de escala desde el group_config, Ãºsalo para el log
-            hr_scale_override = (gc.upscale_by if (gc and isinstance(gc.upscale_by, (int, float))) else None)
-            def _coerce_scale(val):
-                try:
-                    f = float(val)
-                    return f if 1.0 <= f <= 4.0 else 2.0
-                except Exception:
-                    return 2.0
-            hr_display = _coerce_scale(hr_scale_override) if (actual_hr and hr_scale_override is not None) else (_coerce_scale(raw_hr_scale) if actual_hr else None)
-            hires_str = f"ON (x{hr_display})" if actual_hr else "OFF"
-            try:
-                _log(f"Hires Fix override: enable={actual_hr}, scale_override={hr_scale_override if hr_scale_override is not None else 'â€”'}, raw_scale={raw_hr_scale if raw_hr_scale is not None else 'â€”'}")
-            except Exception:
-                pass
-
-            FACTORY_STATE["current_config"] = {
-                "steps": actual_steps,
-                "cfg": actual_cfg,
-                "batch_size": bs,
-                "hires_fix": actual_hr,
-                "hr_scale": hr_display if actual_hr else None,
-                "seed": job.seed,
-                "checkpoint": ckpt,
-                "adetailer": bool(gc.adetailer) if gc is not None else False,
-            }
-            _log(f"Enviando a ReForge: [Seed {job.seed}] Prompt: {final_prompt}")
-            _log(f"Checkpoint: {ckpt}")
-            _log(f"Config: Steps {actual_steps}, CFG {actual_cfg}, Batch Size {bs}, Hires Fix: {hires_str}")
-            # Logs de upscaler/adetailer
-            if gc and isinstance(gc.upscaler, str) and gc.upscaler.strip():
-                _log(f"Upscaler: {gc.upscaler}")
-            if gc and gc.adetailer:
-                _log(f"ADetailer: ON (model={gc.adetailer_model or 'face_yolov8n.pt'})")
-            _log(f"Generando imagen {idx}/{len(jobs)}...")
-            
-            # Overrides de Hires Fix y Denoising segÃºn group_config
-            # Hires Fix override
-            hr_override = gc.hires_fix if (gc and isinstance(gc.hires_fix, bool)) else None
-            dn_override = (float(gc.denoising_strength) if (gc and isinstance(gc.denoising_strength, (int, float))) else None)
-            hr_steps_override = (gc.hires_steps if (gc and isinstance(gc.hires_steps, int)) else None)
-            
-            # Batch Size override
-            bs_override = (gc.batch_size if (gc and isinstance(gc.batch_size, int) and gc.batch_size > 0) else None)
-            
-            # Adetailer script construction (estructura segura)
-            scripts_arr = []
-            if gc and gc.adetailer:
-                model_name = (gc.adetailer_model if (isinstance(getattr(gc, "adetailer_model", None), str) and gc.adetailer_model.strip()) else "face_yolov8n.pt")
-                scripts_arr.append({
-                    "name": "ADetailer",
-                    "args": [
-                        {"ad_model": model_name}
-                    ],
-                })
+            counts = await asyncio.to_thread(job_queue.counts)
+        except Exception:
+            counts = None
+        factory_events.publish("queue_finished", {"queue": counts})
 
-            # Upscaler override (si existe en group config o se pasa como extra)
-            # Nota: call_txt2img debe soportar hr_upscaler si queremos cambiarlo dinÃ¡micamente.
-            # Por ahora solo logueamos, la implementaciÃ³n completa requerirÃ­a actualizar call_txt2img.
-            
-            # Overrides avanzados: VAE y Clip Skip (CLIP_stop_at_last_layers)
-            vae_override = (gc.vae if (gc and isinstance(gc.vae, str) and gc.vae.strip() and gc.vae != "Automatic") else None)
-            cs_override = (gc.clip_skip if (gc and isinstance(gc.clip_skip, int) and 1 <= gc.clip_skip <= 12) else None)
-            override_settings = {}
-            if vae_override:
-                override_settings["sd_vae"] = vae_override
-                _log(f"VAE override: {vae_override}")
+async def _endpoint_worker(ep: ReforgeEndpoint):
+    """
+    Toma jobs de la cola compartida y los genera en una instancia concreta.
+    El guardado de cada lote corre en segundo plano (hasta FACTORY_SAVE_PIPELINE lotes a la vez)
+    y el job se completa en la cola cuando sus archivos están escritos.
+    """
+    inflight: set = set()
+    try:
+        while True:
+            if len(inflight) >= FACTORY_SAVE_PIPELINE:
+                _, inflight = await asyncio.wait(inflight, return_when=asyncio.FIRST_COMPLETED)
+            if FACTORY_STATE.get("stop_requested"):
+                if await asyncio.to_thread(job_queue.cancel_pending, "Parada de emergencia", FACTORY_STATE.get("stop_max_id")):
+                    _log("Parada de emergencia solicitada. Deteniendo cola.")
+                return
+            if not ep.healthy:
+                # Instancia caída: no despacha; sondea con backoff mientras quede trabajo pendiente
+                if not reforge_pool.any_healthy() and not FACTORY_STATE.get("dispatch_paused"):
+                    FACTORY_STATE["dispatch_paused"] = True
+                    _log("ReForge no responde en ninguna instancia: despacho en pausa, los jobs esperan en la cola.")
+                    factory_events.publish("dispatch_paused", {"endpoints": [o.name for o in reforge_pool.endpoints]})
+                if (await asyncio.to_thread(job_queue.counts))["pending"] == 0:
+                    return
+                over = max(0, ep.consecutive_failures - MAX_CONSECUTIVE_FAILURES)
+                await asyncio.sleep(reforge_pool.retry_interval * 2 ** min(over, 2))
+                if await reforge_pool.check(ep):
+                    _log(f"Instancia {ep.name} disponible nuevamente.")
+                    if FACTORY_STATE.get("dispatch_paused"):
+                        FACTORY_STATE["dispatch_paused"] = False
+                        factory_events.publish("dispatch_resumed", {"endpoint": ep.name})
+                continue
+            grouped = FACTORY_STATE.get("scheduling") == "grouped"
+            # Agrupado: seguir con la firma de esta instancia; si no quedan, con su checkpoint cargado.
+            # Jobs que solo difieren en la seed salen juntos (hasta FACTORY_MAX_BATCH) en una sola llamada.
+            rows = await asyncio.to_thread(
+                job_queue.claim_batch, ep.name,
+                ep.signature if grouped else None,
+                ep.checkpoint if grouped else None,
+                FACTORY_MAX_BATCH,
+                fair_share if FACTORY_STATE.get("fair_share") else None,
+            )
+            if not rows:
+                # Nada listo: esperar si otra instancia sigue trabajando (puede llegar más) o si hay
+                # jobs en backoff; si no, la cola está vacía
+                ready_at = await asyncio.to_thread(job_queue.next_ready_at)
+                if ready_at is not None or any(o.current_job_id is not None for o in reforge_pool.endpoints if o is not ep):
+                    wait = 0.5 if ready_at is None else ready_at - time.time()
+                    await asyncio.sleep(min(max(wait, 0.05), 0.5))
+                    continue
+                return
+            claimed = [(r["id"], r.get("signature")) for r in rows]
+            FACTORY_STATE["sched_claimed"].extend(claimed)
+            if ep.signature is not None and rows[0].get("signature") != ep.signature:
+                FACTORY_STATE["sched_swaps"] = int(FACTORY_STATE.get("sched_swaps", 0)) + 1
+            ep.signature = rows[0].get("signature")
+            ids = [r["id"] for r in rows]
+            try:
+                jobs = [PlannerJob(**r["job"]) for r in rows]
+                gc = GroupConfigItem(**rows[0]["config"]) if rows[0].get("config") else None
+            except Exception as e:
+                _log(f"Job #{ids[0]} inválido en la cola: {e}")
+                for job_id in ids:
+                    await asyncio.to_thread(job_queue.fail, job_id, f"Job inválido: {e}")
+                continue
+            if FACTORY_RESULT_CACHE:
+                rows, jobs = await _link_cached_results(ep, rows, jobs, gc)
+                if not rows:
+                    continue
+                ids = [r["id"] for r in rows]
+            idx = int(FACTORY_STATE.get("current_job_index", 0)) + 1
+            last_idx = idx + len(rows) - 1
+            total = max(int(FACTORY_STATE.get("total_jobs", 0)), last_idx)
+            job = jobs[0]
+            span = JobSpan(ids)
+            # Espera en cola del job más antiguo del lote
+            span.add("queue_wait", max((r.get("started_at") or 0) - (r.get("created_at") or 0) for r in rows))
+            FACTORY_STATE["current_job_index"] = last_idx
+            FACTORY_STATE["total_jobs"] = total
+            FACTORY_STATE["current_character"] = job.character_name
+            ep.current_job_id, ep.current_character = ids[0], job.character_name
+            if len(jobs) > 1:
+                _log(f"Procesando {idx}-{last_idx}/{total}: {job.character_name} [{ep.name}] (lote de {len(jobs)} seeds)")
             else:
-                _log("VAE: Usando configuración del modelo/global (sin override)")
-            
-            # Fix para imágenes negras en SDXL/Pony (NaNs en attention)
-            override_settings["upcast_attn"] = True
-            
-            if cs_override is not None:
-                override_settings["CLIP_stop_at_last_layers"] = cs_override
+                _log(f"Procesando {idx}/{total}: {job.character_name} [{ep.name}]")
+            factory_events.publish("job_started", {
+                "job_ids": ids, "character": job.character_name, "endpoint": ep.name,
+                "index": idx, "last_index": last_idx, "total": total,
+            })
+            try:
+                save_task, hashes = await _generate_job(jobs, gc, idx, total, ep, span)
+                reforge_pool.mark_success(ep)
+                if rows[0]["batch_id"] in _cancelled_batches:
+                    # El envío se canceló mientras se generaba: no guardar
+                    save_task.cancel()
+                    raise FactoryStopped()
+                inflight.add(asyncio.create_task(_finish_saved(ep, ids, save_task, span, hashes)))
+            except FactoryStopped:
+                for job_id in ids:
+                    await asyncio.to_thread(job_queue.fail, job_id, "Parada de emergencia", "cancelled")
+                factory_metrics.finish(span, 0, "cancelled")
+            except Exception as e:
+                await _handle_job_error(ep, rows, claimed, span, e)
+            finally:
+                ep.current_job_id, ep.current_character = None, None
+                await _forget_cancelled(rows[0]["batch_id"])
+    finally:
+        if inflight:
+            await asyncio.gather(*inflight, return_exceptions=True)
+
+def _cache_checkpoint(gc: Optional[GroupConfigItem], loaded: Optional[str]) -> Optional[str]:
+    """Checkpoint con el que se calcula el hash de la caché: el que pide el group_config o, si no
+    pide ninguno, el cargado en la instancia. Lo usan la consulta y el guardado por igual."""
+    if gc and isinstance(gc.checkpoint, str) and gc.checkpoint.strip():
+        return gc.checkpoint.strip()
+    return loaded
+
+def _job_content_hash(job: PlannerJob, gc: Optional[GroupConfigItem], checkpoint: Optional[str]) -> Optional[str]:
+    """
+    Hash del payload txt2img que se envía a ReForge para el job (seed incluida) más el checkpoint.
+    En un lote coalescido se usa el payload equivalente del job suelto: la imagen k del lote es la
+    de seed + k, igual que pedirla sola. None si el checkpoint no se conoce o la seed es aleatoria
+    (< 0): sin identidad estable no se cachea.
+    """
+    if not checkpoint or checkpoint == "Desconocido" or job.seed < 0:
+        return None
+    payload = resolve_txt2img_payload(**_txt2img_kwargs(job, gc))
+    raw = json.dumps({"payload": payload, "checkpoint": checkpoint}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
 
-            # Upscaler y escala de Hires (si viene del group_config)
-            hr_upscaler = gc.upscaler if (gc and isinstance(gc.upscaler, str) and gc.upscaler.strip()) else None
-            hr_scale_override = gc.upscale_by if (gc and isinstance(gc.upscale_by, (int, float))) else None
+def _find_cached_result(content_hash: str) -> Optional[Dict[str, Any]]:
+    """
+    Job hecho más reciente con ese hash cuyas imágenes siguen en disco. Si la cola no lo tiene
+    (base de la cola nueva, jobs purgados) se busca en el índice de la galería por el chunk
+    'content_hash' de las imágenes: el resultado trae id None.
+    """
+    for row in job_queue.results_for(content_hash):
+        paths = row.get("result_paths") or []
+        if paths and all(Path(p).exists() for p in paths):
+            return row
+    if gallery_index is not None:
+        paths = [p for p in gallery_index.paths_for_content_hash(content_hash) if Path(p).exists()]
+        if paths:
+            return {"id": None, "result_paths": paths}
+    return None
 
-            try:
-                data = await call_txt2img(
-                    prompt=final_prompt, 
-                    negative_prompt=final_negative,
-                    cfg_scale=cfg_override, 
-                    steps=steps_override, 
-                    enable_hr=hr_override, 
-                    denoising_strength=dn_override, 
-                    hr_second_pass_steps=hr_steps_override,
-                    batch_size=bs_override,
-                    hr_upscaler=hr_upscaler,
-                    hr_scale=hr_scale_override,
-                    width=(gc.width if gc and isinstance(gc.width, int) else None),
-                    height=(gc.height if gc and isinstance(gc.height, int) else None),
-                    alwayson_scripts=scripts_arr if scripts_arr else None,
-                    override_settings=override_settings or None
-                )
-            except httpx.HTTPStatusError as e:
-                code = e.response.status_code if getattr(e, "response", None) else None
-                if code == 422 and scripts_arr:
-                    data = await call_txt2img(
-                        prompt=final_prompt,
-                        negative_prompt=getattr(job, "negative_prompt", None),
-                        cfg_scale=cfg_override,
-                        steps=steps_override,
-                        enable_hr=hr_override,
-                        denoising_strength=dn_override,
-                        hr_second_pass_steps=hr_steps_override,
-                        batch_size=bs_override,
-                        hr_upscaler=hr_upscaler,
-                        hr_scale=hr_scale_override,
-                        alwayson_scripts=None,
-                        override_settings=override_settings or None
-                    )
-                else:
-                    raise
-            # Si se solicitÃ³ STOP mientras esperÃ¡bamos respuesta, no continuar.
-            if FACTORY_STATE.get("stop_requested"):
-                _log("Parada detectada tras la respuesta. Omitiendo guardado y cancelando cola.")
-                break
-            images = data.get("images", []) if isinstance(data, dict) else []
-            if not images:
-                _log("ReForge no devolviÃ³ imÃ¡genes.")
-                continue
-            last_b64 = images[0]
-            # Guardado con posible override de ruta basado en env tokens
-            override_dir = (gc.output_path if (gc and isinstance(gc.output_path, str) and gc.output_path.strip()) else None)
-            path = await _save_image(job.character_name, last_b64, override_dir=override_dir)
-            FACTORY_STATE["last_image_path"] = path
-            FACTORY_STATE["last_image_b64"] = f"data:image/png;base64,{last_b64}"
-            _log(f"[INFO] Imagen guardada en: {path}")
-            _log(f"[INFO] Imagen guardada en: {path}")
-        except httpx.HTTPStatusError as e:
-            err_msg = e.response.text if getattr(e, "response", None) else str(e)
-            _log(f"Error HTTP ReForge ({e.response.status_code}): {err_msg}")
-            continue
-        except Exception as e:
-            _log(f"Error en generación: {e}")
+async def _link_cached_results(ep: ReforgeEndpoint, rows: List[Dict[str, Any]], jobs: List[PlannerJob],
+                               gc: Optional[GroupConfigItem]) -> tuple:
+    """
+    Consulta la caché de resultados antes de despachar: los jobs cuyo payload ya se generó se cierran
+    enlazando las imágenes existentes (result_paths + cached_from) sin pasar por ReForge.
+    Los envíos con force=True siempre se regeneran. Devuelve (rows, jobs) que sí hay que generar.
+    """
+    loaded = ep.checkpoint
+    if _cache_checkpoint(gc, None) is None:
+        # Sin checkpoint pedido vale el cargado: consultarlo (get_options está cacheado) en vez de
+        # depender de ep.checkpoint, que no se conoce hasta el primer txt2img de la instancia
+        options = await get_options(base_url=ep.url)
+        if isinstance(options, dict) and options.get("sd_model_checkpoint"):
+            loaded = ep.checkpoint = options["sd_model_checkpoint"]
+    ckpt = _cache_checkpoint(gc, loaded)
+    keep_rows, keep_jobs = [], []
+    for row, job in zip(rows, jobs):
+        content_hash = None if row.get("force") else _job_content_hash(job, gc, ckpt)
+        hit = await asyncio.to_thread(_find_cached_result, content_hash) if content_hash else None
+        if hit is None:
+            keep_rows.append(row)
+            keep_jobs.append(job)
             continue
-    FACTORY_STATE["is_active"] = False
-    _log("Producción finalizada.")
+        paths = hit["result_paths"]
+        await asyncio.to_thread(job_queue.complete, row["id"], paths, content_hash, hit["id"])
+        FACTORY_STATE["current_job_index"] = int(FACTORY_STATE.get("current_job_index", 0)) + 1
+        factory_metrics.jobs_total["cached"] = factory_metrics.jobs_total.get("cached", 0) + 1
+        origin = f"en el job #{hit['id']}" if hit["id"] is not None else "en la galería"
+        _log(f"Job #{row['id']} ({job.character_name}, seed {job.seed}) ya generado {origin}: "
+             f"se enlazan {len(paths)} imagen(es) sin regenerar.")
+        factory_events.publish("job_finished", {"job_id": row["id"], "status": "done", "endpoint": ep.name,
+                                                "paths": paths, "cached_from": hit["id"]})
+    # Un hit en medio de un lote coalescido deja un hueco de seeds: el resto vuelve a la cola
+    run = 1
+    while run < len(keep_jobs) and (keep_jobs[0].seed < 0 or keep_jobs[run].seed == keep_jobs[0].seed + run):
+        run += 1
+    for row in keep_rows[run:]:
+        await asyncio.to_thread(job_queue.release, row["id"], None)
+    return keep_rows[:run], keep_jobs[:run]
+
+async def _handle_job_error(ep: ReforgeEndpoint, rows: List[Dict[str, Any]], claimed: list, span: JobSpan,
+                            error: Exception):
+    """
+    Aplica la RetryPolicy a un lote que falló en ReForge:
+    - instancia caída (conexión rechazada): los jobs vuelven a la cola sin gastar intento y la
+      instancia deja de despachar hasta que responda;
+    - fallo transitorio (timeout, 5xx): vuelven con backoff exponencial mientras les queden intentos;
+    - fallo permanente (422 u otro 4xx, job inválido) o sin intentos: quedan 'failed' (ver /factory/failed).
+    """
+    ids = [r["id"] for r in rows]
+    kind = retry_policy.classify(error)
+    if isinstance(error, httpx.HTTPStatusError):
+        err_msg = f"HTTP {error.response.status_code}: {error.response.text}"
+    else:
+        err_msg = str(error) or error.__class__.__name__
+    if kind != "permanent":
+        # Lo que se vuelve a intentar no cuenta en el informe de planificación hasta que se tome de nuevo
+        for c in claimed:
+            if c in FACTORY_STATE["sched_claimed"]:
+                FACTORY_STATE["sched_claimed"].remove(c)
+    if kind == "down":
+        reforge_pool.mark_failure(ep, error)
+        await reforge_pool.check(ep)
+        _log(f"Instancia {ep.name} sin respuesta ({error.__class__.__name__}); {len(ids)} job(s) devueltos a la cola.")
+        for job_id in ids:
+            await asyncio.to_thread(job_queue.release, job_id, f"{ep.name}: {error.__class__.__name__}")
+        factory_metrics.finish(span, 0, "released")
+        return
+    if kind == "transient":
+        reforge_pool.mark_failure(ep, error)
+    failed = 0
+    for r in rows:
+        attempts = int(r.get("attempts") or 1)
+        if kind == "transient" and retry_policy.should_retry(attempts, r.get("max_attempts")):
+            delay = retry_policy.delay(attempts)
+            await asyncio.to_thread(job_queue.retry, r["id"], err_msg, delay)
+            factory_events.publish("job_retry", {"job_id": r["id"], "attempt": attempts, "delay": delay,
+                                                 "endpoint": ep.name, "error": err_msg[:500]})
+        else:
+            await asyncio.to_thread(job_queue.fail, r["id"], err_msg)
+            factory_events.publish("job_finished", {"job_id": r["id"], "status": "failed",
+                                                    "endpoint": ep.name, "paths": []})
+            failed += 1
+    if failed < len(rows):
+        _log(f"Error transitorio en {ep.name} ({err_msg[:200]}); {len(rows) - failed} job(s) reintentarán con backoff.")
+    if failed:
+        _log(f"Error en generación ({ep.name}): {err_msg[:500]}; {failed} job(s) fallidos.")
+    ep.jobs_failed += failed
+    factory_metrics.finish(span, 0, "failed" if failed else "retried")
+
+async def _finish_saved(ep: ReforgeEndpoint, ids: List[int], save_task: "asyncio.Task", span: JobSpan,
+                        hashes: Optional[List[Optional[str]]] = None):
+    """Espera el guardado de un lote, cierra sus jobs en la cola (con su hash de payload) y registra sus métricas."""
+    try:
+        results = await save_task
+    except Exception as e:
+        err = getattr(e, "detail", None) or str(e)
+        _log(f"Error guardando imágenes ({ep.name}): {err}")
+        for job_id in ids:
+            await asyncio.to_thread(job_queue.fail, job_id, f"Error guardando: {err}")
+        ep.jobs_failed += len(ids)
+        factory_metrics.finish(span, 0, "failed")
+        return
+    hashes = hashes or [None] * len(ids)
+    for job_id, paths, content_hash in zip(ids, results, hashes):
+        if paths:
+            await asyncio.to_thread(job_queue.complete, job_id, paths, content_hash)
+            ep.jobs_done += 1
+        else:
+            await asyncio.to_thread(job_queue.fail, job_id, "ReForge no devolvió imagen para este job del lote.")
+            ep.jobs_failed += 1
+        factory_events.publish("job_finished", {"job_id": job_id, "status": "done" if paths else "failed",
+                                                "endpoint": ep.name, "paths": paths})
+    factory_metrics.finish(span, len({p for paths in results for p in paths}),
+                           "done" if all(results) else "failed")
+
+_factory_task: Optional[asyncio.Task] = None
+# Se activa con cada envío; el worker lo revisa antes de cerrar la corrida
+_factory_wakeup = asyncio.Event()
+# Envíos cancelados: sus lotes en curso no se guardan
+_cancelled_batches: set = set()
+
+async def _forget_cancelled(batch_id: str):
+    """Saca un envío cancelado del registro cuando ya no le quedan jobs en curso."""
+    if batch_id in _cancelled_batches and not await asyncio.to_thread(job_queue.list, "running", batch_id, 1, 0):
+        _cancelled_batches.discard(batch_id)
+
+def _ensure_factory_worker() -> asyncio.Task:
+    """Lanza el worker de la cola si no hay uno corriendo (si lo hay, le avisa que hay trabajo nuevo)."""
+    global _factory_task
+    _factory_wakeup.set()
+    if _factory_task is None or _factory_task.done():
+        FACTORY_STATE["is_active"] = True
+        _factory_task = asyncio.create_task(_factory_worker())
+        _factory_task.add_done_callback(_on_factory_worker_done)
+    return _factory_task
+
+def _on_factory_worker_done(task: asyncio.Task):
+    # Un envío pudo llegar mientras la corrida cerraba (logs/eventos finales o una parada): relanzar.
+    # La parada solo canceló jobs anteriores a ella (stop_max_id); la corrida nueva la limpia.
+    if _factory_wakeup.is_set():
+        _ensure_factory_worker()
+
+async def _submit_jobs(jobs: List[PlannerJob], group_config: Optional[List[GroupConfigItem]] = None,
+                       priority: int = 0, weight: float = 1.0, max_attempts: Optional[int] = None,
+                       force: bool = False) -> tuple:
+    """Encola un envío en la cola viva de la fábrica y se asegura de que el worker lo tome."""
+    batch_id, ids = await asyncio.to_thread(_enqueue_jobs, jobs, group_config, priority, weight, max_attempts, force)
+    if FACTORY_STATE.get("is_active"):
+        FACTORY_STATE["total_jobs"] = int(FACTORY_STATE.get("total_jobs", 0)) + len(ids)
+        _log(f"Envío {batch_id} agregado a la cola: {len(ids)} trabajos (prioridad {priority}).")
+    else:
+        _log("Iniciando generaciÃ³n directa (sin aprovisionamiento)...")
+    _ensure_factory_worker()
+    return batch_id, ids
+
+async def produce_jobs(jobs: List[PlannerJob], group_config: Optional[List[GroupConfigItem]] = None,
+                       priority: int = 0):
+    """Encola los jobs y espera a que el worker vacíe la cola."""
+    await _submit_jobs(jobs, group_config, priority)
+    await _ensure_factory_worker()
+
+@app.on_event("startup")
+async def _startup_factory_queue():
+    # Recuperación tras caída: lo que quedó 'running' vuelve a 'pending' y se reanuda
+    try:
+        recovered = await asyncio.to_thread(job_queue.recover)
+        pending = (await asyncio.to_thread(job_queue.counts))["pending"]
+    except Exception as e:
+        print(f"\033[33m[FactoryQueue] No se pudo recuperar la cola: {e}\033[0m")
+        return
+    if pending:
+        print(f"[FactoryQueue] Reanudando {pending} trabajos pendientes ({recovered} interrumpidos).")
+        _log(f"Reanudando cola persistente: {pending} trabajos pendientes ({recovered} interrumpidos).")
+        _ensure_factory_worker()
 
 def schedule_production(jobs: List[PlannerJob]):
     try:
@@ -2113,49 +3089,45 @@ def schedule_production(jobs: List[PlannerJob]):
         # Si no hay loop (entornos especÃ­ficos), ejecutar en to_thread
         asyncio.run(produce_jobs(jobs))
 
-async def execute_pipeline(jobs: List[PlannerJob], resources: Optional[List[ResourceMeta]] = None, group_config: Optional[List[GroupConfigItem]] = None):
-    # Limpieza de cola y reseteo de contadores antes de iniciar
-    FACTORY_STATE.update({
-        "is_active": True,
-        "stop_requested": False,
-        "current_job_index": 0,
-        "total_jobs": len(jobs),
-        "current_character": None,
-        "current_prompt": None,
-        "current_config": None,
-    })
-    _log("Iniciando generaciÃ³n directa (sin aprovisionamiento)...")
-    await produce_jobs(jobs, group_config)
-
 @app.post("/planner/execute")
-async def execute_plan(payload: ExecuteRequest, background_tasks: BackgroundTasks):
+async def execute_plan(payload: ExecuteRequest):
     """
     Endpoint V1 (legacy): No soporta configuraciÃ³n por personaje.
     """
-    if FACTORY_STATE["is_active"]:
-        raise HTTPException(status_code=400, detail="FÃ¡brica ocupada")
-    
     # Validar jobs
     if not payload.jobs:
         raise HTTPException(status_code=400, detail="Lista de jobs vacÃ­a")
+    priority = _resolve_priority(payload.priority)
+    weight = _resolve_weight(payload.weight)
+    max_attempts = _resolve_max_attempts(payload.max_retries)
+    queued = bool(FACTORY_STATE["is_active"])
 
-    # Iniciar proceso en background
-    background_tasks.add_task(execute_pipeline, payload.jobs, payload.resources_meta or [], [])
-    return {"status": "started", "total_jobs": len(payload.jobs)}
+    # Persistir en la cola y arrancar el worker en background (si ya corre, se suma a la cola viva)
+    batch_id, _ids = await _submit_jobs(payload.jobs, [], priority, weight, max_attempts, bool(payload.force))
+    return {"status": "queued" if queued else "started", "total_jobs": len(payload.jobs),
+            "batch_id": batch_id, "submission_id": batch_id, "priority": priority, "weight": weight}
 
 @app.post("/planner/execute_v2")
-async def execute_plan_v2(payload: ExecuteV2Request, background_tasks: BackgroundTasks):
+async def execute_plan_v2(payload: ExecuteV2Request):
     """
     Endpoint V2: Soporta configuraciÃ³n por personaje (steps, cfg, hires fix, etc).
     """
-    if FACTORY_STATE["is_active"]:
-        raise HTTPException(status_code=400, detail="FÃ¡brica ocupada")
-    
     if not payload.jobs:
         raise HTTPException(status_code=400, detail="Lista de jobs vacÃ­a")
-
-    background_tasks.add_task(execute_pipeline, payload.jobs, payload.resources_meta or [], payload.group_config or [])
-    return {"status": "started", "total_jobs": len(payload.jobs), "version": "v2"}
+    if payload.scheduling is not None:
+        mode = payload.scheduling.strip().lower()
+        if mode not in FACTORY_SCHEDULING_MODES:
+            raise HTTPException(status_code=400, detail=f"scheduling debe ser uno de: {', '.join(FACTORY_SCHEDULING_MODES)}")
+        FACTORY_STATE["scheduling"] = mode
+    priority = _resolve_priority(payload.priority)
+    weight = _resolve_weight(payload.weight)
+    max_attempts = _resolve_max_attempts(payload.max_retries)
+    queued = bool(FACTORY_STATE["is_active"])
+
+    batch_id, _ids = await _submit_jobs(payload.jobs, payload.group_config or [], priority, weight, max_attempts,
+                                        bool(payload.force))
+    return {"status": "queued" if queued else "started", "total_jobs": len(payload.jobs), "version": "v2",
+            "batch_id": batch_id, "submission_id": batch_id, "priority": priority, "weight": weight}
 
 # Lista de modelos Groq con fallback (prioridad de calidad -> rapidez -> legacy)
 GROQ_MODEL_FALLBACKS = [
@@ -2539,33 +3511,42 @@ async def download_checkpoint(req: DownloadCheckpointRequest):
 
     return await _run()
 
+def _iter_local_loras(d: Path):
+    """Genera los metadatos de cada .safetensors bajo la carpeta de LoRAs (recursivo)."""
+    if not d.exists():
+        return
+    # Listar recursivamente .safetensors
+    for p in d.rglob("*.safetensors"):
+        if not p.is_file():
+            continue
+        
+        # Obtener metadatos enriquecidos via LibraryService
+        meta = library_service.get_metadata(p.name, lora_path=p)
+        
+        # Agregar datos fisicos
+        st = p.stat()
+        meta["path"] = str(p)
+        meta["size_bytes"] = st.st_size
+        meta["modified"] = st.st_mtime
+        
+        yield meta
+
 @app.get("/local/loras")
-async def list_local_loras():
+async def list_local_loras(format: Optional[str] = None):
+    """Lista LoRAs locales. format=ndjson transmite un objeto por línea a medida que se escanean."""
     d = get_lora_dir()
     if d is None:
         raise HTTPException(status_code=400, detail="LORA_PATH/REFORGE_PATH no configurados correctamente.")
 
+    if (format or "").lower() == "ndjson":
+        return StreamingResponse(
+            _ndjson_lines(_iter_local_loras(d)),
+            media_type="application/x-ndjson",
+            headers={"X-Lora-Path": str(d)},
+        )
+
     def _list() -> tuple[List[Dict[str, Any]], str]:
-        if not d.exists():
-            return [], str(d)
-        
-        results = []
-        # Listar recursivamente .safetensors
-        for p in d.rglob("*.safetensors"):
-            if not p.is_file():
-                continue
-            
-            # Obtener metadatos enriquecidos via LibraryService
-            meta = library_service.get_metadata(p.name, lora_path=p)
-            
-            # Agregar datos fisicos
-            meta["path"] = str(p)
-            meta["size_bytes"] = p.stat().st_size
-            meta["modified"] = p.stat().st_mtime
-            
-            results.append(meta)
-            
-        return results, str(d)
+        return list(_iter_local_loras(d)), str(d)
 
     files, path = await asyncio.to_thread(_list)
     return {"files": files, "path": path}
@@ -2660,17 +3641,14 @@ def schedule_production(jobs: List[PlannerJob]):
 
 
 @app.get("/factory/status")
-async def factory_status(limit: int = 50):
-    # Limitar los logs devueltos para evitar sobrecarga del payload
-    try:
-        logs_all = FACTORY_STATE.get("logs", [])
-        l = int(limit)
-        if l <= 0:
-            logs_slice = []
-        else:
-            logs_slice = logs_all[-l:]
-    except Exception:
-        logs_slice = FACTORY_STATE.get("logs", [])[-50:]
+async def factory_status(limit: int = 50, since: Optional[int] = None):
+    # Limitar los logs devueltos para evitar sobrecarga del payload; con since=<log_seq> solo las líneas nuevas
+    l = max(0, int(limit))
+    if since is not None:
+        entries = factory_logs.since(int(since))[-l:] if l else []
+    else:
+        entries = factory_logs.tail(l)
+    logs_slice = [line for _, line in entries]
 
     return {
         "is_active": bool(FACTORY_STATE.get("is_active")),
@@ -2682,24 +3660,251 @@ async def factory_status(limit: int = 50):
         "current_config": FACTORY_STATE.get("current_config"),
         "last_image_url": FACTORY_STATE.get("last_image_path"),
         "last_image_b64": FACTORY_STATE.get("last_image_b64"),
+        "queue": await asyncio.to_thread(job_queue.counts),
+        "endpoints": reforge_pool.status(),
+        "scheduling": _scheduling_report(),
+        "dispatch_paused": bool(FACTORY_STATE.get("dispatch_paused")),
+        "saving": image_writer.status(),
         "logs": logs_slice,
+        "log_seq": factory_logs.last_seq,
     }
 
+_progress_task: Optional[asyncio.Task] = None
+
+async def _progress_poller():
+    """
+    Único sondeo de /sdapi/v1/progress por instancia ocupada, compartido por todos los clientes SSE.
+    Publica 'progress' solo cuando cambia y 'preview' cuando ReForge entrega una vista previa nueva.
+    Termina cuando no quedan suscriptores.
+    """
+    last: Dict[str, tuple] = {}
+    last_preview: Dict[str, str] = {}
+    while factory_events.subscribers > 0:
+        busy = [ep for ep in reforge_pool.endpoints if ep.current_job_id is not None]
+        for ep, res in zip(busy, await asyncio.gather(*(get_progress(base_url=ep.url) for ep in busy), return_exceptions=True)):
+            if not isinstance(res, dict):
+                continue
+            state = res.get("state") if isinstance(res.get("state"), dict) else {}
+            progress = round(float(res.get("progress") or 0), 4)
+            eta = round(float(res.get("eta_relative") or 0), 1)
+            key = (ep.current_job_id, progress, eta)
+            if last.get(ep.name) != key:
+                factory_events.publish("progress", {
+                    "endpoint": ep.name, "job_id": ep.current_job_id, "character": ep.current_character,
+                    "progress": progress, "eta_relative": eta,
+                    "step": state.get("sampling_step"), "steps": state.get("sampling_steps"),
+                })
+            preview = res.get("current_image")
+            if preview and preview != last_preview.get(ep.name):
+                factory_events.publish("preview", {"endpoint": ep.name, "job_id": ep.current_job_id,
+                                                   "image": f"data:image/png;base64,{preview}"})
+                last_preview[ep.name] = preview
+            last[ep.name] = key
+        await asyncio.sleep(FACTORY_EVENTS_POLL_INTERVAL)
+
+def _ensure_progress_poller():
+    global _progress_task
+    if _progress_task is None or _progress_task.done():
+        _progress_task = asyncio.create_task(_progress_poller())
+
+def _sse(event: Dict[str, Any]) -> str:
+    data = json.dumps(event.get("data"), ensure_ascii=False, default=str)
+    head = f"id: {event['id']}\n" if event.get("id") is not None else ""
+    return f"{head}event: {event['type']}\ndata: {data}\n\n"
+
+@app.get("/factory/events")
+async def factory_events_stream(request: Request, previews: bool = False, last_event_id: Optional[int] = None):
+    """
+    Server-Sent Events de la fábrica: status (al conectar), job_started, progress, preview (solo con
+    previews=true), log, image_saved (con URLs de archivo y thumbnail), job_finished y queue_finished.
+    Reemplaza el polling de /factory/status y /reforge/progress; reanuda con el header Last-Event-ID.
+    """
+    header_id = request.headers.get("last-event-id")
+    if last_event_id is None and header_id and header_id.isdigit():
+        last_event_id = int(header_id)
+    queue = factory_events.subscribe(last_event_id)
+    _ensure_progress_poller()
+    base_url = str(request.base_url).rstrip("/")
+
+    async def stream():
+        try:
+            yield _sse({"type": "status", "data": {
+                "is_active": bool(FACTORY_STATE.get("is_active")),
+                "current_job_index": int(FACTORY_STATE.get("current_job_index", 0)),
+                "total_jobs": int(FACTORY_STATE.get("total_jobs", 0)),
+                "current_character": FACTORY_STATE.get("current_character"),
+                "last_image_url": FACTORY_STATE.get("last_image_path"),
+                "queue": await asyncio.to_thread(job_queue.counts),
+                "endpoints": reforge_pool.status(),
+            }})
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=15.0)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        break
+                    yield ": ping\n\n"
+                    continue
+                if event["type"] == "preview" and not previews:
+                    continue
+                if event["type"] == "image_saved" and event["data"].get("rel"):
+                    event = {**event, "data": {**event["data"], **_gallery_ref(base_url, event["data"]["rel"])}}
+                yield _sse(event)
+        finally:
+            factory_events.unsubscribe(queue)
+
+    return StreamingResponse(stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.get("/factory/metrics")
+async def factory_metrics_endpoint(format: str = "json", recent: int = 20):
+    """
+    Tiempos por etapa (queue_wait, options, checkpoint_switch, txt2img, decode, write, save) con
+    p50/p95/p99, imágenes por minuto y los últimos lotes con sus atributos.
+    format=prometheus devuelve el formato de texto de Prometheus.
+    """
+    if format == "prometheus":
+        return PlainTextResponse(factory_metrics.prometheus(), media_type="text/plain; version=0.0.4")
+    return factory_metrics.snapshot(max(0, min(200, int(recent))))
+
+@app.get("/reforge/pool")
+async def reforge_pool_status(refresh: bool = False):
+    """Salud, checkpoint cargado y job actual de cada instancia de ReForge del pool."""
+    if refresh:
+        return await reforge_pool.check_all()
+    return reforge_pool.status()
+
+@app.get("/factory/queue")
+async def factory_queue(status: Optional[str] = None, batch_id: Optional[str] = None, limit: int = 100, offset: int = 0):
+    """Jobs de la cola persistente (más recientes primero) con estado, intentos y rutas generadas."""
+    if status and status not in JOB_STATUSES:
+        raise HTTPException(status_code=400, detail=f"status debe ser uno de: {', '.join(JOB_STATUSES)}")
+    limit = max(1, min(1000, int(limit)))
+    jobs = await asyncio.to_thread(job_queue.list, status, batch_id, limit, max(0, int(offset)))
+    return {"counts": await asyncio.to_thread(job_queue.counts), "jobs": jobs}
+
+@app.get("/factory/logs")
+async def factory_logs_since(since: int = 0, limit: int = 500):
+    """Líneas de log con secuencia > since (más antiguas primero). 'next' es el since de la próxima llamada."""
+    limit = max(1, min(5000, int(limit)))
+    entries = factory_logs.since(int(since), limit)
+    return {
+        "logs": [{"seq": seq, "line": line} for seq, line in entries],
+        "next": entries[-1][0] if entries else max(int(since), 0),
+        "last_seq": factory_logs.last_seq,
+    }
+
+@app.get("/factory/failed")
+async def factory_failed(batch_id: Optional[str] = None, limit: int = 100, offset: int = 0):
+    """Jobs que agotaron sus reintentos o fallaron de forma permanente (más recientes primero)."""
+    limit = max(1, min(1000, int(limit)))
+    jobs = await asyncio.to_thread(job_queue.list, "failed", batch_id, limit, max(0, int(offset)))
+    counts = await asyncio.to_thread(job_queue.counts)
+    return {"total": counts["failed"], "jobs": jobs}
+
+class RequeueRequest(BaseModel):
+    # Sin ids ni batch_id se vuelven a encolar todos los fallidos
+    ids: Optional[List[int]] = None
+    batch_id: Optional[str] = None
+
+@app.post("/factory/failed/requeue")
+async def factory_failed_requeue(payload: RequeueRequest):
+    """Vuelve a encolar jobs fallidos desde cero (intentos reiniciados) y arranca la fábrica si estaba parada."""
+    requeued = await asyncio.to_thread(job_queue.requeue, payload.ids, payload.batch_id)
+    if requeued:
+        if FACTORY_STATE.get("is_active"):
+            FACTORY_STATE["total_jobs"] = int(FACTORY_STATE.get("total_jobs", 0)) + requeued
+        _log(f"{requeued} job(s) fallidos devueltos a la cola.")
+        _ensure_factory_worker()
+    return {"status": "ok", "requeued": requeued}
+
+@app.get("/factory/submissions")
+async def factory_submissions(limit: int = 50):
+    """Envíos a la cola (más recientes primero) con prioridad y jobs por estado."""
+    return await asyncio.to_thread(job_queue.submissions, max(1, min(500, int(limit))))
+
+@app.get("/factory/submissions/{submission_id}")
+async def factory_submission(submission_id: str, limit: int = 500):
+    found = await asyncio.to_thread(job_queue.submissions, 1, submission_id)
+    if not found:
+        raise HTTPException(status_code=404, detail="Envío no encontrado")
+    jobs = await asyncio.to_thread(job_queue.list, None, submission_id, max(1, min(5000, int(limit))), 0)
+    return {**found[0], "jobs": jobs}
+
+@app.delete("/factory/submissions/{submission_id}")
+async def factory_cancel_submission(submission_id: str):
+    """
+    Cancela un envío sin detener la fábrica: sus pendientes pasan a 'cancelled' y las instancias
+    que solo están generando jobs de ese envío se interrumpen (el resultado se descarta).
+    """
+    found = await asyncio.to_thread(job_queue.submissions, 1, submission_id)
+    if not found:
+        raise HTTPException(status_code=404, detail="Envío no encontrado")
+    _cancelled_batches.add(submission_id)
+    cancelled = await asyncio.to_thread(job_queue.cancel_batch, submission_id, "Envío cancelado")
+    running = await asyncio.to_thread(job_queue.list, "running", submission_id, 1000, 0)
+    running_ids = {j["id"] for j in running}
+    if not running_ids:
+        _cancelled_batches.discard(submission_id)
+    interrupted = []
+    for ep in reforge_pool.endpoints:
+        if ep.current_job_id is not None and ep.current_job_id in running_ids:
+            try:
+                await interrupt_generation(base_url=ep.url)
+                interrupted.append(ep.name)
+            except Exception as e:
+                _log(f"Error al interrumpir {ep.name}: {e}")
+    _log(f"Envío {submission_id} cancelado: {cancelled} pendientes, {len(running_ids)} en curso.")
+    return {"status": "cancelled", "submission_id": submission_id, "cancelled": cancelled,
+            "running": len(running_ids), "interrupted": interrupted}
+
+class FairShareUpdate(BaseModel):
+    enabled: Optional[bool] = None
+    character_weights: Optional[Dict[str, float]] = None
+    switch_slack: Optional[float] = None
+    max_wait: Optional[float] = None
+
+@app.get("/factory/fair-share")
+async def factory_fair_share():
+    """Estado del reparto justo: pesos, tiempos virtuales por envío/personaje y elecciones por inanición."""
+    return {"enabled": bool(FACTORY_STATE.get("fair_share")), **fair_share.snapshot()}
+
+@app.post("/factory/fair-share")
+async def factory_fair_share_update(payload: FairShareUpdate):
+    """Ajusta el reparto justo en caliente; aplica desde el próximo job que se tome de la cola."""
+    if payload.character_weights is not None:
+        if any(not w > 0 for w in payload.character_weights.values()):
+            raise HTTPException(status_code=400, detail="Los pesos deben ser mayores que 0")
+        fair_share.character_weights = {k.strip().lower(): float(w) for k, w in payload.character_weights.items()}
+    if payload.switch_slack is not None:
+        fair_share.switch_slack = max(0.0, float(payload.switch_slack))
+    if payload.max_wait is not None:
+        fair_share.max_wait = max(0.0, float(payload.max_wait))
+    if payload.enabled is not None:
+        FACTORY_STATE["fair_share"] = bool(payload.enabled)
+    return await factory_fair_share()
+
 @app.post("/factory/clear-logs")
 async def factory_clear_logs():
-    FACTORY_STATE["logs"] = []
+    factory_logs.clear()
     return {"status": "ok"}
 
 @app.post("/factory/stop")
 async def factory_stop():
+    # La parada alcanza a lo encolado hasta ahora; un envío posterior arranca una corrida nueva
+    FACTORY_STATE["stop_max_id"] = await asyncio.to_thread(job_queue.max_id)
     FACTORY_STATE["stop_requested"] = True
+    cancelled = await asyncio.to_thread(job_queue.cancel_pending, "Parada de emergencia", FACTORY_STATE["stop_max_id"])
+    if cancelled:
+        _log(f"{cancelled} trabajos pendientes cancelados.")
     _log("Parada de emergencia activada por el usuario. Solicitando interrupciÃ³n a Stable Diffusion...")
-    try:
-        data = await interrupt_generation()
-        status = data.get("status", "ok") if isinstance(data, dict) else "ok"
-        _log(f"InterrupciÃ³n enviada a ReForge: {status}")
-    except Exception as e:
-        _log(f"Error al interrumpir la generaciÃ³n en ReForge: {e}")
+    for ep in reforge_pool.endpoints:
+        try:
+            data = await interrupt_generation(base_url=ep.url)
+            status = data.get("status", "ok") if isinstance(data, dict) else "ok"
+            _log(f"InterrupciÃ³n enviada a ReForge ({ep.name}): {status}")
+        except Exception as e:
+            _log(f"Error al interrumpir la generaciÃ³n en ReForge ({ep.name}): {e}")
     return {"status": "stopping"}
 class MarketingGenerateRequest(BaseModel):
     prompt_used: Optional[str] = None
@@ -3380,6 +4585,13 @@ async def gallery_generate_info(req: GenerateInfoRequest):
 
 
 
+def _read_image_metadata(target: Path) -> Dict[str, Any]:
+    """Lee 'parameters' sin decodificar píxeles (chunks PNG / Pillow para WebP-JPEG) y lo parsea."""
+    params = read_image_text(target).get("parameters", "")
+    parsed = parse_parameters(params)
+    parsed["full_params"] = params
+    return parsed
+
 @app.get("/gallery/metadata")
 async def get_image_metadata(path: str):
     """
@@ -3401,28 +4613,44 @@ async def get_image_metadata(path: str):
         if not target.exists():
             return {"prompt": "", "params": ""}
 
-        with Image.open(target) as img:
-            img.load()
-            info = img.info or {}
-            params = info.get("parameters", "")
-            
-            # Parse simple
-            prompt = ""
-            if params:
-                # A1111 format: Prompt \n Negative prompt: ...
-                if "Negative prompt:" in params:
-                    prompt = params.split("Negative prompt:")[0].strip()
-                elif "Steps:" in params:
-                    prompt = params.split("Steps:")[0].strip()
-                else:
-                    prompt = params
-
-            return {"prompt": prompt, "full_params": params}
+        return await asyncio.to_thread(_read_image_metadata, target)
             
     except Exception as e:
         print(f"Error leyendo metadata de {path}: {e}")
         return {"prompt": "", "error": str(e)}
 
+class GalleryMetadataBatchRequest(BaseModel):
+    paths: List[str]
+
+@app.post("/gallery/metadata")
+async def get_image_metadata_batch(req: GalleryMetadataBatchRequest):
+    """
+    Variante por lotes: recibe muchas rutas (relativas a OUTPUTS_DIR) y devuelve
+    prompt, negative_prompt, steps, sampler, seed, model, etc. por cada una.
+    """
+    if not OUTPUTS_DIR:
+        raise HTTPException(status_code=500, detail="OUTPUTS_DIR no configurado")
+    if len(req.paths) > 1000:
+        raise HTTPException(status_code=400, detail="Máximo 1000 rutas por request")
+    base = Path(OUTPUTS_DIR).resolve()
+
+    def _read_all() -> Dict[str, Any]:
+        out: Dict[str, Any] = {}
+        for rel in req.paths:
+            try:
+                target = (base / rel).resolve()
+                if base not in target.parents:
+                    out[rel] = {"error": "Ruta fuera de OUTPUTS_DIR"}
+                elif not target.exists():
+                    out[rel] = {"error": "Archivo no encontrado"}
+                else:
+                    out[rel] = _read_image_metadata(target)
+            except Exception as e:
+                out[rel] = {"error": str(e)}
+        return out
+
+    return {"items": await asyncio.to_thread(_read_all)}
+
 
 
 # Reload trigger 2
@@ -0,0 +1,52 @@
+import asyncio
+import itertools
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Set
+
+
+class EventBus:
+    """
+    Difusión en memoria de eventos tipados de la fábrica (job_started, progress, log, image_saved,
+    queue_finished...) hacia los clientes de /factory/events.
+    Cada suscriptor tiene su propia cola acotada: un cliente lento pierde sus eventos más viejos
+    sin frenar a la fábrica. Los últimos eventos se guardan para reanudar con Last-Event-ID.
+    """
+
+    def __init__(self, history: int = 200, queue_size: int = 500):
+        self._seq = itertools.count(1)
+        self._history: Deque[Dict[str, Any]] = deque(maxlen=history)
+        self._subscribers: Set[asyncio.Queue] = set()
+        self.queue_size = queue_size
+
+    @property
+    def subscribers(self) -> int:
+        return len(self._subscribers)
+
+    def publish(self, type_: str, data: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        event = {"id": next(self._seq), "type": type_, "ts": time.time(), "data": data or {}}
+        self._history.append(event)
+        for q in list(self._subscribers):
+            if q.full():
+                try:
+                    q.get_nowait()
+                except asyncio.QueueEmpty:
+                    pass
+            q.put_nowait(event)
+        return event
+
+    def subscribe(self, last_id: Optional[int] = None) -> asyncio.Queue:
+        """Nueva cola de eventos; con last_id se precarga con lo publicado después de ese id."""
+        q: asyncio.Queue = asyncio.Queue(maxsize=self.queue_size)
+        if last_id is not None:
+            for event in self._history:
+                if event["id"] > last_id and not q.full():
+                    q.put_nowait(event)
+        self._subscribers.add(q)
+        return q
+
+    def unsubscribe(self, q: asyncio.Queue):
+        self._subscribers.discard(q)
+
+    def recent(self, limit: int = 50) -> List[Dict[str, Any]]:
+        return list(self._history)[-limit:]
@@ -0,0 +1,96 @@
+import logging
+import queue
+import threading
+from collections import deque
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from pathlib import Path
+from typing import Deque, List, Optional, Tuple
+
+
+class LogBuffer:
+    """
+    Logs de la fábrica en un buffer circular de tamaño fijo con número de secuencia creciente.
+    Los clientes piden since=<seq> y reciben solo las líneas nuevas.
+    """
+
+    def __init__(self, size: int = 1000):
+        self.size = max(10, size)
+        self._lines: Deque[Tuple[int, str]] = deque(maxlen=self.size)
+        self._lock = threading.Lock()
+        self.last_seq = 0
+
+    def append(self, line: str) -> int:
+        with self._lock:
+            self.last_seq += 1
+            self._lines.append((self.last_seq, line))
+            return self.last_seq
+
+    def load(self, entries: List[Tuple[int, str]]):
+        """Precarga historial (p. ej. del archivo) manteniendo la secuencia por encima de lo cargado."""
+        with self._lock:
+            for seq, line in entries:
+                self._lines.append((seq, line))
+                self.last_seq = max(self.last_seq, seq)
+
+    def since(self, seq: int, limit: Optional[int] = None) -> List[Tuple[int, str]]:
+        """Entradas con secuencia > seq (las más antiguas primero), hasta 'limit'."""
+        with self._lock:
+            if self._lines and seq >= self._lines[-1][0]:
+                return []
+            out = [e for e in self._lines if e[0] > seq]
+        return out[:limit] if limit is not None else out
+
+    def tail(self, n: int) -> List[Tuple[int, str]]:
+        if n <= 0:
+            return []
+        with self._lock:
+            return list(self._lines)[-n:]
+
+    def clear(self):
+        # La secuencia no se reinicia: los cursores de los clientes siguen siendo válidos
+        with self._lock:
+            self._lines.clear()
+
+
+class FactoryLogFile:
+    """
+    Persistencia de los logs en un archivo rotativo ("<seq> <línea>" por renglón).
+    write() solo encola: la escritura la hace el hilo de un QueueListener, sin E/S en el request.
+    """
+
+    def __init__(self, path: Path, max_bytes: int = 5 * 1024 * 1024, backups: int = 3):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._queue: "queue.Queue[logging.LogRecord]" = queue.Queue(-1)
+        handler = RotatingFileHandler(str(self.path), maxBytes=max_bytes, backupCount=backups, encoding="utf-8")
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        self._listener = QueueListener(self._queue, handler)
+        self._logger = logging.Logger(f"factory-log:{self.path}")
+        self._logger.addHandler(QueueHandler(self._queue))
+        self._started = False
+
+    def start(self):
+        if not self._started:
+            self._listener.start()
+            self._started = True
+
+    def stop(self):
+        if self._started:
+            self._listener.stop()  # vacía la cola antes de terminar
+            self._started = False
+
+    def write(self, seq: int, line: str):
+        self._logger.info("%d %s", seq, line.replace("\n", " "))
+
+    def read_tail(self, n: int) -> List[Tuple[int, str]]:
+        """Últimas n entradas del archivo actual (para reanudar el historial al arrancar)."""
+        if n <= 0 or not self.path.exists():
+            return []
+        out: Deque[Tuple[int, str]] = deque(maxlen=n)
+        with open(self.path, "r", encoding="utf-8", errors="replace") as fh:
+            for raw in fh:
+                seq, _, line = raw.rstrip("\n").partition(" ")
+                if seq.isdigit():
+                    out.append((int(seq), line))
+        return list(out)
+
@@ -0,0 +1,141 @@
+import math
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Deque, Dict, Iterator, List, Optional, Tuple
+
+# Etapas medidas por lote generado (un lote = una llamada txt2img, uno o varios jobs).
+# decode/write suman lo de cada imagen del lote (corren en paralelo); save es el tiempo de pared del guardado.
+STAGES = ("queue_wait", "options", "checkpoint_switch", "txt2img", "decode", "write", "save")
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+def percentile(sorted_values: List[float], q: float) -> Optional[float]:
+    """Percentil por rango más cercano sobre una lista ya ordenada."""
+    if not sorted_values:
+        return None
+    k = max(0, min(len(sorted_values) - 1, math.ceil(q * len(sorted_values)) - 1))
+    return sorted_values[k]
+
+
+class JobSpan:
+    """Tiempos por etapa (segundos) y atributos de un lote en curso."""
+
+    def __init__(self, job_ids: List[int], attrs: Optional[Dict[str, Any]] = None):
+        self.job_ids = list(job_ids)
+        self.attrs: Dict[str, Any] = dict(attrs or {})
+        self.stages: Dict[str, float] = {}
+        self.started = time.time()
+
+    def add(self, stage: str, seconds: float):
+        self.stages[stage] = self.stages.get(stage, 0.0) + max(0.0, seconds)
+
+    @contextmanager
+    def time(self, stage: str) -> Iterator[None]:
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - t0)
+
+
+class FactoryMetrics:
+    """
+    Métricas de la línea de producción: ventana de las últimas N muestras por etapa
+    (p50/p95/p99), imágenes por minuto y los lotes recientes con sus atributos.
+    """
+
+    def __init__(self, window: int = 2000, recent: int = 200, rate_window: float = 600.0):
+        self.window = window
+        self.rate_window = rate_window
+        self._samples: Dict[str, Deque[float]] = {s: deque(maxlen=window) for s in STAGES}
+        self._totals: Dict[str, Tuple[int, float]] = {s: (0, 0.0) for s in STAGES}
+        self._images: Deque[Tuple[float, int]] = deque()
+        self._recent: Deque[Dict[str, Any]] = deque(maxlen=recent)
+        self.images_total = 0
+        self.jobs_total: Dict[str, int] = {"done": 0, "failed": 0}
+
+    def record(self, stage: str, seconds: float):
+        if stage not in self._samples:
+            self._samples[stage] = deque(maxlen=self.window)
+            self._totals[stage] = (0, 0.0)
+        self._samples[stage].append(seconds)
+        n, total = self._totals[stage]
+        self._totals[stage] = (n + 1, total + seconds)
+
+    def finish(self, span: JobSpan, images: int, status: str = "done"):
+        """Cierra el lote: vuelca sus etapas a las ventanas y cuenta imágenes/jobs."""
+        for stage, seconds in span.stages.items():
+            self.record(stage, seconds)
+        now = time.time()
+        if images:
+            self.images_total += images
+            self._images.append((now, images))
+        self.jobs_total[status] = self.jobs_total.get(status, 0) + len(span.job_ids)
+        self._recent.append({
+            "job_ids": span.job_ids,
+            "status": status,
+            "images": images,
+            "started": span.started,
+            "finished": now,
+            "stages": {k: round(v, 4) for k, v in span.stages.items()},
+            **span.attrs,
+        })
+
+    def images_per_minute(self) -> float:
+        cutoff = time.time() - self.rate_window
+        while self._images and self._images[0][0] < cutoff:
+            self._images.popleft()
+        if not self._images:
+            return 0.0
+        # Desde la primera imagen de la ventana (mínimo un minuto para no inflar arranques)
+        elapsed = min(self.rate_window, max(60.0, time.time() - self._images[0][0]))
+        return round(sum(n for _, n in self._images) * 60.0 / elapsed, 2)
+
+    def stage_stats(self) -> Dict[str, Dict[str, Any]]:
+        out: Dict[str, Dict[str, Any]] = {}
+        for stage, samples in self._samples.items():
+            values = sorted(samples)
+            n, total = self._totals[stage]
+            stats: Dict[str, Any] = {"count": n, "sum": round(total, 4), "window": len(values)}
+            for q in QUANTILES:
+                p = percentile(values, q)
+                stats[f"p{int(q * 100)}"] = round(p, 4) if p is not None else None
+            stats["max"] = round(values[-1], 4) if values else None
+            out[stage] = stats
+        return out
+
+    def snapshot(self, recent: int = 20) -> Dict[str, Any]:
+        return {
+            "stages": self.stage_stats(),
+            "images_total": self.images_total,
+            "images_per_minute": self.images_per_minute(),
+            "jobs": dict(self.jobs_total),
+            "recent": list(self._recent)[-recent:] if recent > 0 else [],
+        }
+
+    def prometheus(self, prefix: str = "factory") -> str:
+        """Formato de exposición de texto de Prometheus (summary por etapa + contadores)."""
+        lines = [
+            f"# HELP {prefix}_stage_seconds Duración por etapa de la línea de producción.",
+            f"# TYPE {prefix}_stage_seconds summary",
+        ]
+        for stage, stats in self.stage_stats().items():
+            for q in QUANTILES:
+                value = stats[f"p{int(q * 100)}"]
+                if value is not None:
+                    lines.append(f'{prefix}_stage_seconds{{stage="{stage}",quantile="{q}"}} {value}')
+            lines.append(f'{prefix}_stage_seconds_sum{{stage="{stage}"}} {stats["sum"]}')
+            lines.append(f'{prefix}_stage_seconds_count{{stage="{stage}"}} {stats["count"]}')
+        lines += [
+            f"# HELP {prefix}_images_total Imágenes guardadas.",
+            f"# TYPE {prefix}_images_total counter",
+            f"{prefix}_images_total {self.images_total}",
+            f"# HELP {prefix}_images_per_minute Imágenes por minuto en la ventana reciente.",
+            f"# TYPE {prefix}_images_per_minute gauge",
+            f"{prefix}_images_per_minute {self.images_per_minute()}",
+            f"# HELP {prefix}_jobs_total Jobs terminados por estado.",
+            f"# TYPE {prefix}_jobs_total counter",
+        ]
+        lines += [f'{prefix}_jobs_total{{status="{k}"}} {v}' for k, v in self.jobs_total.items()]
+        return "\n".join(lines) + "\n"
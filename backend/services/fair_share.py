@@ -0,0 +1,131 @@
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+
+def parse_weights(raw: Optional[str]) -> Dict[str, float]:
+    """"rias=2,akeno=0.5" -> {"rias": 2.0, "akeno": 0.5} (claves en minúsculas; se ignoran entradas inválidas)."""
+    out: Dict[str, float] = {}
+    for part in (raw or "").split(","):
+        name, sep, value = part.partition("=")
+        if not sep or not name.strip():
+            continue
+        try:
+            weight = float(value)
+        except ValueError:
+            continue
+        if weight > 0:
+            out[name.strip().lower()] = weight
+    return out
+
+
+class FairShare:
+    """
+    Reparto justo de la cola entre envíos y, dentro de cada envío, entre personajes.
+    Cada flujo lleva un tiempo virtual que avanza 1/peso por job tomado; se sirve el flujo más
+    atrasado (primero por envío, luego por personaje), así un envío de 20 jobs no espera a uno de 300.
+    Compatible con el modo agrupado: si la instancia tiene un checkpoint cargado, se sigue con un flujo
+    de ese checkpoint mientras no esté más de switch_slack jobs por delante del más atrasado.
+    Anti-inanición: un envío sin servicio durante max_wait segundos pasa primero, sea cual sea su peso.
+    pick()/charge() se llaman con el lock de la cola tomado.
+    """
+
+    def __init__(self, character_weights: Optional[Dict[str, float]] = None,
+                 switch_slack: float = 8.0, max_wait: float = 300.0):
+        self.character_weights: Dict[str, float] = {k.lower(): float(v) for k, v in (character_weights or {}).items()}
+        self.switch_slack = max(0.0, float(switch_slack))
+        self.max_wait = max(0.0, float(max_wait))
+        self._vt_submission: Dict[str, float] = {}
+        self._vt_character: Dict[Tuple[str, str], float] = {}
+        self._last_served: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self.starvation_picks = 0
+
+    def character_weight(self, character: str) -> float:
+        return self.character_weights.get((character or "").lower(), 1.0)
+
+    def _sync(self, flows: List[Dict[str, Any]]):
+        """Olvida flujos sin pendientes y arranca los nuevos en el tiempo virtual mínimo vigente
+        (un envío nuevo no acumula crédito por el tiempo que no estuvo en la cola)."""
+        active = {f["batch_id"] for f in flows}
+        for batch_id in [b for b in self._vt_submission if b not in active]:
+            self._vt_submission.pop(batch_id, None)
+            self._last_served.pop(batch_id, None)
+        active_chars = {(f["batch_id"], f["character"]) for f in flows}
+        for key in [k for k in self._vt_character if k not in active_chars]:
+            self._vt_character.pop(key, None)
+        base = min(self._vt_submission.values(), default=0.0)
+        for f in flows:
+            self._vt_submission.setdefault(f["batch_id"], base)
+        for batch_id in active:
+            chars = [v for (b, _), v in self._vt_character.items() if b == batch_id]
+            char_base = min(chars, default=0.0)
+            for f in flows:
+                if f["batch_id"] == batch_id:
+                    self._vt_character.setdefault((batch_id, f["character"]), char_base)
+
+    def _score(self, flow: Dict[str, Any]) -> Tuple[float, float, int]:
+        return (self._vt_submission[flow["batch_id"]],
+                self._vt_character[(flow["batch_id"], flow["character"])],
+                int(flow["first_id"]))
+
+    def _lag(self, flow: Dict[str, Any], best: Dict[str, Any]) -> float:
+        """Cuántos jobs (a peso 1) va 'flow' por delante del flujo que toca por justicia."""
+        if flow["batch_id"] == best["batch_id"]:
+            return (self._vt_character[(flow["batch_id"], flow["character"])]
+                    - self._vt_character[(best["batch_id"], best["character"])])
+        return self._vt_submission[flow["batch_id"]] - self._vt_submission[best["batch_id"]]
+
+    def pick(self, flows: List[Dict[str, Any]], prefer_signature: Optional[str] = None,
+             prefer_checkpoint: Optional[str] = None, now: Optional[float] = None) -> Optional[Dict[str, Any]]:
+        """
+        Elige el flujo del que sale el próximo job. Cada flujo: {"batch_id", "character", "signature",
+        "checkpoint", "first_id", "oldest", "weight"} (pendientes de la prioridad más alta).
+        """
+        if not flows:
+            return None
+        now = time.time() if now is None else now
+        with self._lock:
+            self._sync(flows)
+            if self.max_wait > 0:
+                waits = {f["batch_id"]: now - self._last_served.get(f["batch_id"], f["oldest"]) for f in flows}
+                starving = [f for f in flows if waits[f["batch_id"]] > self.max_wait]
+                if starving:
+                    self.starvation_picks += 1
+                    return min(starving, key=lambda f: (-waits[f["batch_id"]], int(f["first_id"])))
+            best = min(flows, key=self._score)
+            for key, value in (("signature", prefer_signature), ("checkpoint", prefer_checkpoint)):
+                if value is None or value == "":
+                    continue
+                matches = [f for f in flows if f.get(key) == value]
+                if matches:
+                    match = min(matches, key=self._score)
+                    if self._lag(match, best) <= self.switch_slack:
+                        return match
+                    break
+            return best
+
+    def charge(self, rows: List[Dict[str, Any]], now: Optional[float] = None):
+        """Descuenta los jobs tomados de sus flujos (un lote combinado puede tocar varios envíos)."""
+        now = time.time() if now is None else now
+        with self._lock:
+            for r in rows:
+                batch_id, character = r["batch_id"], r.get("character") or ""
+                weight = float(r.get("weight") or 1.0)
+                self._vt_submission[batch_id] = self._vt_submission.get(batch_id, 0.0) + 1.0 / max(weight, 1e-6)
+                key = (batch_id, character)
+                self._vt_character[key] = self._vt_character.get(key, 0.0) + 1.0 / self.character_weight(character)
+                self._last_served[batch_id] = now
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "character_weights": dict(self.character_weights),
+                "switch_slack": self.switch_slack,
+                "max_wait": self.max_wait,
+                "starvation_picks": self.starvation_picks,
+                "submissions": {b: {"vtime": round(v, 3), "last_served": self._last_served.get(b)}
+                                for b, v in self._vt_submission.items()},
+                "characters": [{"batch_id": b, "character": c, "vtime": round(v, 3)}
+                               for (b, c), v in self._vt_character.items()],
+            }
@@ -0,0 +1,643 @@
+import base64
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from services.png_meta import read_image_text, parse_parameters
+
+IMAGE_EXTS = {".png", ".jpg", ".jpeg", ".webp"}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS images (
+    path TEXT PRIMARY KEY,
+    filename TEXT NOT NULL,
+    character TEXT NOT NULL,
+    date_folder TEXT,
+    mtime INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    seed INTEGER,
+    checkpoint TEXT,
+    meta_indexed INTEGER NOT NULL DEFAULT 0,
+    content_hash TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_images_mtime ON images(mtime DESC, path DESC);
+CREATE INDEX IF NOT EXISTS idx_images_character ON images(character, mtime DESC, path DESC);
+CREATE INDEX IF NOT EXISTS idx_images_date ON images(date_folder);
+CREATE TABLE IF NOT EXISTS image_hashes (
+    path TEXT PRIMARY KEY,
+    dhash INTEGER,
+    mtime INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_image_hashes_dhash ON image_hashes(dhash);
+CREATE TRIGGER IF NOT EXISTS image_hashes_ad AFTER DELETE ON images BEGIN
+    DELETE FROM image_hashes WHERE path = old.path;
+END;
+"""
+
+# Agregados por (personaje, carpeta YYYYMMDD) mantenidos por triggers: /gallery/stats no recorre images
+STATS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS image_stats (
+    character TEXT NOT NULL,
+    date_folder TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    bytes INTEGER NOT NULL,
+    latest INTEGER NOT NULL,
+    PRIMARY KEY (character, date_folder)
+);
+CREATE INDEX IF NOT EXISTS idx_images_char_date ON images(character, date_folder, mtime);
+CREATE TRIGGER IF NOT EXISTS image_stats_ai AFTER INSERT ON images BEGIN
+    INSERT INTO image_stats(character, date_folder, count, bytes, latest)
+    VALUES (new.character, COALESCE(new.date_folder, ''), 1, new.size, new.mtime)
+    ON CONFLICT(character, date_folder) DO UPDATE SET
+        count = count + 1, bytes = bytes + excluded.bytes, latest = MAX(latest, excluded.latest);
+END;
+CREATE TRIGGER IF NOT EXISTS image_stats_ad AFTER DELETE ON images BEGIN
+    UPDATE image_stats SET
+        count = count - 1,
+        bytes = bytes - old.size,
+        latest = CASE WHEN old.mtime < latest THEN latest ELSE COALESCE((
+            SELECT MAX(mtime) FROM images
+            WHERE character = old.character AND date_folder IS old.date_folder), 0) END
+    WHERE character = old.character AND date_folder = COALESCE(old.date_folder, '');
+    DELETE FROM image_stats WHERE character = old.character AND date_folder = COALESCE(old.date_folder, '') AND count <= 0;
+END;
+CREATE TRIGGER IF NOT EXISTS image_stats_au AFTER UPDATE OF size, mtime ON images BEGIN
+    UPDATE image_stats SET
+        bytes = bytes - old.size + new.size,
+        latest = CASE WHEN new.mtime >= latest THEN new.mtime ELSE COALESCE((
+            SELECT MAX(mtime) FROM images
+            WHERE character = new.character AND date_folder IS new.date_folder), 0) END
+    WHERE character = new.character AND date_folder = COALESCE(new.date_folder, '');
+END;
+"""
+
+# Índice invertido de los 'parameters' A1111 (rowid = images.rowid)
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS images_fts USING fts5(
+    prompt, negative_prompt, loras, checkpoint,
+    tokenize = 'unicode61 remove_diacritics 2'
+);
+CREATE TRIGGER IF NOT EXISTS images_fts_ad AFTER DELETE ON images BEGIN
+    DELETE FROM images_fts WHERE rowid = old.rowid;
+END;
+"""
+
+# UPSERT conserva el rowid (INSERT OR REPLACE lo cambiaría y desalinearía images_fts)
+UPSERT_SQL = """
+INSERT INTO images(path, filename, character, date_folder, mtime, size, seed, checkpoint, content_hash, meta_indexed)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 1)
+ON CONFLICT(path) DO UPDATE SET
+    filename = excluded.filename, character = excluded.character, date_folder = excluded.date_folder,
+    mtime = excluded.mtime, size = excluded.size, seed = excluded.seed,
+    checkpoint = excluded.checkpoint, content_hash = excluded.content_hash, meta_indexed = 1
+"""
+
+RE_FTS_TOKEN = re.compile(r"\w+", re.UNICODE)
+
+
+def parse_date_bound(value: Optional[str], end: bool = False) -> Optional[int]:
+    """
+    Convierte 'YYYY-MM-DD' / 'YYYYMMDD' (hora local) o epoch en segundos.
+    Con end=True una fecha sin hora apunta al inicio del día siguiente (límite exclusivo).
+    """
+    raw = (value or "").strip()
+    if not raw:
+        return None
+    digits = raw.replace("-", "")
+    if len(digits) == 8 and digits.isdigit():
+        day = datetime.strptime(digits, "%Y%m%d")
+        if end:
+            day += timedelta(days=1)
+        return int(day.timestamp())
+    try:
+        return int(float(raw))
+    except ValueError:
+        raise ValueError(f"Fecha inválida: {raw} (usar YYYY-MM-DD, YYYYMMDD o epoch)")
+
+
+def _is_date_folder(name: str) -> bool:
+    return len(name) == 8 and name.isdigit()
+
+
+def date_folder_bounds(ts_from: Optional[int], ts_to: Optional[int]) -> Tuple[Optional[str], Optional[str]]:
+    """
+    Rango de carpetas YYYYMMDD (inclusivo) que pueden contener archivos con mtime en [ts_from, ts_to).
+    _save_image nombra la carpeta con la fecha local del guardado, igual que parse_date_bound.
+    """
+    lo = datetime.fromtimestamp(ts_from).strftime("%Y%m%d") if ts_from is not None else None
+    hi = datetime.fromtimestamp(ts_to - 1).strftime("%Y%m%d") if ts_to is not None else None
+    return lo, hi
+
+
+def date_folder_in_range(name: str, bounds: Tuple[Optional[str], Optional[str]]) -> bool:
+    """False solo para carpetas de fecha fuera del rango (las demás se recorren igual)."""
+    if not _is_date_folder(name):
+        return True
+    lo, hi = bounds
+    return (lo is None or name >= lo) and (hi is None or name <= hi)
+
+
+def split_rel_path(rel: str) -> Tuple[str, Optional[str]]:
+    """Devuelve (personaje, carpeta YYYYMMDD) a partir de una ruta relativa a OUTPUTS_DIR."""
+    parts = rel.split("/")
+    character = parts[0] if len(parts) > 1 else ""
+    date_folder = parts[1] if len(parts) > 2 and _is_date_folder(parts[1]) else None
+    return character, date_folder
+
+
+class GalleryIndex:
+    """
+    Índice persistente (SQLite) de las imágenes bajo OUTPUTS_DIR.
+    Guarda ruta relativa, personaje (carpeta top-level), carpeta de fecha, mtime y tamaño,
+    para que /gallery pagine con índices en lugar de recorrer todo el árbol en cada request.
+    Los métodos son síncronos: desde endpoints async se llaman vía asyncio.to_thread.
+    """
+
+    def __init__(self, db_path: Path, root: Optional[str]):
+        self.db_path = Path(db_path)
+        self.root = Path(root).resolve() if root else None
+        self._lock = threading.Lock()
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+        self._migrate()
+        self._conn.executescript(STATS_SCHEMA)
+        if self._get_meta("stats_built") is None:
+            self._rebuild_stats()
+        self.fts_enabled = True
+        try:
+            self._conn.executescript(FTS_SCHEMA)
+        except sqlite3.OperationalError as e:
+            print(f"[GalleryIndex] FTS5 no disponible en este SQLite ({e}); búsqueda desactivada")
+            self.fts_enabled = False
+        self._check_root()
+        self._generation = int(self._get_meta("generation") or 0)
+        self._last_change = float(self._get_meta("last_change") or time.time())
+
+    def _migrate(self):
+        """Agrega columnas nuevas a índices creados por versiones anteriores."""
+        cols = {r["name"] for r in self._conn.execute("PRAGMA table_info(images)")}
+        for name, decl in (("seed", "INTEGER"), ("checkpoint", "TEXT"), ("meta_indexed", "INTEGER NOT NULL DEFAULT 0"),
+                           ("content_hash", "TEXT")):
+            if name not in cols:
+                self._conn.execute(f"ALTER TABLE images ADD COLUMN {name} {decl}")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_images_seed ON images(seed)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_images_content_hash ON images(content_hash)")
+        self._conn.commit()
+
+    def _rebuild_stats(self):
+        """Reconstruye image_stats desde images (índices creados antes de existir los agregados)."""
+        with self._lock:
+            self._conn.execute("DELETE FROM image_stats")
+            self._conn.execute(
+                "INSERT INTO image_stats(character, date_folder, count, bytes, latest) "
+                "SELECT character, COALESCE(date_folder, ''), COUNT(*), SUM(size), MAX(mtime) "
+                "FROM images GROUP BY character, COALESCE(date_folder, '')"
+            )
+            self._set_meta("stats_built", "1")
+            self._conn.commit()
+
+    def _check_root(self):
+        """Si OUTPUTS_DIR cambió respecto al índice guardado, se vacía para reconstruirlo."""
+        root_str = str(self.root) if self.root else ""
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = 'root'").fetchone()
+            if row is None or row["value"] != root_str:
+                if row is not None:
+                    print(f"[GalleryIndex] OUTPUTS_DIR cambió ({row['value']} -> {root_str}); reiniciando índice")
+                self._conn.execute("DELETE FROM images")
+                self._conn.execute("DELETE FROM meta WHERE key = 'last_reconciled'")
+                self._conn.execute("INSERT OR REPLACE INTO meta(key, value) VALUES ('last_change', ?)", (str(time.time()),))
+                self._conn.execute("INSERT OR REPLACE INTO meta(key, value) VALUES ('root', ?)", (root_str,))
+                self._conn.commit()
+
+    def _get_meta(self, key: str) -> Optional[str]:
+        row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row["value"] if row else None
+
+    def _set_meta(self, key: str, value: str):
+        self._conn.execute("INSERT OR REPLACE INTO meta(key, value) VALUES (?, ?)", (key, value))
+
+    def _bump_locked(self):
+        """Marca un cambio en la colección (para ETag/Last-Modified). Requiere el lock tomado."""
+        self._generation += 1
+        self._last_change = time.time()
+        self._set_meta("generation", str(self._generation))
+        self._set_meta("last_change", str(self._last_change))
+
+    def version(self) -> Tuple[int, float]:
+        """(generación, timestamp del último cambio) de la colección indexada."""
+        return self._generation, self._last_change
+
+    def last_reconciled(self) -> Optional[float]:
+        with self._lock:
+            raw = self._get_meta("last_reconciled")
+        try:
+            return float(raw) if raw else None
+        except ValueError:
+            return None
+
+    def to_rel(self, path: Any) -> Optional[str]:
+        """Convierte una ruta absoluta (o relativa) en clave relativa a OUTPUTS_DIR con '/'."""
+        if not self.root:
+            return None
+        p = Path(path)
+        if not p.is_absolute():
+            p = self.root / p
+        try:
+            rel = p.resolve().relative_to(self.root)
+        except ValueError:
+            return None
+        rel_str = str(rel).replace("\\", "/")
+        return rel_str if rel_str and rel_str != "." else None
+
+    # == Escritura ==
+
+    def _entry_for(self, rel: str, st: os.stat_result) -> Tuple[tuple, Optional[tuple]]:
+        """Fila de images + fila FTS. Lee 'parameters' y 'content_hash' (caché de resultados de la fábrica)
+        solo de la cabecera (sin decodificar píxeles)."""
+        character, date_folder = split_rel_path(rel)
+        meta: Dict[str, Any] = {}
+        content_hash = None
+        try:
+            text = read_image_text(self.root / rel)
+            content_hash = text.get("content_hash") or None
+            params = text.get("parameters", "")
+            if params:
+                meta = parse_parameters(params)
+        except Exception:
+            meta = {}
+        row = (rel, rel.rsplit("/", 1)[-1], character, date_folder, int(st.st_mtime), int(st.st_size), meta.get("seed"),
+               meta.get("model"), content_hash)
+        fts = None
+        if meta:
+            fts = (meta.get("prompt") or "", meta.get("negative_prompt") or "", " ".join(meta.get("loras") or []), meta.get("model") or "")
+        return row, fts
+
+    def _write_entries(self, entries: List[Tuple[tuple, Optional[tuple]]]):
+        """Escribe filas (y su FTS) bajo lock. Llamar sin tener el lock tomado."""
+        with self._lock:
+            for row, fts in entries:
+                self._conn.execute(UPSERT_SQL, row)
+                if self.fts_enabled:
+                    rowid = self._conn.execute("SELECT rowid FROM images WHERE path = ?", (row[0],)).fetchone()[0]
+                    if fts is None:
+                        self._conn.execute("DELETE FROM images_fts WHERE rowid = ?", (rowid,))
+                    else:
+                        self._conn.execute(
+                            "INSERT OR REPLACE INTO images_fts(rowid, prompt, negative_prompt, loras, checkpoint) VALUES (?, ?, ?, ?, ?)",
+                            (rowid,) + fts,
+                        )
+            if entries:
+                self._bump_locked()
+            self._conn.commit()
+
+    def upsert_file(self, path: Any) -> bool:
+        """Indexa (o actualiza) un archivo concreto. Devuelve False si no aplica."""
+        rel = self.to_rel(path)
+        if not rel or os.path.splitext(rel)[1].lower() not in IMAGE_EXTS:
+            return False
+        try:
+            st = (self.root / rel).stat()
+        except OSError:
+            return self.remove(rel)
+        self._write_entries([self._entry_for(rel, st)])
+        return True
+
+    def remove(self, path: Any) -> bool:
+        rel = self.to_rel(path)
+        if not rel:
+            return False
+        with self._lock:
+            cur = self._conn.execute("DELETE FROM images WHERE path = ? OR path LIKE ? ESCAPE '\\'", (rel, _like_prefix(rel + "/")))
+            if cur.rowcount > 0:
+                self._bump_locked()
+            self._conn.commit()
+            return cur.rowcount > 0
+
+    def reconcile(self, pause: float = 0.0) -> Dict[str, int]:
+        """
+        Recorre OUTPUTS_DIR una vez y sincroniza el índice (altas, cambios y bajas).
+        El recorrido se hace sin lock; solo las escrituras por lotes lo toman.
+        - pause: segundos a ceder por cada carpeta recorrida (barrido de baja prioridad).
+        """
+        if not self.root or not self.root.exists():
+            return {"added": 0, "updated": 0, "removed": 0}
+        started = time.time()
+        with self._lock:
+            # Filas sin metadatos (índices previos a la búsqueda) se tratan como cambiadas
+            known = {
+                r["path"]: (r["mtime"], r["size"]) if r["meta_indexed"] else None
+                for r in self._conn.execute("SELECT path, mtime, size, meta_indexed FROM images")
+            }
+        seen = set()
+        pending: List[Tuple[tuple, Optional[tuple]]] = []
+        added = updated = 0
+        for dirpath, _, files in os.walk(self.root):
+            if pause:
+                time.sleep(pause)
+            for fname in files:
+                if os.path.splitext(fname)[1].lower() not in IMAGE_EXTS:
+                    continue
+                fpath = os.path.join(dirpath, fname)
+                rel = os.path.relpath(fpath, self.root).replace("\\", "/")
+                try:
+                    st = os.stat(fpath)
+                except OSError:
+                    continue
+                seen.add(rel)
+                prev = known.get(rel, False)
+                if prev is False:
+                    added += 1
+                elif prev != (int(st.st_mtime), int(st.st_size)):
+                    updated += 1
+                else:
+                    continue
+                pending.append(self._entry_for(rel, st))
+                if len(pending) >= 500:
+                    self._write_entries(pending)
+                    pending = []
+        if pending:
+            self._write_entries(pending)
+        # Bajas: revalidar en disco para no borrar archivos creados durante el recorrido
+        missing = [(p,) for p in known.keys() if p not in seen and not (self.root / p).exists()]
+        with self._lock:
+            if missing:
+                self._conn.executemany("DELETE FROM images WHERE path = ?", missing)
+                self._bump_locked()
+            self._set_meta("last_reconciled", str(time.time()))
+            self._conn.commit()
+        stats = {"added": added, "updated": updated, "removed": len(missing)}
+        print(f"[GalleryIndex] Reconciliado en {time.time() - started:.1f}s: {stats}")
+        return stats
+
+    # == Lectura ==
+
+    def count(self) -> int:
+        with self._lock:
+            return int(self._conn.execute("SELECT COUNT(*) FROM images").fetchone()[0])
+
+    def characters(self) -> List[str]:
+        with self._lock:
+            rows = self._conn.execute("SELECT DISTINCT character FROM images WHERE character != '' ORDER BY character").fetchall()
+        return [r["character"] for r in rows]
+
+    def query(self, prefix: str = "", character: Optional[str] = None, limit: int = 100, offset: int = 0,
+              cursor: Optional[Tuple[int, str]] = None, date_from: Optional[int] = None,
+              date_to: Optional[int] = None) -> List[Dict[str, Any]]:
+        """
+        Devuelve filas ordenadas por (mtime, path) descendente.
+        - prefix: subcarpeta relativa a OUTPUTS_DIR (override_base) sin '/' final.
+        - character: nombre "bonito" del personaje relativo a prefix ('_' equivale a ' ').
+        - cursor: (mtime, path) de la última fila vista; paginación por clave (ignora offset).
+        - date_from/date_to: epoch inclusivo/exclusivo; además descarta carpetas YYYYMMDD fuera
+          del rango (mismo criterio que el recorrido sin índice).
+        """
+        where: List[str] = []
+        args: List[Any] = []
+        if cursor is not None:
+            where.append("(mtime, path) < (?, ?)")
+            args.extend([int(cursor[0]), cursor[1]])
+            offset = 0
+        if date_from is not None:
+            where.append("mtime >= ?")
+            args.append(int(date_from))
+        if date_to is not None:
+            where.append("mtime < ?")
+            args.append(int(date_to))
+        lo, hi = date_folder_bounds(date_from, date_to)
+        if lo is not None:
+            where.append("(date_folder IS NULL OR date_folder >= ?)")
+            args.append(lo)
+        if hi is not None:
+            where.append("(date_folder IS NULL OR date_folder <= ?)")
+            args.append(hi)
+        prefix = (prefix or "").strip("/")
+        if prefix:
+            first = prefix.split("/")[0]
+            # El primer segmento es la columna personaje: permite usar idx_images_character
+            where.append("character = ?")
+            args.append(first)
+            if "/" in prefix:
+                where.append("path LIKE ? ESCAPE '\\'")
+                args.append(_like_prefix(prefix + "/"))
+        if character and character.strip():
+            cc = character.strip().lower()
+            if prefix:
+                # Personaje relativo a la base: siguiente segmento tras el prefijo
+                where.append("lower(replace(substr(path, ?), '_', ' ')) LIKE ? ESCAPE '\\'")
+                args.extend([len(prefix) + 2, _like_escape(cc) + "/%"])
+            else:
+                names = [c for c in self.characters() if c.replace("_", " ").lower() == cc]
+                if not names:
+                    return []
+                where.append(f"character IN ({', '.join('?' for _ in names)})")
+                args.extend(names)
+        sql = "SELECT path, filename, character, date_folder, mtime, size FROM images"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY mtime DESC, path DESC LIMIT ? OFFSET ?"
+        args.extend([int(limit), int(offset)])
+        with self._lock:
+            rows = self._conn.execute(sql, args).fetchall()
+        return [dict(r) for r in rows]
+
+    def iter_query(self, prefix: str = "", character: Optional[str] = None, cursor: Optional[Tuple[int, str]] = None,
+                   batch_size: int = 500, date_from: Optional[int] = None,
+                   date_to: Optional[int] = None) -> Iterator[Dict[str, Any]]:
+        """Recorre todos los resultados de query() por lotes (keyset), sin retener el lock entre lotes."""
+        while True:
+            rows = self.query(prefix, character, batch_size, 0, cursor, date_from, date_to)
+            yield from rows
+            if len(rows) < batch_size:
+                return
+            cursor = (rows[-1]["mtime"], rows[-1]["path"])
+
+    def search(self, q: Optional[str] = None, lora: Optional[str] = None, seed: Optional[int] = None,
+               checkpoint: Optional[str] = None, date_from: Optional[int] = None, date_to: Optional[int] = None,
+               character: Optional[str] = None, limit: int = 50, offset: int = 0) -> List[Dict[str, Any]]:
+        """
+        Búsqueda sobre los parámetros de generación indexados.
+        - q: tokens del prompt (todos deben aparecer), ordenado por relevancia (bm25).
+        - lora / checkpoint: frase (con prefijo) dentro de las columnas loras / checkpoint.
+        - seed: igualdad exacta. date_from/date_to: epoch (mtime) inclusivo/exclusivo.
+        Sin q, el orden es por fecha descendente.
+        """
+        match_parts: List[str] = []
+        q_tokens = RE_FTS_TOKEN.findall(q or "")
+        if q_tokens:
+            match_parts.append("prompt : (" + " AND ".join(_fts_quote(t) for t in q_tokens) + ")")
+        for column, value in (("loras", lora), ("checkpoint", checkpoint)):
+            tokens = RE_FTS_TOKEN.findall(value or "")
+            if tokens:
+                # Prefijo en el último token: "illustrious" encuentra "illustriousXL_v1"
+                match_parts.append(f"{column} : " + _fts_quote(" ".join(tokens)) + " *")
+        if match_parts and not self.fts_enabled:
+            raise RuntimeError("FTS5 no disponible en este SQLite")
+
+        where: List[str] = []
+        args: List[Any] = []
+        if match_parts:
+            sql = ("SELECT i.path, i.filename, i.character, i.date_folder, i.mtime, i.size, i.seed, i.checkpoint, "
+                   "bm25(images_fts) AS rank FROM images_fts JOIN images i ON i.rowid = images_fts.rowid")
+            where.append("images_fts MATCH ?")
+            args.append(" AND ".join(match_parts))
+        else:
+            sql = "SELECT i.path, i.filename, i.character, i.date_folder, i.mtime, i.size, i.seed, i.checkpoint, NULL AS rank FROM images i"
+        if seed is not None:
+            where.append("i.seed = ?")
+            args.append(int(seed))
+        if date_from is not None:
+            where.append("i.mtime >= ?")
+            args.append(int(date_from))
+        if date_to is not None:
+            where.append("i.mtime < ?")
+            args.append(int(date_to))
+        if character and character.strip():
+            cc = character.strip().lower()
+            names = [c for c in self.characters() if c.replace("_", " ").lower() == cc or c.lower() == cc]
+            if not names:
+                return []
+            where.append(f"i.character IN ({', '.join('?' for _ in names)})")
+            args.extend(names)
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY rank, i.mtime DESC, i.path DESC" if match_parts else " ORDER BY i.mtime DESC, i.path DESC"
+        sql += " LIMIT ? OFFSET ?"
+        args.extend([int(limit), int(offset)])
+        with self._lock:
+            rows = self._conn.execute(sql, args).fetchall()
+        return [dict(r) for r in rows]
+
+    def stats(self, character: Optional[str] = None) -> Dict[str, Any]:
+        """Conteo, bytes y último timestamp por personaje y por día (desde image_stats)."""
+        where, args = "", []
+        if character:
+            where, args = " WHERE character = ?", [character]
+        with self._lock:
+            total = self._conn.execute(
+                f"SELECT COALESCE(SUM(count), 0) AS count, COALESCE(SUM(bytes), 0) AS bytes, MAX(latest) AS latest FROM image_stats{where}", args
+            ).fetchone()
+            by_character = self._conn.execute(
+                f"SELECT character, SUM(count) AS count, SUM(bytes) AS bytes, MAX(latest) AS latest FROM image_stats{where} "
+                "GROUP BY character ORDER BY count DESC", args
+            ).fetchall()
+            by_day = self._conn.execute(
+                f"SELECT date_folder AS date, SUM(count) AS count, SUM(bytes) AS bytes, MAX(latest) AS latest FROM image_stats{where} "
+                "GROUP BY date_folder ORDER BY date_folder DESC", args
+            ).fetchall()
+            by_character_day = self._conn.execute(
+                f"SELECT character, date_folder AS date, count, bytes, latest FROM image_stats{where} "
+                "ORDER BY date_folder DESC, character", args
+            ).fetchall()
+        return {
+            "total": dict(total),
+            "by_character": [dict(r) for r in by_character],
+            "by_day": [dict(r) for r in by_day],
+            "by_character_day": [dict(r) for r in by_character_day],
+        }
+
+    def paths_for_content_hash(self, content_hash: str, limit: int = 50) -> List[str]:
+        """Rutas absolutas de las imágenes guardadas con ese hash de payload (chunk 'content_hash')."""
+        if not self.root:
+            return []
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT path FROM images WHERE content_hash = ? ORDER BY mtime DESC, path LIMIT ?",
+                (content_hash, int(limit)),
+            ).fetchall()
+        return [str(self.root / r["path"]) for r in rows]
+
+    # == Hashes perceptuales (ver services/phash.py) ==
+
+    def paths_missing_hash(self, limit: int) -> List[Tuple[str, int]]:
+        """Imágenes sin hash o cuyo archivo cambió desde que se calculó."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT i.path, i.mtime FROM images i LEFT JOIN image_hashes h ON h.path = i.path "
+                "WHERE h.path IS NULL OR h.mtime != i.mtime LIMIT ?",
+                (int(limit),),
+            ).fetchall()
+        return [(r["path"], r["mtime"]) for r in rows]
+
+    def store_hashes(self, rows: List[Tuple[str, int, int]]):
+        """rows: (path, hash de 64 bits o -1 si ilegible, mtime). Ilegible se guarda como NULL."""
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO image_hashes(path, dhash, mtime) "
+                "SELECT ?, ?, ? WHERE EXISTS (SELECT 1 FROM images WHERE path = ?)",
+                [(p, _to_signed64(h) if h >= 0 else None, m, p) for p, h, m in rows],
+            )
+            self._conn.commit()
+
+    def all_hashes(self) -> List[Tuple[str, int]]:
+        with self._lock:
+            rows = self._conn.execute("SELECT path, dhash FROM image_hashes WHERE dhash IS NOT NULL").fetchall()
+        return [(r["path"], _to_unsigned64(r["dhash"])) for r in rows]
+
+    def hashes_for(self, paths: List[str]) -> Dict[str, int]:
+        out: Dict[str, int] = {}
+        with self._lock:
+            for i in range(0, len(paths), 500):
+                chunk = paths[i:i + 500]
+                rows = self._conn.execute(
+                    f"SELECT path, dhash FROM image_hashes WHERE dhash IS NOT NULL AND path IN ({', '.join('?' for _ in chunk)})",
+                    chunk,
+                ).fetchall()
+                out.update((r["path"], _to_unsigned64(r["dhash"])) for r in rows)
+        return out
+
+    def hash_counts(self) -> Dict[str, int]:
+        with self._lock:
+            hashed = self._conn.execute("SELECT COUNT(*) FROM image_hashes").fetchone()[0]
+            total = self._conn.execute("SELECT COUNT(*) FROM images").fetchone()[0]
+        return {"hashed": int(hashed), "pending": max(0, int(total) - int(hashed))}
+
+
+# SQLite guarda enteros con signo de 64 bits
+def _to_signed64(value: int) -> int:
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def _to_unsigned64(value: int) -> int:
+    return value & ((1 << 64) - 1)
+
+
+def encode_cursor(mtime: int, path: str) -> str:
+    """Cursor opaco (base64url) para paginación por clave (mtime, path)."""
+    raw = json.dumps([int(mtime), path], separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(token: str) -> Tuple[int, str]:
+    try:
+        padded = token + "=" * (-len(token) % 4)
+        mtime, path = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+        return int(mtime), str(path)
+    except Exception:
+        raise ValueError("cursor inválido")
+
+
+def _fts_quote(value: str) -> str:
+    return '"' + value.replace('"', '""') + '"'
+
+
+def _like_escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def _like_prefix(prefix: str) -> str:
+    return _like_escape(prefix) + "%"
@@ -0,0 +1,132 @@
+import asyncio
+import time
+from typing import Any, Dict, Optional
+
+from services.gallery_index import GalleryIndex
+
+# watchdog es opcional: sin él solo queda el barrido periódico
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except Exception:
+    Observer = None
+    FileSystemEventHandler = object
+
+
+class _IndexEventHandler(FileSystemEventHandler):
+    """Traduce eventos del sistema de archivos a altas/bajas en el índice."""
+
+    def __init__(self, index: GalleryIndex):
+        super().__init__()
+        self.index = index
+
+    def _apply(self, path: str, deleted: bool = False):
+        try:
+            if deleted:
+                self.index.remove(path)
+            else:
+                self.index.upsert_file(path)
+        except Exception as e:
+            print(f"[GalleryWatcher] Error aplicando evento {path}: {e}")
+
+    def on_created(self, event):
+        if not event.is_directory:
+            self._apply(event.src_path)
+
+    def on_modified(self, event):
+        if not event.is_directory:
+            self._apply(event.src_path)
+
+    def on_deleted(self, event):
+        self._apply(event.src_path, deleted=True)
+
+    def on_moved(self, event):
+        self._apply(event.src_path, deleted=True)
+        if not event.is_directory:
+            self._apply(event.dest_path)
+
+
+class GalleryWatcher:
+    """
+    Mantiene el índice de galería sincronizado con OUTPUTS_DIR sin bloquear requests:
+    - Observer de watchdog (si está instalado) para altas/bajas en tiempo real.
+    - Barrido de reconciliación periódico y de baja prioridad como respaldo
+      (cubre archivos copiados a mano, eventos perdidos o ausencia de watchdog).
+    """
+
+    def __init__(self, index: GalleryIndex, interval: Optional[float] = None):
+        self.index = index
+        default_interval = 1800.0 if Observer is not None else 120.0
+        self.interval = float(interval) if interval else default_interval
+        self.reconciling = False
+        self.last_stats: Dict[str, int] = {}
+        self._observer = None
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def mode(self) -> str:
+        return "watchdog" if self._observer is not None else "polling"
+
+    def start(self):
+        root = self.index.root
+        if root is None or not root.exists():
+            print("[GalleryWatcher] OUTPUTS_DIR no existe; watcher desactivado")
+            return
+        if Observer is not None and self._observer is None:
+            try:
+                observer = Observer()
+                observer.schedule(_IndexEventHandler(self.index), str(root), recursive=True)
+                observer.daemon = True
+                observer.start()
+                self._observer = observer
+            except Exception as e:
+                print(f"[GalleryWatcher] No se pudo iniciar watchdog ({e}); solo barrido periódico")
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._loop())
+        print(f"[GalleryWatcher] Activo (modo={self.mode}, barrido cada {int(self.interval)}s)")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._task = None
+        if self._observer is not None:
+            try:
+                self._observer.stop()
+                await asyncio.to_thread(self._observer.join, 5)
+            except Exception:
+                pass
+            self._observer = None
+
+    async def reconcile_now(self) -> Dict[str, int]:
+        """Ejecuta un barrido en un hilo (si ya hay uno en curso, no lanza otro)."""
+        if self.reconciling:
+            return self.last_stats
+        self.reconciling = True
+        try:
+            self.last_stats = await asyncio.to_thread(self.index.reconcile, 0.002)
+        except Exception as e:
+            print(f"[GalleryWatcher] Error en reconciliación: {e}")
+        finally:
+            self.reconciling = False
+        return self.last_stats
+
+    async def _loop(self):
+        # Primer barrido inmediato (en segundo plano), luego según intervalo
+        while True:
+            await self.reconcile_now()
+            await asyncio.sleep(self.interval)
+
+    def status(self) -> Dict[str, Any]:
+        last = self.index.last_reconciled()
+        return {
+            "mode": self.mode,
+            "reconciling": self.reconciling,
+            "last_reconciled": last,
+            "seconds_since_reconcile": (time.time() - last) if last else None,
+            "interval": self.interval,
+            "last_stats": self.last_stats,
+        }
@@ -0,0 +1,86 @@
+import asyncio
+import base64
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+from services.png_meta import add_png_text
+
+
+def write_image(directory: str, stem: str, image_b64: str, fsync: bool = True,
+                text: Optional[Dict[str, str]] = None) -> Tuple[str, float, float]:
+    """
+    Decodifica y escribe una imagen base64 como <directory>/<stem>.png (se ejecuta en el pool).
+    Creación exclusiva ('xb'): si el nombre existe se agrega _1, _2... sin pisar archivos,
+    aunque varios hilos guarden en el mismo segundo.
+    text agrega chunks tEXt (p. ej. content_hash) sin recomprimir la imagen.
+    Devuelve (ruta, segundos de decode, segundos de escritura + fsync).
+    """
+    t0 = time.perf_counter()
+    data = base64.b64decode(image_b64)
+    if text:
+        data = add_png_text(data, text)
+    t1 = time.perf_counter()
+    folder = Path(directory)
+    folder.mkdir(parents=True, exist_ok=True)
+    target = folder / f"{stem}.png"
+    n = 1
+    while True:
+        try:
+            with open(target, "xb") as fh:
+                fh.write(data)
+                if fsync:
+                    fh.flush()
+                    os.fsync(fh.fileno())
+            return str(target), t1 - t0, time.perf_counter() - t1
+        except FileExistsError:
+            target = folder / f"{stem}_{n}.png"
+            n += 1
+
+
+class ImageWriter:
+    """
+    Etapa de guardado de la fábrica: decode + escritura + fsync en un pool de hilos acotado,
+    fuera del event loop (status/progress siguen respondiendo mientras se guardan varios MB).
+    """
+
+    def __init__(self, workers: Optional[int] = None, fsync: bool = True):
+        # Trabajo dominado por E/S (write + fsync): más hilos que núcleos no estorba
+        self.workers = max(1, workers or 4)
+        self.fsync = fsync
+        self._pool: Optional[ThreadPoolExecutor] = None
+        self.saved_total = 0
+        self.pending = 0
+
+    def _get_pool(self) -> ThreadPoolExecutor:
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="image-writer")
+        return self._pool
+
+    async def save(self, directory: Path, stem: str, image_b64: str, span: Any = None,
+                   text: Optional[Dict[str, str]] = None) -> Path:
+        """Guarda la imagen; si se pasa un JobSpan le suma las etapas 'decode' y 'write'."""
+        loop = asyncio.get_running_loop()
+        self.pending += 1
+        try:
+            path, decode_s, write_s = await loop.run_in_executor(
+                self._get_pool(), write_image, str(directory), stem, image_b64, self.fsync, text
+            )
+        finally:
+            self.pending -= 1
+        self.saved_total += 1
+        if span is not None:
+            span.add("decode", decode_s)
+            span.add("write", write_s)
+        return Path(path)
+
+    def shutdown(self):
+        if self._pool is not None:
+            # Esperar las escrituras en curso: cortar un PNG a medias lo deja corrupto
+            self._pool.shutdown(wait=True)
+            self._pool = None
+
+    def status(self) -> Dict[str, Any]:
+        return {"workers": self.workers, "fsync": self.fsync, "pending": self.pending, "saved": self.saved_total}
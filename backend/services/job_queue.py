@@ -0,0 +1,391 @@
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+# Estados de un job: pending -> running -> done | failed | cancelled
+JOB_STATUSES = ("pending", "running", "done", "failed", "cancelled")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    batch_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    character TEXT NOT NULL,
+    job TEXT NOT NULL,
+    config TEXT,
+    result_paths TEXT,
+    error TEXT,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status, id);
+CREATE INDEX IF NOT EXISTS idx_jobs_batch ON jobs(batch_id, position);
+"""
+
+
+class JobQueue:
+    """
+    Cola persistente (SQLite) de trabajos de la fábrica.
+    Cada fila guarda el PlannerJob y su GroupConfigItem serializados, el estado, los intentos
+    y las rutas generadas, de modo que un reinicio del backend no pierde la producción:
+    al arrancar, recover() devuelve a 'pending' lo que quedó 'running'.
+    Los métodos son síncronos: desde endpoints async se llaman vía asyncio.to_thread.
+    """
+
+    def __init__(self, db_path: Path):
+        self.db_path = Path(db_path)
+        self._lock = threading.Lock()
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+        self._migrate()
+
+    def _migrate(self):
+        """Agrega columnas nuevas a colas creadas por versiones anteriores."""
+        cols = {r["name"] for r in self._conn.execute("PRAGMA table_info(jobs)")}
+        for name, decl in (("endpoint", "TEXT"), ("checkpoint", "TEXT"), ("signature", "TEXT"), ("batch_key", "TEXT"),
+                           ("priority", "INTEGER NOT NULL DEFAULT 0"), ("weight", "REAL NOT NULL DEFAULT 1"),
+                           ("not_before", "REAL"), ("max_attempts", "INTEGER"),
+                           ("content_hash", "TEXT"), ("force", "INTEGER NOT NULL DEFAULT 0"), ("cached_from", "INTEGER")):
+            if name not in cols:
+                self._conn.execute(f"ALTER TABLE jobs ADD COLUMN {name} {decl}")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_signature ON jobs(status, signature, id)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_checkpoint ON jobs(status, checkpoint, id)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_batch_key ON jobs(status, batch_key, id)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_priority ON jobs(status, priority, id)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_content_hash ON jobs(content_hash, status, id)")
+        self._conn.commit()
+
+    def enqueue(self, items: List[Dict[str, Any]], priority: int = 0, weight: float = 1.0,
+                max_attempts: Optional[int] = None, force: bool = False) -> Tuple[str, List[int]]:
+        """
+        Encola un lote (un envío). Cada item: {"job", "config", "checkpoint", "signature", "batch_key"}
+        (signature = checkpoint/VAE/clip_skip que exige el job, para agrupar sin recargar modelos;
+        batch_key = igual para jobs que solo difieren en la seed, para generarlos en una sola llamada).
+        Los envíos de mayor prioridad se toman antes que cualquier otro pendiente; weight es su
+        parte relativa en el reparto justo entre envíos de igual prioridad (ver FairShare);
+        max_attempts reemplaza el límite de intentos de la RetryPolicy para estos jobs; force los
+        regenera aunque la caché de resultados ya tenga su salida.
+        Devuelve (batch_id, ids) en orden.
+        """
+        batch_id = uuid.uuid4().hex[:12]
+        now = time.time()
+        ids: List[int] = []
+        with self._lock:
+            for pos, item in enumerate(items):
+                job, config = item["job"], item.get("config")
+                cur = self._conn.execute(
+                    "INSERT INTO jobs(batch_id, position, character, job, config, checkpoint, signature, batch_key, priority, weight, "
+                    "max_attempts, force, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (batch_id, pos, str(job.get("character_name") or ""), json.dumps(job, ensure_ascii=False),
+                     json.dumps(config, ensure_ascii=False) if config else None,
+                     item.get("checkpoint"), item.get("signature"), item.get("batch_key"), int(priority), float(weight),
+                     int(max_attempts) if max_attempts else None, int(bool(force)), now),
+                )
+                ids.append(int(cur.lastrowid))
+            self._conn.commit()
+        return batch_id, ids
+
+    def claim_next(self, endpoint: Optional[str] = None, prefer_signature: Optional[str] = None,
+                   prefer_checkpoint: Optional[str] = None, scheduler: Optional[Any] = None) -> Optional[Dict[str, Any]]:
+        """Toma un único job pendiente (ver claim_batch)."""
+        rows = self.claim_batch(endpoint, prefer_signature, prefer_checkpoint, 1, scheduler)
+        return rows[0] if rows else None
+
+    def claim_batch(self, endpoint: Optional[str] = None, prefer_signature: Optional[str] = None,
+                    prefer_checkpoint: Optional[str] = None, max_size: int = 1,
+                    scheduler: Optional[Any] = None) -> List[Dict[str, Any]]:
+        """
+        Toma el siguiente job pendiente y, si max_size > 1, hasta max_size - 1 jobs pendientes más
+        con su mismo batch_key (del mismo envío y prioridad); los marca 'running' y suma un intento.
+        ReForge genera un lote con seed, seed+1, ...: solo se suman jobs con las seeds consecutivas
+        a la del primero (o, si la suya es aleatoria, otros con seed aleatoria), y se devuelven en ese orden.
+        Solo se consideran los pendientes listos (sin backoff en curso) de la prioridad más alta. Dentro de ella, FIFO; con
+        prefer_signature / prefer_checkpoint toma primero el más antiguo de ese grupo (orden de envío
+        preservado dentro del grupo) y si no hay, el más antiguo.
+        Con scheduler (FairShare) el orden entre envíos/personajes lo decide el reparto justo, que
+        recibe las mismas preferencias; dentro del flujo elegido se mantiene el orden de envío.
+        El lock hace atómica la toma: varios workers del pool nunca reciben el mismo job.
+        """
+        with self._lock:
+            now = time.time()
+            top = self._conn.execute(f"SELECT MAX(priority) AS p FROM jobs WHERE {_READY}", (now,)).fetchone()["p"]
+            if top is None:
+                return []
+            row = None
+            flow = None
+            if scheduler is not None:
+                flows = [dict(r) for r in self._conn.execute(
+                    "SELECT batch_id, character, signature, checkpoint, MIN(id) AS first_id, MIN(created_at) AS oldest, "
+                    f"MAX(weight) AS weight FROM jobs WHERE {_READY} AND priority = ? "
+                    "GROUP BY batch_id, character, signature",
+                    (now, top),
+                )]
+                flow = scheduler.pick(flows, prefer_signature, prefer_checkpoint)
+                if flow is not None:
+                    row = self._conn.execute("SELECT id, batch_key, batch_id, job FROM jobs WHERE id = ?", (flow["first_id"],)).fetchone()
+            elif prefer_signature is not None:
+                row = self._conn.execute(
+                    f"SELECT id, batch_key, batch_id, job FROM jobs WHERE {_READY} AND priority = ? AND signature = ? ORDER BY id LIMIT 1",
+                    (now, top, prefer_signature),
+                ).fetchone()
+            if row is None and prefer_checkpoint:
+                row = self._conn.execute(
+                    f"SELECT id, batch_key, batch_id, job FROM jobs WHERE {_READY} AND priority = ? AND checkpoint = ? ORDER BY id LIMIT 1",
+                    (now, top, prefer_checkpoint),
+                ).fetchone()
+            if row is None:
+                row = self._conn.execute(
+                    f"SELECT id, batch_key, batch_id, job FROM jobs WHERE {_READY} AND priority = ? ORDER BY id LIMIT 1",
+                    (now, top),
+                ).fetchone()
+            if row is None:
+                return []
+            ids = [row["id"]]
+            if row["batch_key"] and max_size > 1:
+                # Solo del mismo envío y prioridad: un lote nunca mezcla envíos (cancelación por envío)
+                more = self._conn.execute(
+                    f"SELECT id, job FROM jobs WHERE {_READY} AND batch_key = ? AND batch_id = ? AND priority = ? "
+                    "AND id != ? ORDER BY id",
+                    (now, row["batch_key"], row["batch_id"], top, row["id"]),
+                ).fetchall()
+                ids.extend(_consecutive_seeds(_job_seed(row["job"]), more, int(max_size) - 1))
+            marks = ", ".join("?" for _ in ids)
+            self._conn.execute(
+                "UPDATE jobs SET status = 'running', attempts = attempts + 1, started_at = ?, error = NULL, endpoint = ?, "
+                f"not_before = NULL WHERE id IN ({marks})",
+                (now, endpoint, *ids),
+            )
+            self._conn.commit()
+            rows = [_decode(r) for r in self._conn.execute(f"SELECT * FROM jobs WHERE id IN ({marks})", ids)]
+            # Orden del lote = orden de seeds (la imagen k de ReForge sale con seed + k)
+            rows.sort(key=lambda r: ids.index(r["id"]))
+            if flow is not None:
+                # Solo se descuenta el flujo que eligió el reparto justo
+                scheduler.charge([r for r in rows if r["batch_id"] == flow["batch_id"]
+                                  and (r.get("character") or "") == (flow.get("character") or "")])
+        return rows
+
+    def complete(self, job_id: int, result_paths: List[str], content_hash: Optional[str] = None,
+                 cached_from: Optional[int] = None):
+        """Marca el job como hecho. content_hash (hash del payload txt2img resuelto) alimenta la caché de
+        resultados; cached_from indica el job cuya salida se reutilizó en vez de generar."""
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status = 'done', result_paths = ?, finished_at = ?, "
+                "content_hash = COALESCE(?, content_hash), cached_from = ? WHERE id = ?",
+                (json.dumps(result_paths, ensure_ascii=False), time.time(), content_hash, cached_from, int(job_id)),
+            )
+            self._conn.commit()
+
+    def results_for(self, content_hash: str, limit: int = 5) -> List[Dict[str, Any]]:
+        """Jobs hechos con ese hash de payload y con imágenes (más recientes primero)."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT * FROM jobs WHERE content_hash = ? AND status = 'done' AND result_paths IS NOT NULL "
+                "AND result_paths != '[]' ORDER BY id DESC LIMIT ?",
+                (content_hash, int(limit)),
+            ).fetchall()
+        return [_decode(r) for r in rows]
+
+    def fail(self, job_id: int, error: str, status: str = "failed"):
+        """Marca el job como fallido (o 'cancelled' si se detuvo a mitad de camino)."""
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, finished_at = ? WHERE id = ?",
+                (status, str(error)[:2000], time.time(), int(job_id)),
+            )
+            self._conn.commit()
+
+    def release(self, job_id: int, error: Optional[str] = None):
+        """Devuelve un job 'running' a 'pending' sin consumir el intento (la instancia no respondió)."""
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status = 'pending', attempts = MAX(attempts - 1, 0), started_at = NULL, error = ? "
+                "WHERE id = ? AND status = 'running'",
+                (error, int(job_id)),
+            )
+            self._conn.commit()
+
+    def retry(self, job_id: int, error: str, delay: float):
+        """Devuelve un job 'running' a 'pending' gastando el intento; no se toma antes de 'delay' segundos."""
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status = 'pending', started_at = NULL, error = ?, not_before = ? "
+                "WHERE id = ? AND status = 'running'",
+                (str(error)[:2000], time.time() + max(0.0, float(delay)), int(job_id)),
+            )
+            self._conn.commit()
+
+    def next_ready_at(self) -> Optional[float]:
+        """Momento en que vence el próximo backoff entre los pendientes (None si no hay ninguno esperando)."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT MIN(not_before) AS t FROM jobs WHERE status = 'pending' AND not_before > ?", (time.time(),)
+            ).fetchone()
+        return row["t"]
+
+    def requeue(self, ids: Optional[List[int]] = None, batch_id: Optional[str] = None,
+                status: str = "failed") -> int:
+        """
+        Vuelve a encolar jobs terminados en 'status' (por defecto los fallidos), desde cero: intentos,
+        error y backoff reiniciados. Filtra por ids o batch_id; sin filtros, todos. Devuelve cuántos afectó.
+        """
+        where = ["status = ?"]
+        args: List[Any] = [status]
+        if ids is not None:
+            if not ids:
+                return 0
+            where.append(f"id IN ({', '.join('?' for _ in ids)})")
+            args.extend(int(i) for i in ids)
+        if batch_id:
+            where.append("batch_id = ?")
+            args.append(batch_id)
+        with self._lock:
+            cur = self._conn.execute(
+                "UPDATE jobs SET status = 'pending', attempts = 0, error = NULL, not_before = NULL, started_at = NULL, "
+                "finished_at = NULL, result_paths = NULL WHERE " + " AND ".join(where),
+                args,
+            )
+            self._conn.commit()
+        return cur.rowcount
+
+    def cancel_pending(self, reason: str = "Cancelado", max_id: Optional[int] = None) -> int:
+        """
+        Cancela lo pendiente (parada de emergencia). Devuelve cuántos jobs afectó.
+        Con max_id solo toca jobs con id <= max_id: lo encolado después de la parada sigue en la cola.
+        """
+        sql = "UPDATE jobs SET status = 'cancelled', error = ?, finished_at = ? WHERE status = 'pending'"
+        args: list = [reason, time.time()]
+        if max_id is not None:
+            sql += " AND id <= ?"
+            args.append(int(max_id))
+        with self._lock:
+            cur = self._conn.execute(sql, args)
+            self._conn.commit()
+        return cur.rowcount
+
+    def max_id(self) -> int:
+        """Id del último job encolado (0 si la cola nunca tuvo jobs)."""
+        with self._lock:
+            row = self._conn.execute("SELECT MAX(id) FROM jobs").fetchone()
+        return int(row[0] or 0)
+
+    def cancel_batch(self, batch_id: str, reason: str = "Cancelado") -> int:
+        """Cancela lo pendiente de un envío (el resto de la cola sigue). Devuelve cuántos jobs afectó."""
+        with self._lock:
+            cur = self._conn.execute(
+                "UPDATE jobs SET status = 'cancelled', error = ?, finished_at = ? WHERE status = 'pending' AND batch_id = ?",
+                (reason, time.time(), batch_id),
+            )
+            self._conn.commit()
+        return cur.rowcount
+
+    def recover(self) -> int:
+        """Devuelve a 'pending' los jobs que quedaron 'running' por un cierre inesperado."""
+        with self._lock:
+            cur = self._conn.execute(
+                "UPDATE jobs SET status = 'pending', started_at = NULL WHERE status = 'running'"
+            )
+            self._conn.commit()
+        return cur.rowcount
+
+    def counts(self) -> Dict[str, int]:
+        with self._lock:
+            rows = self._conn.execute("SELECT status, COUNT(*) AS n FROM jobs GROUP BY status").fetchall()
+        out = {s: 0 for s in JOB_STATUSES}
+        out.update({r["status"]: r["n"] for r in rows})
+        return out
+
+    def submissions(self, limit: int = 50, batch_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Envíos más recientes primero, con prioridad y conteo de jobs por estado."""
+        sql = ("SELECT batch_id, MAX(priority) AS priority, MAX(weight) AS weight, MIN(created_at) AS created_at, MAX(finished_at) AS finished_at, "
+               + ", ".join(f"SUM(status = '{s}') AS {s}" for s in JOB_STATUSES)
+               + " FROM jobs")
+        args: List[Any] = []
+        if batch_id:
+            sql += " WHERE batch_id = ?"
+            args.append(batch_id)
+        sql += " GROUP BY batch_id ORDER BY MIN(id) DESC LIMIT ?"
+        args.append(int(limit))
+        with self._lock:
+            rows = self._conn.execute(sql, args).fetchall()
+        out = []
+        for r in rows:
+            d = dict(r)
+            d["counts"] = {s: int(d.pop(s) or 0) for s in JOB_STATUSES}
+            d["total"] = sum(d["counts"].values())
+            out.append(d)
+        return out
+
+    def list(self, status: Optional[str] = None, batch_id: Optional[str] = None,
+             limit: int = 100, offset: int = 0) -> List[Dict[str, Any]]:
+        """Jobs más recientes primero, filtrando opcionalmente por estado o lote."""
+        where: List[str] = []
+        args: List[Any] = []
+        if status:
+            where.append("status = ?")
+            args.append(status)
+        if batch_id:
+            where.append("batch_id = ?")
+            args.append(batch_id)
+        sql = "SELECT * FROM jobs"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY id DESC LIMIT ? OFFSET ?"
+        args.extend([int(limit), int(offset)])
+        with self._lock:
+            rows = self._conn.execute(sql, args).fetchall()
+        return [_decode(r) for r in rows]
+
+
+# Pendiente y sin backoff en curso (parámetro: ahora)
+_READY = "status = 'pending' AND (not_before IS NULL OR not_before <= ?)"
+
+
+def _job_seed(raw: Optional[str]) -> Optional[int]:
+    try:
+        seed = json.loads(raw or "{}").get("seed")
+    except (ValueError, AttributeError):
+        return None
+    return seed if isinstance(seed, int) else None
+
+
+def _consecutive_seeds(first_seed: Optional[int], candidates: List[sqlite3.Row], limit: int) -> List[int]:
+    """Ids de candidatos cuyas seeds siguen a first_seed sin huecos (first+1, first+2, ...), hasta limit.
+    Con first_seed aleatoria (< 0) cualquier otro job de seed aleatoria sirve."""
+    if limit <= 0:
+        return []
+    if first_seed is None or first_seed < 0:
+        seeds = ((r["id"], _job_seed(r["job"])) for r in candidates)
+        return [job_id for job_id, seed in seeds if seed is None or seed < 0][:limit]
+    by_seed: Dict[int, int] = {}
+    for r in candidates:
+        seed = _job_seed(r["job"])
+        if seed is not None:
+            by_seed.setdefault(seed, r["id"])
+    out: List[int] = []
+    while len(out) < limit and first_seed + len(out) + 1 in by_seed:
+        out.append(by_seed[first_seed + len(out) + 1])
+    return out
+
+
+def _decode(row: sqlite3.Row) -> Dict[str, Any]:
+    d = dict(row)
+    for key in ("job", "config", "result_paths"):
+        if d.get(key):
+            try:
+                d[key] = json.loads(d[key])
+            except ValueError:
+                d[key] = None
+    return d
@@ -0,0 +1,223 @@
+import asyncio
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from services.gallery_index import GalleryIndex
+
+# NumPy es opcional: sin él se compara con listas de Python (más lento, mismo resultado)
+try:
+    import numpy as np
+except Exception:
+    np = None
+
+HASH_BITS = 64
+
+
+def dhash(path: Any, hash_size: int = 8) -> int:
+    """
+    Difference hash de 64 bits: escala de grises 9x8 y compara píxeles vecinos por fila.
+    Robusto a recompresión, reescalado leve y cambios de brillo.
+    """
+    from PIL import Image
+
+    with Image.open(path) as img:
+        img.draft("L", (hash_size * 16, hash_size * 16))
+        small = img.convert("L").resize((hash_size + 1, hash_size), Image.BILINEAR)
+    if np is not None:
+        arr = np.asarray(small, dtype=np.int16)
+        bits = (arr[:, 1:] > arr[:, :-1]).flatten()
+        return int("".join("1" if b else "0" for b in bits), 2)
+    px = list(small.getdata())
+    value = 0
+    for row in range(hash_size):
+        base = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (1 if px[base + col + 1] > px[base + col] else 0)
+    return value
+
+
+def hamming(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+class BKTree:
+    """Árbol BK sobre distancia de Hamming: busca vecinos a distancia <= d sin comparar contra todo."""
+
+    def __init__(self):
+        self._root: Optional[list] = None  # nodo: [hash, [items], {distancia: hijo}]
+        self.size = 0
+
+    def add(self, value: int, item: Any):
+        self.size += 1
+        if self._root is None:
+            self._root = [value, [item], {}]
+            return
+        node = self._root
+        while True:
+            d = hamming(value, node[0])
+            if d == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(d)
+            if child is None:
+                node[2][d] = [value, [item], {}]
+                return
+            node = child
+
+    def search(self, value: int, max_dist: int) -> List[Tuple[int, int, Any]]:
+        """Devuelve [(distancia, hash, item)] con distancia <= max_dist."""
+        out: List[Tuple[int, int, Any]] = []
+        if self._root is None:
+            return out
+        stack = [self._root]
+        while stack:
+            node = stack.pop()
+            d = hamming(value, node[0])
+            if d <= max_dist:
+                out.extend((d, node[0], it) for it in node[1])
+            for k, child in node[2].items():
+                if d - max_dist <= k <= d + max_dist:
+                    stack.append(child)
+        out.sort(key=lambda x: x[0])
+        return out
+
+    def hashes(self) -> Iterable[int]:
+        stack = [self._root] if self._root is not None else []
+        while stack:
+            node = stack.pop()
+            yield node[0]
+            stack.extend(node[2].values())
+
+
+class DuplicateDetector:
+    """
+    Trabajo en segundo plano que calcula el dHash de cada imagen indexada (tabla image_hashes)
+    y mantiene un árbol BK en memoria para el reporte de duplicados y "buscar similares".
+    El árbol solo crece; las entradas obsoletas se descartan verificando contra el índice.
+    El hilo de hashing y los requests (vía to_thread) comparten el árbol: todo acceso pasa por _lock.
+    """
+
+    def __init__(self, index: GalleryIndex, batch_size: int = 200, idle_interval: float = 60.0):
+        self.index = index
+        self.batch_size = batch_size
+        self.idle_interval = idle_interval
+        self._tree: Optional[BKTree] = None
+        self._in_tree: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self.hashed_total = 0
+        self.last_run: Optional[float] = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._task = None
+
+    async def _loop(self):
+        while True:
+            try:
+                done = await asyncio.to_thread(self.hash_pending, self.batch_size)
+            except Exception as e:
+                print(f"[Duplicates] Error calculando hashes: {e}")
+                done = 0
+            # Con trabajo pendiente sigue enseguida (cediendo), si no espera al siguiente ciclo
+            await asyncio.sleep(0.05 if done else self.idle_interval)
+
+    def hash_pending(self, limit: int) -> int:
+        """Calcula hashes de imágenes nuevas o modificadas. Devuelve cuántas procesó."""
+        pending = self.index.paths_missing_hash(limit)
+        if not pending:
+            return 0
+        results: List[Tuple[str, int, int]] = []
+        for rel, mtime in pending:
+            try:
+                h = dhash(self.index.root / rel)
+            except Exception:
+                h = -1  # ilegible: se marca para no reintentar hasta que cambie el mtime
+            results.append((rel, h, mtime))
+        self.index.store_hashes(results)
+        with self._lock:
+            if self._tree is not None:
+                for rel, h, _ in results:
+                    if h >= 0 and self._in_tree.get(rel) != h:
+                        self._tree.add(h, rel)
+                        self._in_tree[rel] = h
+        self.hashed_total += len(results)
+        self.last_run = time.time()
+        return len(results)
+
+    def _get_tree(self) -> BKTree:
+        """Árbol BK (se construye la primera vez). Llamar con _lock tomado."""
+        if self._tree is None:
+            tree = BKTree()
+            in_tree: Dict[str, int] = {}
+            for rel, h in self.index.all_hashes():
+                tree.add(h, rel)
+                in_tree[rel] = h
+            self._tree, self._in_tree = tree, in_tree
+        return self._tree
+
+    def _live(self, matches: List[Tuple[int, int, Any]]) -> List[Tuple[int, int, Any]]:
+        """Filtra coincidencias cuyo archivo ya no existe o cambió de hash."""
+        current = self.index.hashes_for([m[2] for m in matches])
+        return [m for m in matches if current.get(m[2]) == m[1]]
+
+    def similar(self, rel: str, max_dist: int = 8, limit: int = 50) -> List[Dict[str, Any]]:
+        """Imágenes similares a 'rel' (calcula su hash si aún no existe)."""
+        h = self.index.hashes_for([rel]).get(rel)
+        if h is None:
+            h = dhash(self.index.root / rel)
+        with self._lock:
+            found = self._get_tree().search(h, max_dist)
+        matches = self._live(found)
+        return [{"path": p, "distance": d} for d, _, p in matches if p != rel][:limit]
+
+    def duplicate_groups(self, max_dist: int = 4, limit: int = 200) -> List[Dict[str, Any]]:
+        """Agrupa imágenes a distancia <= max_dist (union-find sobre búsquedas en el árbol BK)."""
+        current = dict(self.index.all_hashes())
+        by_hash: Dict[int, List[str]] = {}
+        for rel, h in current.items():
+            by_hash.setdefault(h, []).append(rel)
+        parent: Dict[int, int] = {h: h for h in by_hash}
+
+        def find(x: int) -> int:
+            while parent[x] != x:
+                parent[x] = parent[parent[x]]
+                x = parent[x]
+            return x
+
+        if max_dist > 0:
+            with self._lock:
+                neighbours = {h: [other for _, other, _ in self._get_tree().search(h, max_dist)] for h in by_hash}
+            for h in by_hash:
+                for other in neighbours[h]:
+                    if other in parent and other != h:
+                        ra, rb = find(h), find(other)
+                        if ra != rb:
+                            parent[rb] = ra
+        clusters: Dict[int, List[str]] = {}
+        for h, paths in by_hash.items():
+            clusters.setdefault(find(h), []).extend(paths)
+        groups = [sorted(paths) for paths in clusters.values() if len(paths) > 1]
+        groups.sort(key=len, reverse=True)
+        return [{"count": len(g), "paths": g} for g in groups[:limit]]
+
+    def status(self) -> Dict[str, Any]:
+        counts = self.index.hash_counts()
+        return {
+            "running": self._task is not None and not self._task.done(),
+            "hashed": counts["hashed"],
+            "pending": counts["pending"],
+            "hashed_this_session": self.hashed_total,
+            "last_run": self.last_run,
+            "numpy": np is not None,
+        }
@@ -0,0 +1,177 @@
+import re
+import struct
+import zlib
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+TEXT_CHUNKS = {b"tEXt", b"zTXt", b"iTXt"}
+# Límite defensivo por chunk de texto (los 'parameters' de A1111 ocupan pocos KB)
+MAX_TEXT_CHUNK = 4 * 1024 * 1024
+
+# Formato A1111: "Clave: valor, Clave: "valor, con comas", ..."
+RE_PARAM = re.compile(r'\s*(\w[\w \-/]+):\s*("(?:\\.|[^\\"])+"|[^,]*)(?:,|$)')
+RE_LORA = re.compile(r"<lora:([^:>]+)(?::[^>]+)?>")
+
+
+def _decode_text_chunk(ctype: bytes, data: bytes) -> Optional[tuple]:
+    try:
+        if ctype == b"tEXt":
+            key, _, value = data.partition(b"\x00")
+            return key.decode("latin-1"), value.decode("latin-1")
+        if ctype == b"zTXt":
+            key, _, rest = data.partition(b"\x00")
+            # rest[0] = método de compresión (0 = zlib)
+            return key.decode("latin-1"), zlib.decompress(rest[1:]).decode("latin-1")
+        if ctype == b"iTXt":
+            key, _, rest = data.partition(b"\x00")
+            compressed, _method = rest[0], rest[1]
+            _lang, _, rest = rest[2:].partition(b"\x00")
+            _tkey, _, text = rest.partition(b"\x00")
+            if compressed:
+                text = zlib.decompress(text)
+            return key.decode("latin-1"), text.decode("utf-8", errors="replace")
+    except Exception:
+        return None
+    return None
+
+
+def read_png_text(path: Any) -> Dict[str, str]:
+    """
+    Lee los chunks de texto (tEXt/zTXt/iTXt) de un PNG recorriendo solo la cabecera:
+    se detiene al llegar a IDAT, sin decodificar píxeles.
+    """
+    out: Dict[str, str] = {}
+    with open(path, "rb") as f:
+        if f.read(8) != PNG_SIGNATURE:
+            return out
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                break
+            length, ctype = struct.unpack(">I4s", header)
+            if ctype in (b"IDAT", b"IEND"):
+                break
+            if ctype in TEXT_CHUNKS and length <= MAX_TEXT_CHUNK:
+                decoded = _decode_text_chunk(ctype, f.read(length))
+                f.seek(4, 1)  # CRC
+                if decoded:
+                    out[decoded[0]] = decoded[1]
+            else:
+                f.seek(length + 4, 1)
+    return out
+
+
+def png_text_chunk(key: str, value: str) -> bytes:
+    """Chunk tEXt (latin-1) con su CRC, listo para insertar en un PNG."""
+    data = key.encode("latin-1") + b"\x00" + value.encode("latin-1")
+    return struct.pack(">I4s", len(data), b"tEXt") + data + struct.pack(">I", zlib.crc32(b"tEXt" + data) & 0xFFFFFFFF)
+
+
+def add_png_text(data: bytes, text: Dict[str, str]) -> bytes:
+    """
+    Inserta chunks tEXt justo después de IHDR (antes de IDAT, donde read_png_text los encuentra)
+    sin decodificar píxeles. Si los bytes no son un PNG los devuelve sin cambios.
+    """
+    if not text or data[:8] != PNG_SIGNATURE or data[12:16] != b"IHDR":
+        return data
+    end = 8 + 8 + struct.unpack(">I", data[8:12])[0] + 4
+    return data[:end] + b"".join(png_text_chunk(k, v) for k, v in text.items()) + data[end:]
+
+
+def _decode_user_comment(raw: Any) -> str:
+    """Decodifica EXIF UserComment (prefijo de 8 bytes con el charset, estilo piexif)."""
+    if isinstance(raw, str):
+        return raw
+    if not isinstance(raw, (bytes, bytearray)):
+        return ""
+    prefix, body = bytes(raw[:8]), bytes(raw[8:])
+    if prefix.startswith(b"UNICODE"):
+        for enc in ("utf-16-be", "utf-16-le"):
+            try:
+                return body.decode(enc).rstrip("\x00")
+            except UnicodeDecodeError:
+                continue
+    return body.decode("utf-8", errors="replace").rstrip("\x00")
+
+
+def read_image_text(path: Any) -> Dict[str, str]:
+    """Metadatos de texto de una imagen: PNG por chunks; WebP/JPEG vía Pillow (sin img.load())."""
+    p = Path(path)
+    if p.suffix.lower() == ".png":
+        info = read_png_text(p)
+        if info:
+            return info
+    from PIL import Image
+
+    with Image.open(p) as img:
+        info = {k: v for k, v in (img.info or {}).items() if isinstance(v, str)}
+        if "parameters" not in info:
+            try:
+                comment = img.getexif().get_ifd(0x8769).get(0x9286)
+                text = _decode_user_comment(comment) if comment else ""
+                if text:
+                    info["parameters"] = text
+            except Exception:
+                pass
+    return info
+
+
+def parse_parameters(params: str) -> Dict[str, Any]:
+    """
+    Parsea el string 'parameters' de A1111/ReForge:
+    prompt, negative_prompt y la línea final "Steps: ..., Sampler: ..., Seed: ...".
+    """
+    result: Dict[str, Any] = {
+        "prompt": "",
+        "negative_prompt": "",
+        "steps": None,
+        "sampler": None,
+        "cfg_scale": None,
+        "seed": None,
+        "size": None,
+        "model": None,
+        "model_hash": None,
+        "loras": [],
+        "extra": {},
+    }
+    if not params:
+        return result
+    lines = params.strip().split("\n")
+    settings_line = ""
+    if lines and RE_PARAM.match(lines[-1]) and lines[-1].lstrip().startswith("Steps:"):
+        settings_line = lines.pop()
+    prompt_lines: List[str] = []
+    negative_lines: List[str] = []
+    target = prompt_lines
+    for line in lines:
+        if line.startswith("Negative prompt:"):
+            target = negative_lines
+            line = line[len("Negative prompt:"):].strip()
+        target.append(line)
+    result["prompt"] = "\n".join(prompt_lines).strip()
+    result["negative_prompt"] = "\n".join(negative_lines).strip()
+    result["loras"] = RE_LORA.findall(result["prompt"])
+
+    fields: Dict[str, str] = {}
+    for key, value in RE_PARAM.findall(settings_line):
+        value = value.strip()
+        if len(value) >= 2 and value[0] == '"' and value[-1] == '"':
+            value = value[1:-1]
+        fields[key.strip()] = value
+
+    def _num(key: str, cast):
+        try:
+            return cast(fields.pop(key))
+        except (KeyError, ValueError):
+            return None
+
+    result["steps"] = _num("Steps", int)
+    result["cfg_scale"] = _num("CFG scale", float)
+    result["seed"] = _num("Seed", int)
+    result["sampler"] = fields.pop("Sampler", None)
+    result["size"] = fields.pop("Size", None)
+    result["model"] = fields.pop("Model", None)
+    result["model_hash"] = fields.pop("Model hash", None)
+    result["extra"] = fields
+    return result
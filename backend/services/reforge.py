@@ -1,7 +1,8 @@
-from typing import Any, Dict, Optional, List
+from typing import Any, Dict, Optional, List, Tuple
 import httpx
 import json
 import os
+import time
 
 # URL base de ReForge parametrizada por .env
 BASE_URL = os.getenv("REFORGE_API_BASE_URL", "http://127.0.0.1:7860")
@@ -11,6 +12,42 @@ OPTIONS_ENDPOINT = "/sdapi/v1/options"
 INTERRUPT_ENDPOINT = "/sdapi/v1/interrupt"
 VAES_ENDPOINT = "/sdapi/v1/sd-vae"
 
+# Cliente HTTP compartido (keep-alive): se abre en el startup de la app y se cierra en el shutdown
+MAX_CONNECTIONS = int(os.getenv("REFORGE_MAX_CONNECTIONS", "20") or 20)
+# Vigencia (s) de la caché de /options; set_active_checkpoint y refresh_checkpoints la invalidan
+OPTIONS_CACHE_TTL = float(os.getenv("REFORGE_OPTIONS_TTL", "3") or 0)
+
+_client: Optional[httpx.AsyncClient] = None
+_options_cache: Dict[str, Tuple[float, Dict[str, Any]]] = {}
+
+
+def get_client() -> httpx.AsyncClient:
+    """Cliente con pool de conexiones reutilizado por todas las llamadas (se crea si aún no existe).
+    Cada llamada fija su propio timeout."""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            timeout=httpx.Timeout(30.0),
+            limits=httpx.Limits(max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_CONNECTIONS),
+        )
+    return _client
+
+
+async def close_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+    _options_cache.clear()
+
+
+def invalidate_options(base_url: Optional[str] = None):
+    """Descarta las opciones cacheadas de una instancia (o de todas)."""
+    if base_url is None:
+        _options_cache.clear()
+    else:
+        _options_cache.pop(base_url or BASE_URL, None)
+
 
 def build_txt2img_payload(prompt: Optional[str] = None,
                            negative_prompt: Optional[str] = None,
@@ -23,10 +60,12 @@ def build_txt2img_payload(prompt: Optional[str] = None,
                            hr_upscaler: Optional[str] = None,
                            hr_scale: Optional[float] = None,
                            width: Optional[int] = None,
-                           height: Optional[int] = None) -> Dict[str, Any]:
+                           height: Optional[int] = None,
+                           seed: Optional[int] = None) -> Dict[str, Any]:
     """Devuelve el payload para txt2img con overrides opcionales.
     - Si 'prompt' viene definido, NO usa wildcards por defecto.
     - 'batch_size', 'cfg_scale' y 'steps' se aplican si se proveen.
+    - 'seed' se envía tal cual (-1 = aleatoria; con batch_size N ReForge usa seed, seed+1, ...).
     - Si 'enable_hr' y 'denoising_strength' se proveen, se habilita Hires Fix.
     """
     payload = {
@@ -46,6 +85,8 @@ def build_txt2img_payload(prompt: Optional[str] = None,
         payload["negative_prompt"] = negative_prompt.strip() if isinstance(negative_prompt, str) else ""
     if isinstance(batch_size, int) and 1 <= batch_size <= 10:
         payload["batch_size"] = batch_size
+    if isinstance(seed, int):
+        payload["seed"] = seed
     if isinstance(cfg_scale, (int, float)) and 1 <= float(cfg_scale) <= 15:
         payload["cfg_scale"] = float(cfg_scale)
     if isinstance(steps, int) and 1 <= steps <= 100:
@@ -79,32 +120,29 @@ def build_txt2img_payload(prompt: Optional[str] = None,
     return payload
 
 
-async def get_progress() -> Dict[str, Any]:
+async def get_progress(base_url: Optional[str] = None) -> Dict[str, Any]:
     """Consulta el progreso actual de generación en ReForge."""
-    url = f"{BASE_URL}/sdapi/v1/progress"
-    async with httpx.AsyncClient(timeout=httpx.Timeout(5.0)) as client:
-        resp = await client.get(url)
-        resp.raise_for_status()
-        return resp.json()
+    url = f"{base_url or BASE_URL}/sdapi/v1/progress"
+    resp = await get_client().get(url, timeout=5.0)
+    resp.raise_for_status()
+    return resp.json()
 
-async def call_txt2img(prompt: Optional[str] = None,
-                       negative_prompt: Optional[str] = None,
-                       batch_size: Optional[int] = None,
-                       cfg_scale: Optional[float] = None,
-                       steps: Optional[int] = None,
-                       enable_hr: Optional[bool] = None,
-                       denoising_strength: Optional[float] = None,
-                       hr_second_pass_steps: Optional[int] = None,
-                       hr_upscaler: Optional[str] = None,
-                       hr_scale: Optional[float] = None,
-                       width: Optional[int] = None,
-                       height: Optional[int] = None,
-                       alwayson_scripts: Optional[Any] = None,
-                       override_settings: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
-    """Realiza la llamada a la API de ReForge txt2img y devuelve el JSON de respuesta.
-    Aplica overrides si se proporcionan.
-    """
-    url = f"{BASE_URL}{TXT2IMG_ENDPOINT}"
+def resolve_txt2img_payload(prompt: Optional[str] = None,
+                            negative_prompt: Optional[str] = None,
+                            batch_size: Optional[int] = None,
+                            cfg_scale: Optional[float] = None,
+                            steps: Optional[int] = None,
+                            enable_hr: Optional[bool] = None,
+                            denoising_strength: Optional[float] = None,
+                            hr_second_pass_steps: Optional[int] = None,
+                            hr_upscaler: Optional[str] = None,
+                            hr_scale: Optional[float] = None,
+                            width: Optional[int] = None,
+                            height: Optional[int] = None,
+                            alwayson_scripts: Optional[Any] = None,
+                            seed: Optional[int] = None,
+                            override_settings: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Payload final que call_txt2img envía a ReForge (defaults, overrides, scripts y opciones avanzadas)."""
     payload = build_txt2img_payload(
         prompt=prompt,
         negative_prompt=negative_prompt,
@@ -118,6 +156,7 @@ async def call_txt2img(prompt: Optional[str] = None,
         hr_scale=hr_scale,
         width=width,
         height=height,
+        seed=seed,
     )
     # Compatibilidad: aceptar dict o lista para alwayson_scripts
     if alwayson_scripts:
@@ -136,9 +175,49 @@ async def call_txt2img(prompt: Optional[str] = None,
         # Inyección directa de opciones avanzadas (sd_vae, CLIP_stop_at_last_layers, etc.)
         payload["override_settings"] = override_settings
     
+    # Sanitizar None
+    return {k: v for k, v in payload.items() if v is not None}
+
+
+async def call_txt2img(prompt: Optional[str] = None,
+                       negative_prompt: Optional[str] = None,
+                       batch_size: Optional[int] = None,
+                       cfg_scale: Optional[float] = None,
+                       steps: Optional[int] = None,
+                       enable_hr: Optional[bool] = None,
+                       denoising_strength: Optional[float] = None,
+                       hr_second_pass_steps: Optional[int] = None,
+                       hr_upscaler: Optional[str] = None,
+                       hr_scale: Optional[float] = None,
+                       width: Optional[int] = None,
+                       height: Optional[int] = None,
+                       alwayson_scripts: Optional[Any] = None,
+                       seed: Optional[int] = None,
+                       override_settings: Optional[Dict[str, Any]] = None,
+                       base_url: Optional[str] = None) -> Dict[str, Any]:
+    """Realiza la llamada a la API de ReForge txt2img y devuelve el JSON de respuesta.
+    Aplica overrides si se proporcionan. base_url permite apuntar a otra instancia (pool).
+    """
+    url = f"{base_url or BASE_URL}{TXT2IMG_ENDPOINT}"
+    payload = resolve_txt2img_payload(
+        prompt=prompt,
+        negative_prompt=negative_prompt,
+        batch_size=batch_size,
+        cfg_scale=cfg_scale,
+        steps=steps,
+        enable_hr=enable_hr,
+        denoising_strength=denoising_strength,
+        hr_second_pass_steps=hr_second_pass_steps,
+        hr_upscaler=hr_upscaler,
+        hr_scale=hr_scale,
+        width=width,
+        height=height,
+        alwayson_scripts=alwayson_scripts,
+        seed=seed,
+        override_settings=override_settings,
+    )
     # Timeout ampliado a 600s para evitar 502 por Mac M2
-    # Sanitizar None y log de depuración del payload completo
-    payload = {k: v for k, v in payload.items() if v is not None}
+    # Log de depuración del payload completo
     try:
         print(f"[DEBUG] Hires Payload: scale={payload.get('hr_scale')}, upscaler={payload.get('hr_upscaler')}, modules={payload.get('hr_additional_modules')}")
     except Exception:
@@ -150,31 +229,29 @@ async def call_txt2img(prompt: Optional[str] = None,
             print("[ReForge/txt2img] Payload serialización fallida")
         except Exception:
             pass
-    async with httpx.AsyncClient(timeout=httpx.Timeout(600.0)) as client:
-        try:
-            resp = await client.post(url, json=payload)
-            resp.raise_for_status()
-            return resp.json()
-        except httpx.HTTPStatusError as e:
-            print(f"[ERROR] ReForge returned {e.response.status_code}: {e.response.text}")
-            raise
+    try:
+        resp = await get_client().post(url, json=payload, timeout=600.0)
+        resp.raise_for_status()
+        return resp.json()
+    except httpx.HTTPStatusError as e:
+        print(f"[ERROR] ReForge returned {e.response.status_code}: {e.response.text}")
+        raise
 
 
 async def list_checkpoints() -> List[str]:
     """Obtiene la lista de modelos (checkpoints) y devuelve solo los 'title'."""
     url = f"{BASE_URL}{MODELS_ENDPOINT}"
     try:
-        async with httpx.AsyncClient(timeout=5.0) as client:
-            resp = await client.get(url)
-            resp.raise_for_status()
-            data = resp.json()
-            titles: List[str] = []
-            if isinstance(data, list):
-                for item in data:
-                    title = item.get("title") if isinstance(item, dict) else None
-                    if title:
-                        titles.append(title)
-            return titles
+        resp = await get_client().get(url, timeout=5.0)
+        resp.raise_for_status()
+        data = resp.json()
+        titles: List[str] = []
+        if isinstance(data, list):
+            for item in data:
+                title = item.get("title") if isinstance(item, dict) else None
+                if title:
+                    titles.append(title)
+        return titles
     except Exception:
         return []
 
@@ -182,17 +259,16 @@ async def list_vaes() -> List[str]:
     """Obtiene la lista de VAEs y devuelve solo los 'model_name'."""
     url = f"{BASE_URL}{VAES_ENDPOINT}"
     try:
-        async with httpx.AsyncClient(timeout=5.0) as client:
-            resp = await client.get(url)
-            resp.raise_for_status()
-            data = resp.json()
-            names: List[str] = []
-            if isinstance(data, list):
-                for item in data:
-                    name = item.get("model_name") if isinstance(item, dict) else None
-                    if name:
-                        names.append(name)
-            return names
+        resp = await get_client().get(url, timeout=5.0)
+        resp.raise_for_status()
+        data = resp.json()
+        names: List[str] = []
+        if isinstance(data, list):
+            for item in data:
+                name = item.get("model_name") if isinstance(item, dict) else None
+                if name:
+                    names.append(name)
+        return names
     except Exception:
         return []
 
@@ -200,69 +276,77 @@ async def list_upscalers() -> List[str]:
     """Obtiene la lista de Upscalers disponibles desde la API y devuelve solo los 'name'."""
     url = f"{BASE_URL}/sdapi/v1/upscalers"
     try:
-        async with httpx.AsyncClient(timeout=5.0) as client:
-            resp = await client.get(url)
-            resp.raise_for_status()
-            data = resp.json()
-            names: List[str] = []
-            if isinstance(data, list):
-                for item in data:
-                    name = item.get("name") if isinstance(item, dict) else None
-                    if name:
-                        names.append(name)
-            return names
+        resp = await get_client().get(url, timeout=5.0)
+        resp.raise_for_status()
+        data = resp.json()
+        names: List[str] = []
+        if isinstance(data, list):
+            for item in data:
+                name = item.get("name") if isinstance(item, dict) else None
+                if name:
+                    names.append(name)
+        return names
     except Exception:
         return []
 
 
-async def set_active_checkpoint(title: str) -> Dict[str, Any]:
+async def set_active_checkpoint(title: str, base_url: Optional[str] = None) -> Dict[str, Any]:
     """Cambia el modelo activo enviando opciones a la API."""
-    url = f"{BASE_URL}{OPTIONS_ENDPOINT}"
+    url = f"{base_url or BASE_URL}{OPTIONS_ENDPOINT}"
     payload = {"sd_model_checkpoint": title}
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        resp = await client.post(url, json=payload)
+    try:
+        resp = await get_client().post(url, json=payload, timeout=30.0)
         resp.raise_for_status()
-        return {"status": "ok", "applied": title}
+    finally:
+        # El cambio de modelo puede aplicarse aunque la respuesta falle: no servir opciones viejas
+        invalidate_options(base_url)
+    return {"status": "ok", "applied": title}
 
 async def refresh_checkpoints() -> Dict[str, Any]:
     url = f"{BASE_URL}/sdapi/v1/refresh-checkpoints"
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        resp = await client.post(url)
-        resp.raise_for_status()
-        try:
-            return resp.json()
-        except Exception:
-            return {"status": "ok"}
+    invalidate_options()
+    resp = await get_client().post(url, timeout=30.0)
+    resp.raise_for_status()
+    try:
+        return resp.json()
+    except Exception:
+        return {"status": "ok"}
 
 
-async def get_options() -> Dict[str, Any]:
-    """Obtiene las opciones actuales de ReForge (incluye sd_model_checkpoint, enable_hr, hr_scale, etc.)."""
-    url = f"{BASE_URL}{OPTIONS_ENDPOINT}"
+async def get_options(base_url: Optional[str] = None, fresh: bool = False) -> Dict[str, Any]:
+    """Obtiene las opciones actuales de ReForge (incluye sd_model_checkpoint, enable_hr, hr_scale, etc.).
+    Usa la caché de OPTIONS_CACHE_TTL segundos salvo fresh=True; los errores no se cachean."""
+    key = base_url or BASE_URL
+    cached = _options_cache.get(key)
+    if not fresh and cached is not None and time.monotonic() - cached[0] < OPTIONS_CACHE_TTL:
+        return dict(cached[1])
     try:
-        async with httpx.AsyncClient(timeout=5.0) as client:
-            resp = await client.get(url)
-            resp.raise_for_status()
-            return resp.json()
+        resp = await get_client().get(f"{key}{OPTIONS_ENDPOINT}", timeout=5.0)
+        resp.raise_for_status()
+        data = resp.json()
     except Exception:
         return {}
+    if isinstance(data, dict) and OPTIONS_CACHE_TTL > 0:
+        _options_cache[key] = (time.monotonic(), data)
+        return dict(data)
+    return data
 
 
-async def interrupt_generation() -> Dict[str, Any]:
+async def interrupt_generation(base_url: Optional[str] = None) -> Dict[str, Any]:
     """Interrumpe la generación actual en ReForge/Stable Diffusion (endpoint oficial /sdapi/v1/interrupt)."""
-    url = f"{BASE_URL}{INTERRUPT_ENDPOINT}"
-    async with httpx.AsyncClient(timeout=10.0) as client:
-        resp = await client.post(url)
-        # Algunas implementaciones devuelven 200 sin cuerpo; asegurar status
-        try:
-            resp.raise_for_status()
-        except Exception:
-            # Si falla, devolvemos un estado parcial para log
-            return {"status": "error", "code": resp.status_code}
-        try:
-            data = resp.json()
-        except Exception:
-            data = {"status": "ok"}
-        return data
+    url = f"{base_url or BASE_URL}{INTERRUPT_ENDPOINT}"
+    resp = await get_client().post(url, timeout=10.0)
+    # Algunas implementaciones devuelven 200 sin cuerpo; asegurar status
+    try:
+        resp.raise_for_status()
+    except Exception:
+        # Si falla, devolvemos un estado parcial para log
+        return {"status": "error", "code": resp.status_code}
+    try:
+        data = resp.json()
+    except Exception:
+        data = {"status": "ok"}
+    return data
     def _clamp_dim(val: Optional[int]) -> Optional[int]:
         try:
             if val is None:
@@ -0,0 +1,114 @@
+import asyncio
+import os
+import time
+from typing import Any, Dict, List, Optional
+
+from services.reforge import BASE_URL, OPTIONS_ENDPOINT, get_client
+
+# Fallos consecutivos de red tras los cuales una instancia se marca no disponible
+MAX_CONSECUTIVE_FAILURES = 2
+
+
+class ReforgeEndpoint:
+    """Estado de una instancia de ReForge dentro del pool."""
+
+    def __init__(self, url: str, name: Optional[str] = None):
+        self.url = url.rstrip("/")
+        self.name = name or self.url.split("://", 1)[-1]
+        self.healthy = True
+        self.last_error: Optional[str] = None
+        self.last_check: Optional[float] = None
+        self.consecutive_failures = 0
+        # Checkpoint cargado según la última lectura de opciones o el último cambio hecho por la fábrica
+        self.checkpoint: Optional[str] = None
+        # Firma (checkpoint/VAE/clip_skip) del último job ejecutado, para la planificación agrupada
+        self.signature: Optional[str] = None
+        self.current_job_id: Optional[int] = None
+        self.current_character: Optional[str] = None
+        self.jobs_done = 0
+        self.jobs_failed = 0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "url": self.url,
+            "healthy": self.healthy,
+            "busy": self.current_job_id is not None,
+            "current_job_id": self.current_job_id,
+            "current_character": self.current_character,
+            "checkpoint": self.checkpoint,
+            "signature": self.signature,
+            "last_error": self.last_error,
+            "last_check": self.last_check,
+            "jobs_done": self.jobs_done,
+            "jobs_failed": self.jobs_failed,
+        }
+
+
+class ReforgePool:
+    """
+    Conjunto de instancias de ReForge (REFORGE_API_BASE_URLS, separadas por comas).
+    La fábrica lanza un worker por instancia sobre la cola compartida; el pool solo
+    lleva la salud y el checkpoint de cada una.
+    """
+
+    def __init__(self, urls: List[str], retry_interval: float = 15.0):
+        seen = set()
+        self.endpoints: List[ReforgeEndpoint] = []
+        for url in urls:
+            url = (url or "").strip().rstrip("/")
+            if url and url not in seen:
+                seen.add(url)
+                self.endpoints.append(ReforgeEndpoint(url))
+        if not self.endpoints:
+            self.endpoints.append(ReforgeEndpoint(BASE_URL))
+        self.retry_interval = retry_interval
+
+    @classmethod
+    def from_env(cls) -> "ReforgePool":
+        raw = os.getenv("REFORGE_API_BASE_URLS") or ""
+        urls = [u for u in raw.split(",") if u.strip()] or [os.getenv("REFORGE_API_BASE_URL") or BASE_URL]
+        interval = float(os.getenv("REFORGE_HEALTH_INTERVAL", "15") or 15)
+        return cls(urls, retry_interval=interval)
+
+    def get(self, name_or_url: str) -> Optional[ReforgeEndpoint]:
+        for ep in self.endpoints:
+            if name_or_url in (ep.name, ep.url):
+                return ep
+        return None
+
+    def any_healthy(self) -> bool:
+        return any(ep.healthy for ep in self.endpoints)
+
+    async def check(self, ep: ReforgeEndpoint) -> bool:
+        """Lee /options de la instancia: actualiza salud y checkpoint cargado."""
+        ep.last_check = time.time()
+        try:
+            resp = await get_client().get(f"{ep.url}{OPTIONS_ENDPOINT}", timeout=5.0)
+            resp.raise_for_status()
+            options = resp.json()
+            ckpt = options.get("sd_model_checkpoint") if isinstance(options, dict) else None
+            if ckpt:
+                ep.checkpoint = ckpt
+            self.mark_success(ep)
+        except Exception as e:
+            self.mark_failure(ep, e)
+        return ep.healthy
+
+    async def check_all(self) -> List[Dict[str, Any]]:
+        await asyncio.gather(*(self.check(ep) for ep in self.endpoints))
+        return self.status()
+
+    def mark_success(self, ep: ReforgeEndpoint):
+        ep.healthy = True
+        ep.consecutive_failures = 0
+        ep.last_error = None
+
+    def mark_failure(self, ep: ReforgeEndpoint, error: Any):
+        ep.consecutive_failures += 1
+        ep.last_error = str(error) or error.__class__.__name__
+        if ep.consecutive_failures >= MAX_CONSECUTIVE_FAILURES:
+            ep.healthy = False
+
+    def status(self) -> List[Dict[str, Any]]:
+        return [ep.to_dict() for ep in self.endpoints]
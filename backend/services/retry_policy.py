@@ -0,0 +1,49 @@
+import random
+from typing import Optional
+
+import httpx
+
+# Estados HTTP de ReForge que vale la pena reintentar (además de cualquier 5xx)
+RETRIABLE_STATUS = (408, 425, 429)
+
+
+class RetryPolicy:
+    """
+    Política de reintentos de la fábrica: clasifica el error y calcula la espera (backoff exponencial
+    con jitter) antes de devolver el job a la cola.
+    - "down": la instancia no acepta conexiones (ReForge reiniciando). El job vuelve sin gastar intento
+      y la instancia deja de despachar hasta que responda.
+    - "transient": timeout, corte a mitad de respuesta, 5xx/429. Gasta un intento y espera backoff.
+    - "permanent": 4xx (p. ej. 422 de validación) o error propio del job. Falla sin reintentar.
+    """
+
+    def __init__(self, max_attempts: int = 4, base_delay: float = 5.0, max_delay: float = 300.0,
+                 factor: float = 2.0, jitter: float = 0.2):
+        self.max_attempts = max(1, int(max_attempts))
+        self.base_delay = max(0.0, float(base_delay))
+        self.max_delay = max(self.base_delay, float(max_delay))
+        self.factor = max(1.0, float(factor))
+        self.jitter = min(1.0, max(0.0, float(jitter)))
+
+    @staticmethod
+    def classify(error: BaseException) -> str:
+        if isinstance(error, (httpx.ConnectError, httpx.ConnectTimeout)):
+            return "down"
+        if isinstance(error, httpx.TransportError):
+            return "transient"
+        if isinstance(error, httpx.HTTPStatusError):
+            code = error.response.status_code
+            return "transient" if code >= 500 or code in RETRIABLE_STATUS else "permanent"
+        return "permanent"
+
+    def delay(self, attempt: int) -> float:
+        """Espera antes del intento siguiente a 'attempt' (1 = primer intento fallido)."""
+        raw = min(self.max_delay, self.base_delay * self.factor ** max(0, attempt - 1))
+        if self.jitter:
+            raw *= 1.0 + random.uniform(-self.jitter, self.jitter)
+        return round(max(0.0, raw), 3)
+
+    def should_retry(self, attempts: int, max_attempts: Optional[int] = None) -> bool:
+        """attempts = intentos ya consumidos por el job; max_attempts propio del job si lo tiene."""
+        limit = int(max_attempts) if max_attempts else self.max_attempts
+        return attempts < limit
@@ -0,0 +1,124 @@
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+# Lado mayor (px) de cada rendition
+THUMB_SIZES: Dict[str, int] = {"sm": 256, "md": 768}
+THUMB_QUALITY = 80
+
+
+def default_thumbs_dir(outputs_dir: str) -> Path:
+    """Carpeta de caché junto a OUTPUTS_DIR (fuera del árbol indexado): <OUTPUTS_DIR>_thumbs."""
+    base = Path(outputs_dir).resolve()
+    return base.parent / f"{base.name}_thumbs"
+
+
+def render_thumbnails(src: str, targets: Dict[str, Tuple[str, int]]) -> Dict[str, str]:
+    """
+    Genera las renditions WebP de una imagen (se ejecuta en el pool de procesos).
+    targets: {size_key: (ruta_destino, lado_mayor_px)}. Escritura atómica vía archivo temporal.
+    """
+    from PIL import Image
+
+    out: Dict[str, str] = {}
+    with Image.open(src) as img:
+        img.draft("RGB", (max(px for _, px in targets.values()),) * 2)
+        base = img.convert("RGBA" if img.mode in ("RGBA", "LA", "P") else "RGB")
+    # De mayor a menor: cada reducción parte de la anterior (más barato)
+    for key, (dest, px) in sorted(targets.items(), key=lambda kv: -kv[1][1]):
+        base.thumbnail((px, px))
+        Path(dest).parent.mkdir(parents=True, exist_ok=True)
+        tmp = f"{dest}.{os.getpid()}.tmp"
+        base.save(tmp, "WEBP", quality=THUMB_QUALITY, method=4)
+        os.replace(tmp, dest)
+        out[key] = dest
+    return out
+
+
+class ThumbnailService:
+    """
+    Renditions WebP (sm/md) de las imágenes de OUTPUTS_DIR en una carpeta de caché.
+    - schedule(): generación anticipada al guardar (fire-and-forget).
+    - ensure(): generación perezosa para archivos existentes, deduplicando trabajos en curso.
+    """
+
+    def __init__(self, outputs_dir: str, thumbs_dir: Optional[str] = None, workers: Optional[int] = None):
+        self.outputs_dir = Path(outputs_dir).resolve()
+        self.thumbs_dir = Path(thumbs_dir).resolve() if thumbs_dir else default_thumbs_dir(outputs_dir)
+        self.workers = workers or max(1, min(2, (os.cpu_count() or 2) - 1))
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._inflight: Dict[str, asyncio.Future] = {}
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            # 'fork' con hilos vivos (watchdog, SQLite, asyncio.to_thread) puede dejar a los hijos
+            # bloqueados en un lock heredado: se usa forkserver (o spawn donde no existe)
+            if "forkserver" in multiprocessing.get_all_start_methods():
+                ctx = multiprocessing.get_context("forkserver")
+                # Precargar solo este módulo: el servidor no re-ejecuta main.py como __mp_main__
+                ctx.set_forkserver_preload([__name__])
+            else:
+                ctx = multiprocessing.get_context("spawn")
+            self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=ctx)
+        return self._pool
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    def source_path(self, rel: str) -> Optional[Path]:
+        """Ruta absoluta de la imagen original validando que quede dentro de OUTPUTS_DIR."""
+        target = (self.outputs_dir / rel).resolve()
+        if self.outputs_dir not in target.parents:
+            return None
+        return target
+
+    def thumb_path(self, rel: str, size: str) -> Path:
+        return self.thumbs_dir / size / f"{rel}.webp"
+
+    def is_fresh(self, rel: str, size: str) -> bool:
+        src = self.source_path(rel)
+        dest = self.thumb_path(rel, size)
+        try:
+            return src is not None and dest.stat().st_mtime >= src.stat().st_mtime
+        except OSError:
+            return False
+
+    async def ensure(self, rel: str, size: str) -> Optional[Path]:
+        """Devuelve la ruta del thumbnail, generándolo (todas las medidas) si falta o está viejo."""
+        if size not in THUMB_SIZES:
+            return None
+        if self.is_fresh(rel, size):
+            return self.thumb_path(rel, size)
+        src = self.source_path(rel)
+        if src is None or not src.exists():
+            return None
+        fut = self._inflight.get(rel)
+        if fut is None:
+            targets = {k: (str(self.thumb_path(rel, k)), px) for k, px in THUMB_SIZES.items()}
+            loop = asyncio.get_running_loop()
+            fut = asyncio.ensure_future(loop.run_in_executor(self._get_pool(), render_thumbnails, str(src), targets))
+            self._inflight[rel] = fut
+            fut.add_done_callback(lambda _f, key=rel: self._inflight.pop(key, None))
+        await asyncio.shield(fut)
+        return self.thumb_path(rel, size)
+
+    def schedule(self, rel: str) -> None:
+        """Lanza la generación en segundo plano (usado por _save_image)."""
+        async def _run():
+            try:
+                await self.ensure(rel, "sm")
+            except Exception as e:
+                print(f"[Thumbnails] Error generando thumbnail de {rel}: {e}")
+        asyncio.create_task(_run())
+
+    def remove(self, rel: str) -> None:
+        for size in THUMB_SIZES:
+            try:
+                self.thumb_path(rel, size).unlink()
+            except OSError:
+                pass
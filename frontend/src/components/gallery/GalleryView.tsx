@@ -9,6 +9,8 @@ interface GalleryItem {
   url: string;
   character: string;
   timestamp: number;
+  thumb_url?: string | null;
+  thumb_md_url?: string | null;
 }
 
 export default function GalleryView() {
@@ -16,6 +18,8 @@ export default function GalleryView() {
     process.env.NEXT_PUBLIC_API_BASE_URL || "http://127.0.0.1:8000";
   const [items, setItems] = React.useState<GalleryItem[]>([]);
   const [page, setPage] = React.useState<number>(1);
+  // Cursor de paginación estable (header X-Next-Cursor del backend)
+  const [cursor, setCursor] = React.useState<string | null>(null);
   const [loading, setLoading] = React.useState<boolean>(false);
   const [error, setError] = React.useState<string | null>(null);
   const [selectedCharacter] = React.useState<string>("");
@@ -34,7 +38,11 @@ export default function GalleryView() {
       setError(null);
       try {
         const params = new URLSearchParams();
-        params.set("page", String(reset ? 1 : page));
+        if (!reset && cursor) {
+          params.set("cursor", cursor);
+        } else {
+          params.set("page", String(reset ? 1 : page));
+        }
         params.set("limit", "100");
         if (selectedCharacter && selectedCharacter.trim()) {
           params.set("character", selectedCharacter.trim());
@@ -52,6 +60,7 @@ export default function GalleryView() {
           );
         }
         const data: GalleryItem[] = await res.json();
+        setCursor(res.headers.get("X-Next-Cursor"));
         if (reset) {
           setItems(data);
           setPage(2);
@@ -67,7 +76,7 @@ export default function GalleryView() {
         setLoading(false);
       }
     },
-    [baseUrl, page, selectedCharacter, overrideBase]
+    [baseUrl, page, cursor, selectedCharacter, overrideBase]
   );
 
   React.useEffect(() => {
@@ -202,7 +211,7 @@ export default function GalleryView() {
             <div key={it.path} className="group relative">
               {/* eslint-disable-next-line @next/next/no-img-element */}
               <img
-                src={it.url}
+                src={it.thumb_url || it.url}
                 alt={it.filename}
                 title={it.url}
                 className="aspect-square w-full object-cover rounded-md border border-slate-700 group-hover:opacity-90"